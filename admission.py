@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+上游配额准入控制
+功能：在用户请求与 Vertex / 火山引擎配额之间加一层准入控制
+    1. 每个用户一个令牌桶，限制单个用户的请求速率
+    2. 每个上游一个全局并发预算，超出部分进入按优先级排序、按用户公平轮转的等待队列
+    3. 无法准入时抛出 AdmissionRejected，携带 Retry-After 与排队位置提示
+注意：状态保存在进程内存中，多进程部署时每个进程各自限流
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from tracing import get_tracer
+
+# 优先级：数值越小越优先
+PRIORITY_HIGH = 0     # 有额外（购买/赠送）额度的用户
+PRIORITY_NORMAL = 1   # 普通用户
+PRIORITY_RETRY = 2    # 刚失败过、免费重试同一个谜底的请求
+PRIORITY_BACKGROUND = 3  # 后台预生成任务，只使用空闲配额
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（限流或排队已满/超时）"""
+
+    def __init__(self, reason: str, retry_after: float, queue_position: Optional[int] = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(retry_after + 0.999))
+        self.queue_position = queue_position
+
+
+class TokenBucket:
+    """经典令牌桶：以 rate 个/秒的速度补充令牌，最多积累 capacity 个"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self, now: Optional[float] = None) -> float:
+        """
+        尝试取出一个令牌
+
+        返回:
+            float: 0 表示成功；否则为下一个令牌可用前需要等待的秒数
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class UserRateLimiter:
+    """按用户划分的令牌桶集合，长时间空闲（已补满）的桶会被清理"""
+
+    def __init__(self, rate_per_minute: float, burst: int, idle_seconds: float = 600):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.idle_seconds = idle_seconds
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def check(self, user_id: int) -> None:
+        """
+        为用户取出一个令牌
+
+        异常:
+            AdmissionRejected: 令牌不足时抛出，retry_after 为下一个令牌的等待时间
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            wait = bucket.try_acquire(now)
+            if now - self._last_prune > self.idle_seconds:
+                self._prune(now)
+        if wait:
+            raise AdmissionRejected("rate_limited", retry_after=wait)
+
+    def _prune(self, now: float) -> None:
+        self._last_prune = now
+        for user_id in [uid for uid, b in self._buckets.items() if now - b.updated > self.idle_seconds]:
+            del self._buckets[user_id]
+
+
+class _Ticket:
+    __slots__ = ("user_id", "granted")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.granted = False
+
+
+class UpstreamBudget:
+    """
+    单个上游的全局并发预算
+
+    空闲槽位直接准入；否则进入等待队列。队列按 (优先级, 该用户在队列中的序号, 到达顺序) 排序，
+    同一优先级内各用户轮流获得槽位，单个用户的大量请求无法挤占其他用户。
+    """
+
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, max_wait: float, max_queued_per_user: int):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.max_queued_per_user = max_queued_per_user
+        self._cond = threading.Condition()
+        self._active = 0
+        self._queue = []
+        self._queued_per_user = {}
+        self._seq = itertools.count()
+        # 槽位占用时长的指数加权平均，用于估算 Retry-After
+        self._avg_hold = 10.0
+        self.stats = {"admitted": 0, "queued_total": 0, "rejected_full": 0, "rejected_timeout": 0}
+
+    def _estimate_wait(self, position: int) -> float:
+        return self._avg_hold * position / max(1, self.max_concurrency)
+
+    def _position(self, entry: tuple) -> int:
+        return 1 + sum(1 for e in self._queue if e[:3] < entry[:3])
+
+    def _grant_next(self) -> None:
+        while self._queue and self._active < self.max_concurrency:
+            _, _, _, ticket = heapq.heappop(self._queue)
+            self._dequeued(ticket.user_id)
+            ticket.granted = True
+            self._active += 1
+        self._cond.notify_all()
+
+    def _dequeued(self, user_id) -> None:
+        remaining = self._queued_per_user[user_id] - 1
+        if remaining:
+            self._queued_per_user[user_id] = remaining
+        else:
+            del self._queued_per_user[user_id]
+
+    def acquire(self, user_id: int, priority: int = PRIORITY_NORMAL) -> None:
+        """
+        获取一个并发槽位，必要时排队等待
+
+        异常:
+            AdmissionRejected: 队列已满、该用户排队请求过多或等待超时
+        """
+        with self._cond:
+            if self._active < self.max_concurrency and not self._queue:
+                self._active += 1
+                self.stats["admitted"] += 1
+                return
+
+            user_queued = self._queued_per_user.get(user_id, 0)
+            if len(self._queue) >= self.max_queue or user_queued >= self.max_queued_per_user:
+                self.stats["rejected_full"] += 1
+                position = len(self._queue) + 1
+                raise AdmissionRejected(f"{self.name}_queue_full", self._estimate_wait(position), position)
+
+            ticket = _Ticket(user_id)
+            entry = (priority, user_queued, next(self._seq), ticket)
+            heapq.heappush(self._queue, entry)
+            self._queued_per_user[user_id] = user_queued + 1
+            self.stats["queued_total"] += 1
+
+            deadline = time.monotonic() + self.max_wait
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    position = self._position(entry)
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._dequeued(user_id)
+                    self.stats["rejected_timeout"] += 1
+                    raise AdmissionRejected(f"{self.name}_queue_timeout", self._estimate_wait(position), position)
+                self._cond.wait(remaining)
+            self.stats["admitted"] += 1
+
+    def release(self, hold_seconds: Optional[float] = None) -> None:
+        """归还槽位并唤醒队首的请求"""
+        with self._cond:
+            self._active -= 1
+            if hold_seconds is not None:
+                self._avg_hold = 0.8 * self._avg_hold + 0.2 * hold_seconds
+            self._grant_next()
+
+    @contextmanager
+    def slot(self, user_id: int, priority: int = PRIORITY_NORMAL):
+        """在 with 语句块内占用一个并发槽位（排队等待的耗时记录为 admission.<name> Span）"""
+        with get_tracer().span(f"admission.{self.name}", priority=priority):
+            self.acquire(user_id, priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def snapshot(self) -> dict:
+        """返回当前并发、排队和累计计数"""
+        with self._cond:
+            return {
+                "name": self.name,
+                "active": self._active,
+                "max_concurrency": self.max_concurrency,
+                "queued": len(self._queue),
+                "max_queue": self.max_queue,
+                "avg_hold_seconds": round(self._avg_hold, 3),
+                **self.stats,
+            }
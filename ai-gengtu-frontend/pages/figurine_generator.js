@@ -162,7 +162,7 @@ export default function FigurineGeneratorPage() {
             {history.map((item) => (
               <div key={item.id} className={styles.historyItem}>
                 <img
-                  src={`${process.env.NEXT_PUBLIC_API_BASE_URL}${item.image_url}`}
+                  src={item.image_url.startsWith('http') ? item.image_url : `${process.env.NEXT_PUBLIC_API_BASE_URL}${item.image_url}`}
                   alt={item.riddle_answer}
                   className={styles.historyImage}
                 />
@@ -11,6 +11,8 @@ export default function MemeGeneratorPage() {
   const [credits, setCredits] = useState(null);
   const [history, setHistory] = useState([]);
   const [selectedSize, setSelectedSize] = useState('vertical');
+  const [generationId, setGenerationId] = useState(null);
+  const [variantsRemaining, setVariantsRemaining] = useState(0);
 
   const fetchUserData = useCallback(async () => {
     try {
@@ -71,13 +73,7 @@ export default function MemeGeneratorPage() {
         throw new Error(errorData.message || `生成失败 (状态码: ${response.status})`);
       }
 
-      const imageBlob = await response.blob();
-      const objectURL = URL.createObjectURL(imageBlob);
-      setImageUrl(objectURL);
-
-      // 操作成功后，刷新额度和历史记录
-      await fetchUserData();
-      await fetchHistory();
+      await showImageResponse(response);
 
     } catch (err) {
       console.error('Meme generation error:', err);
@@ -87,6 +83,44 @@ export default function MemeGeneratorPage() {
     }
   };
 
+  const showImageResponse = async (response) => {
+    const imageBlob = await response.blob();
+    const objectURL = URL.createObjectURL(imageBlob);
+    setImageUrl(objectURL);
+    setGenerationId(response.headers.get('X-Generation-Id'));
+    setVariantsRemaining(Number(response.headers.get('X-Variants-Remaining') || 0));
+
+    // 操作成功后，刷新额度和历史记录
+    await fetchUserData();
+    await fetchHistory();
+  };
+
+  // 换一个版本：直接取同一次生成中保存的下一张图片
+  const handleNextVariant = async () => {
+    setLoading(true);
+    setError(null);
+
+    try {
+      const response = await fetch(`${process.env.NEXT_PUBLIC_API_BASE_URL}/api/generations/${generationId}/next_variant`, {
+        method: 'POST',
+        credentials: 'include'
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(errorData.message || `获取失败 (状态码: ${response.status})`);
+      }
+
+      await showImageResponse(response);
+
+    } catch (err) {
+      console.error('Next variant error:', err);
+      setError(err.message);
+    } finally {
+      setLoading(false);
+    }
+  };
+
   return (
     <div className={styles.pageContainer}>
       <Head>
@@ -138,6 +172,11 @@ export default function MemeGeneratorPage() {
           <a href={imageUrl} download={`meme_${new Date().getTime()}.png`} className={styles.downloadButton}>
             下载梗图
           </a>
+          {generationId && variantsRemaining > 0 && (
+            <button type="button" className={styles.button} onClick={handleNextVariant} disabled={loading || (credits !== null && credits <= 0)}>
+              换一个版本（还有 {variantsRemaining} 个）
+            </button>
+          )}
         </div>
       )}
 
@@ -148,7 +187,7 @@ export default function MemeGeneratorPage() {
             {history.map((item) => (
               <div key={item.id} className={styles.historyItem}>
                 <img
-                  src={`${process.env.NEXT_PUBLIC_API_BASE_URL}${item.image_url}`}
+                  src={item.image_url.startsWith('http') ? item.image_url : `${process.env.NEXT_PUBLIC_API_BASE_URL}${item.image_url}`}
                   alt={item.riddle_answer}
                   className={styles.historyImage}
                 />
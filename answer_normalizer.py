@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+谜底归一化工具
+功能：把用户输入的谜底转换为缓存键，使仅在标点、空白、全半角、繁简体上不同的输入得到同一个键
+    可选：转换为无声调拼音，使同音的不同写法也能命中（谐音谜题的核心特性）
+环境依赖：繁简转换需要 opencc（pip install opencc-python-reimplemented），拼音需要 pypinyin；未安装时跳过对应步骤
+"""
+
+import logging
+import unicodedata
+
+try:
+    from opencc import OpenCC
+    _t2s = OpenCC("t2s")
+except ImportError:
+    _t2s = None
+    logging.warning("未安装 opencc，谜底归一化将跳过繁简转换")
+
+try:
+    from pypinyin import lazy_pinyin
+except ImportError:
+    lazy_pinyin = None
+
+# 去除的 Unicode 字符类别：标点（P*）、符号（S*）、分隔符/空白（Z*）、控制字符（C*）
+_STRIPPED_CATEGORIES = ("P", "S", "Z", "C")
+
+
+def normalize_answer(answer: str, use_pinyin: bool = False) -> str:
+    """
+    计算谜底的归一化缓存键
+
+    参数:
+        answer: 用户输入的谜底
+        use_pinyin: 是否转换为无声调拼音（需要 pypinyin，未安装时忽略）
+
+    返回:
+        str: 归一化后的键；拼音键带 "py:" 前缀，与字形键互不冲突
+    """
+    text = unicodedata.normalize("NFKC", answer).lower()
+    text = "".join(ch for ch in text if not unicodedata.category(ch).startswith(_STRIPPED_CATEGORIES))
+    if _t2s is not None:
+        text = _t2s.convert(text)
+    if use_pinyin and lazy_pinyin is not None:
+        return "py:" + "".join(lazy_pinyin(text))
+    return text
@@ -15,9 +15,10 @@ import base64
 import datetime
 import hashlib
 import hmac
+import uuid
 from PIL import Image  # 用于图片处理
 import os
-from typing import Optional  # 类型提示：可选参数
+from typing import List, Optional  # 类型提示
 from io import BytesIO
 
 # 第三方库
@@ -25,32 +26,16 @@ import requests
 from dotenv import load_dotenv
 import logging  # 日志模块
 
+# 本地模块
+from tracing import get_tracer
+from cassette import get_cassette, response_to_dict, response_from_dict
+from log_config import setup_logging
+
 # ------------------------------
 # 2. 日志系统初始化（输出到文件+控制台）
 # ------------------------------
-"""初始化日志配置：同时输出到指定文件和控制台"""
-# 日志目录（用户指定路径）
-LOG_DIR = os.getenv('LOGS_PATH')
-# 确保日志目录存在（不存在则创建）
-os.makedirs(LOG_DIR, exist_ok=True)
-
-# 日志文件名（按日期命名，如：2024-05-20.log）
-log_file = os.path.join(LOG_DIR, datetime.datetime.now().strftime("%Y-%m-%d") + "_jimeng.log")
-
-# 日志格式（包含：时间、级别、模块行号、消息）
-log_format = "%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s"
-
-# 配置日志处理器（文件+控制台）
-logging.basicConfig(
-    level=logging.INFO,  # 日志级别：INFO及以上会被记录
-    format=log_format,
-    handlers=[
-        # 1. 输出到文件（UTF-8编码，避免中文乱码）
-        logging.FileHandler(log_file, encoding="utf-8"),
-        # 2. 输出到控制台
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+# 统一日志配置（队列异步写入、按时间和大小轮转）；被主后端导入时沿用主后端已有的配置
+setup_logging("jimeng")
 
 # ------------------------------
 # 3. 全局配置加载（从.env文件读取密钥和路径）
@@ -77,6 +62,9 @@ DEFAULT_IMAGE_DIR = os.getenv(
     "./images"
 )
 
+# 单次 HTTP 请求的超时时间（秒）：同步渲染时即梦在这一个请求内出图，是图片阶段的实际超时
+REQUEST_TIMEOUT = float(os.getenv("JIMENG_REQUEST_TIMEOUT", "30"))
+
 
 # ------------------------------
 # 4. 工具函数：Base64转图片
@@ -123,9 +111,9 @@ def base64_to_image(base64_str: str, output_path: Optional[str] = None) -> Optio
                 os.makedirs(DEFAULT_IMAGE_DIR, exist_ok=True)
                 logging.info("确认/创建默认图片目录：%s", DEFAULT_IMAGE_DIR)
                 
-                # 生成时间戳文件名（避免重复）：20240520143025.png
+                # 生成时间戳+随机后缀文件名（同一秒内的多张图片/并发请求不会重名）：20240520143025_1a2b3c4d.png
                 timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-                output_path = os.path.join(DEFAULT_IMAGE_DIR, f"{timestamp}.{img_format}")
+                output_path = os.path.join(DEFAULT_IMAGE_DIR, f"{timestamp}_{uuid.uuid4().hex[:8]}.{img_format}")
             
             # 步骤5：保存图片到本地
             logging.info("开始保存图片到：%s", output_path)
@@ -206,26 +194,23 @@ def format_query_params(params: dict) -> str:
     return formatted
 
 
-# ------------------------------
-# 6. 核心函数：V4签名+API请求
-# ------------------------------
-def send_v4_signed_request(
+def build_v4_signed_headers(
     access_key: str,
     secret_key: str,
-    query_params: dict,
-    request_body: dict
-) -> Optional[str]:
+    canonical_query: str,
+    request_body_str: str
+) -> dict:
     """
-    生成V4签名并发送API请求，最终返回图片保存路径
+    按火山引擎V4签名规则构建请求头（签名包含当前时间，每次调用结果不同）
     
     参数:
         access_key: 火山引擎AccessKey
         secret_key: 火山引擎SecretKey
-        query_params: API查询参数（如Action、Version）
-        request_body: API请求体（如prompt、req_key）
+        canonical_query: 已格式化的查询参数（format_query_params的结果）
+        request_body_str: JSON格式的请求体字符串
     
     返回:
-        Optional[str]: 成功返回图片路径；失败返回None
+        dict: 包含X-Date、Authorization等字段的完整请求头
     """
     # 前置检查：密钥是否缺失
     if not (access_key and secret_key):
@@ -245,15 +230,11 @@ def send_v4_signed_request(
     signed_headers = "content-type;host;x-content-sha256;x-date"  # 需签名的请求头
     content_type = "application/json"  # 请求体格式
     
-    # 2.2 格式化查询参数和请求体
-    canonical_query = format_query_params(query_params)
-    request_body_str = json.dumps(request_body, ensure_ascii=False)  # 转为JSON字符串
-    
-    # 2.3 计算请求体的SHA256哈希（V4签名要求）
+    # 2.2 计算请求体的SHA256哈希（V4签名要求）
     payload_hash = hashlib.sha256(request_body_str.encode("utf-8")).hexdigest()
     logging.debug("请求体SHA256哈希：%s", payload_hash)
     
-    # 2.4 构建规范请求头（小写key+值，末尾换行）
+    # 2.3 构建规范请求头（小写key+值，末尾换行）
     canonical_headers = (
         f"content-type:{content_type}\n"
         f"host:{API_CONFIG['host']}\n"
@@ -262,7 +243,7 @@ def send_v4_signed_request(
     )
     logging.debug("规范请求头：%s", canonical_headers.strip())  # strip()去除末尾换行，避免日志冗余
     
-    # 2.5 拼接完整规范请求
+    # 2.4 拼接完整规范请求
     canonical_request = (
         f"{API_CONFIG['method']}\n"
         f"{canonical_uri}\n"
@@ -286,7 +267,7 @@ def send_v4_signed_request(
     # 步骤4：生成签名密钥并计算最终签名
     signing_key = generate_v4_sign_key(secret_key, date_stamp, API_CONFIG['region'], API_CONFIG['service'])
     signature = hmac.new(signing_key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
-    logging.info("V4签名计算完成：%s", signature)
+    logging.debug("V4签名计算完成：%s", signature)
     
     # 步骤5：构建Authorization请求头
     auth_header = (
@@ -304,65 +285,177 @@ def send_v4_signed_request(
         "Content-Type": content_type
     }
     logging.debug("请求头构建完成：%s", request_headers)
+    return request_headers
+
+
+# ------------------------------
+# 6. 核心函数：V4签名+API请求
+# ------------------------------
+def send_v4_signed_json(
+    access_key: str,
+    secret_key: str,
+    query_params: dict,
+    request_body: dict
+) -> dict:
+    """
+    生成V4签名并发送API请求，返回解析后的JSON响应
+    
+    参数:
+        access_key: 火山引擎AccessKey
+        secret_key: 火山引擎SecretKey
+        query_params: API查询参数（如Action、Version）
+        request_body: API请求体（如prompt、req_key）
+    
+    返回:
+        dict: 响应JSON
+    
+    异常:
+        requests.exceptions.RequestException: 超时、连接失败、4xx/5xx等
+        ValueError: 响应不是合法JSON
+    """
+    # 格式化查询参数和请求体（签名和录制/回放的请求键都基于它们）
+    canonical_query = format_query_params(query_params)
+    request_body_str = json.dumps(request_body, ensure_ascii=False)  # 转为JSON字符串
     
-    # 步骤7：发送POST请求
+    # 签名并发送POST请求（经过录制/回放层，回放时不签名、不访问网络）
     request_url = f"{API_CONFIG['endpoint']}?{canonical_query}"
     logging.info("开始发送API请求，URL：%s", request_url)
     logging.debug("请求体：%s", request_body_str)
     
-    try:
-        response = requests.post(
+    def post():
+        return requests.post(
             url=request_url,
-            headers=request_headers,
+            headers=build_v4_signed_headers(access_key, secret_key, canonical_query, request_body_str),
             data=request_body_str.encode("utf-8"),  # 显式指定UTF-8编码，避免中文乱码
-            timeout=30  # 超时时间30秒，防止长期阻塞
+            timeout=REQUEST_TIMEOUT  # 超时时间，防止长期阻塞
         )
+    
+    with get_tracer().span("jimeng.http", action=query_params.get("Action")) as span:
+        response = get_cassette().call(
+            "jimeng", {"query": query_params, "body": request_body}, post,
+            encode=response_to_dict, decode=response_from_dict,
+        )
+        span.set_attribute("http.status_code", response.status_code)
         # 检查HTTP状态码（200为成功）
         response.raise_for_status()
-        logging.info("API请求成功，HTTP状态码：%d", response.status_code)
-    
-    except requests.exceptions.RequestException as e:
-        # 捕获所有HTTP请求异常（超时、连接失败、4xx/5xx等）
-        logging.error("API请求失败：%s", str(e), exc_info=True)
-        return None
+    logging.info("API请求成功，HTTP状态码：%d", response.status_code)
     
-    # 步骤8：解析响应并提取Base64图片
     try:
         response_json = response.json()
+    except ValueError:
+        logging.error("API响应不是合法JSON格式，响应长度：%d字节", len(response.content))
+        logging.debug("非JSON的API响应内容：%s", response.text)
+        raise
+    # 响应中可能包含完整的Base64图片（数MB），只在开启DEBUG时才序列化
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
         logging.debug("API响应内容：%s", json.dumps(response_json, indent=2, ensure_ascii=False))
+    return response_json
+
+
+def save_base64_images(base64_images: List[str]) -> List[str]:
+    """把响应中的Base64图片逐张保存到本地（单张转换失败时跳过），返回保存路径列表"""
+    image_paths = []
+    for base64_image in base64_images:
+        with get_tracer().span("jimeng.base64_to_image", base64_bytes=len(base64_image)):
+            image_paths.append(base64_to_image(base64_str=base64_image))
+    return [path for path in image_paths if path]
+
+
+def send_v4_signed_request_multi(
+    access_key: str,
+    secret_key: str,
+    query_params: dict,
+    request_body: dict,
+    max_images: int = 1
+) -> List[str]:
+    """
+    生成V4签名并发送API请求，保存响应中的所有图片（最多max_images张）
+    
+    参数:
+        access_key: 火山引擎AccessKey
+        secret_key: 火山引擎SecretKey
+        query_params: API查询参数（如Action、Version）
+        request_body: API请求体（如prompt、req_key）
+        max_images: 最多保存的图片数量
+    
+    返回:
+        List[str]: 成功保存的图片路径列表（按响应顺序）；上游拒绝或响应结构异常时返回空列表
+
+    异常:
+        requests.exceptions.RequestException: 请求未能完成（超时、连接失败、4xx/5xx等），由调用方决定是否重试
+    """
+    # 步骤1：签名并发送请求
+    try:
+        response_json = send_v4_signed_json(access_key, secret_key, query_params, request_body)
+    except requests.exceptions.RequestException as e:
+        logging.error("API请求失败：%s", e)
+        raise
+    except ValueError:
+        return []
+    
+    # 步骤2：解析响应并提取Base64图片
+    try:
+        # 提取即梦生图返回的Base64数据（响应结构：data → binary_data_base64[]，可能包含多张图片）
+        base64_images = response_json["data"]["binary_data_base64"][:max_images]
+        if not base64_images:
+            raise KeyError("binary_data_base64")
+        logging.info("成功提取%d张Base64图片数据", len(base64_images))
         
-        # 提取即梦生图返回的Base64数据（响应结构：data → binary_data_base64[0]）
-        base64_image = response_json["data"]["binary_data_base64"][0]
-        logging.info("成功提取Base64图片数据（长度：%d字节）", len(base64_image))
-        
-        # 调用工具函数将Base64转为本地图片
-        return base64_to_image(base64_str=base64_image)
+        # 调用工具函数将Base64转为本地图片（单张转换失败时跳过）
+        return save_base64_images(base64_images)
     
-    except KeyError as e:
+    except (KeyError, TypeError) as e:
         logging.error("API响应结构异常，缺失字段：%s", str(e))
-        return None
-    except json.JSONDecodeError:
-        logging.error("API响应不是合法JSON格式，响应内容：%s", response.text)
-        return None
+        return []
+
+
+def send_v4_signed_request(
+    access_key: str,
+    secret_key: str,
+    query_params: dict,
+    request_body: dict
+) -> Optional[str]:
+    """
+    生成V4签名并发送API请求，最终返回第一张图片的保存路径
+    
+    参数:
+        access_key: 火山引擎AccessKey
+        secret_key: 火山引擎SecretKey
+        query_params: API查询参数（如Action、Version）
+        request_body: API请求体（如prompt、req_key）
+    
+    返回:
+        Optional[str]: 成功返回图片路径；失败返回None
+
+    异常:
+        requests.exceptions.RequestException: 请求未能完成
+    """
+    image_paths = send_v4_signed_request_multi(access_key, secret_key, query_params, request_body)
+    return image_paths[0] if image_paths else None
 
 
 # ------------------------------
 # 7. 业务函数：即梦生图API调用入口
 # ------------------------------
-def jimeng_generate_api(prompt: str, width: int, height: int) -> Optional[str]:
+def jimeng_generate_variants(prompt: str, width: int, height: int, count: int = 1) -> List[str]:
     """
-    即梦生图API调用入口：输入提示词，返回图片保存路径
+    即梦生图API调用入口：一次请求生成同一提示词的多个版本
 
     参数:
         prompt: 图片生成提示词（中文，需符合即梦生图格式要求）
         width: 图片宽度
         height: 图片高度
+        count: 期望的图片数量；为1时强制单图输出。模型实际返回的数量可能少于count
 
     返回:
-        Optional[str]: 成功返回图片路径；失败返回None
+        List[str]: 图片路径列表，第一张为主图；失败返回空列表
+
+    异常:
+        requests.exceptions.RequestException: 请求未能完成（超时、连接失败等），由调用方决定是否重试
     """
     logging.info("=" * 50)
-    logging.info("开始调用即梦生图API，提示词：%s，尺寸：%dx%d", prompt, width, height)
+    logging.info("开始调用即梦生图API，提示词长度：%d字符，尺寸：%dx%d，版本数：%d", len(prompt), width, height, count)
+    logging.debug("即梦提示词：%s", prompt)
     logging.info("=" * 50)
     
     # 1. 构建API查询参数（即梦生图固定参数）
@@ -372,36 +465,147 @@ def jimeng_generate_api(prompt: str, width: int, height: int) -> Optional[str]:
     }
     
     # 2. 构建API请求体（核心参数：提示词、模型版本）
-    request_body = {
-        "req_key": "jimeng_t2i_v40",  # 即梦生图V4.0模型
-        "prompt": prompt,             # 用户输入的提示词
-        "width": width,
-        "height": height
-    }
+    request_body = build_t2i_request_body(prompt, width, height, count)
     
     # 3. 发送签名请求并返回图片路径
     try:
-        image_path = send_v4_signed_request(
-            access_key=ACCESS_KEY,
-            secret_key=SECRET_KEY,
-            query_params=query_params,
-            request_body=request_body
-        )
+        with get_tracer().span("jimeng.generate", width=width, height=height, variants=count) as span:
+            image_paths = send_v4_signed_request_multi(
+                access_key=ACCESS_KEY,
+                secret_key=SECRET_KEY,
+                query_params=query_params,
+                request_body=request_body,
+                max_images=max(1, count)
+            )
+            span.set_attribute("images", len(image_paths))
         
-        if image_path:
-            logging.info("即梦生图API调用完成，图片保存路径：%s", image_path)
-            return image_path
+        if image_paths:
+            logging.info("即梦生图API调用完成，图片保存路径：%s", image_paths)
+            return image_paths
         else:
             logging.error("即梦生图API调用失败，未获取到图片路径")
-            return None
+            return []
     
+    except requests.exceptions.RequestException:
+        raise
     except Exception as e:
         logging.error("即梦生图API调用过程中发生未知错误：%s", str(e), exc_info=True)
-        return None
+        return []
+
+
+def jimeng_generate_api(prompt: str, width: int, height: int) -> Optional[str]:
+    """
+    即梦生图API调用入口：输入提示词，返回图片保存路径
+
+    参数:
+        prompt: 图片生成提示词（中文，需符合即梦生图格式要求）
+        width: 图片宽度
+        height: 图片高度
+
+    返回:
+        Optional[str]: 成功返回图片路径；失败返回None
+
+    异常:
+        requests.exceptions.RequestException: 请求未能完成
+    """
+    image_paths = jimeng_generate_variants(prompt, width, height, count=1)
+    return image_paths[0] if image_paths else None
+
+
+# ------------------------------
+# 8. 业务函数：异步任务接口（提交任务 + 查询结果）
+# ------------------------------
+# 同步的 CVProcess 在整个渲染期间占用一个线程和一条连接；异步接口提交后立即返回 task_id，
+# 由主后端的轮询器（task_poller.py）统一查询结果
+JIMENG_SUCCESS_CODE = 10000
+# 查询结果中的任务状态：in_queue / generating 为进行中，done 为完成，not_found / expired 为任务不存在或已过期
+JIMENG_PENDING_STATUSES = ("in_queue", "generating")
+
+
+def build_t2i_request_body(prompt: str, width: int, height: int, count: int = 1) -> dict:
+    """构建即梦生图V4.0的请求体（同步与异步接口共用）"""
+    return {
+        "req_key": "jimeng_t2i_v40",  # 即梦生图V4.0模型
+        "prompt": prompt,             # 用户输入的提示词
+        "width": width,
+        "height": height,
+        "force_single": count <= 1    # 关闭后模型可在一次请求中返回多张图片
+    }
+
+
+def jimeng_submit_task(prompt: str, width: int, height: int, count: int = 1) -> Optional[str]:
+    """
+    提交异步生图任务（CVSync2AsyncSubmitTask）
+
+    参数:
+        prompt: 图片生成提示词
+        width: 图片宽度
+        height: 图片高度
+        count: 期望的图片数量；为1时强制单图输出
+
+    返回:
+        Optional[str]: 任务ID；上游拒绝或响应结构异常时返回None
+
+    异常:
+        requests.exceptions.RequestException: 请求未能完成（由调用方决定是否重试）
+    """
+    query_params = {"Action": "CVSync2AsyncSubmitTask", "Version": "2022-08-31"}
+    with get_tracer().span("jimeng.submit", width=width, height=height, variants=count) as span:
+        try:
+            response_json = send_v4_signed_json(ACCESS_KEY, SECRET_KEY, query_params,
+                                                build_t2i_request_body(prompt, width, height, count))
+        except ValueError:
+            return None
+        if response_json.get("code") != JIMENG_SUCCESS_CODE:
+            logging.error("即梦任务提交失败：code=%s，message=%s", response_json.get("code"), response_json.get("message"))
+            return None
+        task_id = (response_json.get("data") or {}).get("task_id")
+        span.set_attribute("task_id", task_id)
+    logging.info("即梦任务已提交，task_id：%s", task_id)
+    return task_id
+
+
+def jimeng_get_task_result(task_id: str) -> dict:
+    """
+    查询异步生图任务（CVSync2AsyncGetResult），完成时把图片保存到本地
+
+    参数:
+        task_id: jimeng_submit_task 返回的任务ID
+
+    返回:
+        dict: {"status": "pending" / "done" / "failed", "image_paths": [...], "message": 失败原因}
+
+    异常:
+        requests.exceptions.RequestException: 请求未能完成（轮询器稍后重试）
+    """
+    query_params = {"Action": "CVSync2AsyncGetResult", "Version": "2022-08-31"}
+    request_body = {
+        "req_key": "jimeng_t2i_v40",
+        "task_id": task_id,
+        "req_json": json.dumps({"return_url": False}),
+    }
+    try:
+        response_json = send_v4_signed_json(ACCESS_KEY, SECRET_KEY, query_params, request_body)
+    except ValueError:
+        return {"status": "failed", "image_paths": [], "message": "响应不是合法JSON"}
+    data = response_json.get("data") or {}
+    status = data.get("status")
+    if response_json.get("code") != JIMENG_SUCCESS_CODE:
+        # 任务本身失败（如内容审核不通过）
+        return {"status": "failed", "image_paths": [], "message": response_json.get("message")}
+    if status in JIMENG_PENDING_STATUSES:
+        return {"status": "pending", "image_paths": [], "message": status}
+    if status != "done":
+        return {"status": "failed", "image_paths": [], "message": status}
+    image_paths = save_base64_images(data.get("binary_data_base64") or [])
+    if not image_paths:
+        return {"status": "failed", "image_paths": [], "message": "任务完成但没有返回图片"}
+    logging.info("即梦任务 %s 完成，图片保存路径：%s", task_id, image_paths)
+    return {"status": "done", "image_paths": image_paths, "message": None}
 
 
 # ------------------------------
-# 8. 主程序入口（测试用）
+# 9. 主程序入口（测试用）
 # ------------------------------
 if __name__ == "__main__":    
     # 测试：调用即梦生图API生成图片
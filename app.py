@@ -1,14 +1,26 @@
 # app.py
+import io
 import os
 import sys
-import re
+import gzip
+import json
+import time
+import hmac
+import hashlib
 import logging
+import threading
+import click
 import requests  # 新增导入 requests 库
-from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timezone, timedelta
 from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
-from flask import Flask, request, jsonify, session, send_file
+from functools import wraps
+from flask import Flask, request, jsonify, session, send_file, redirect, g, stream_with_context
+from werkzeug.security import safe_join
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, select, update
+from sqlalchemy.exc import IntegrityError
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_cors import CORS
 from bcrypt import hashpw, gensalt, checkpw
@@ -16,10 +28,30 @@ from flask_migrate import Migrate
 from dotenv import load_dotenv
 load_dotenv()
 
+# 配置日志（需在导入其他模块之前，使整个进程写入同一个日志文件）
+from log_config import setup_logging, SAMPLE_POLL
+setup_logging('app')
+
 # 将 api 目录添加到系统路径
 sys.path.append(os.path.join(os.path.dirname(__file__), 'api'))
 # 移除 genemi_api 导入，因为它将不再被直接调用
-from api.jimeng_api import jimeng_generate_api
+from api.jimeng_api import jimeng_generate_api, jimeng_generate_variants, jimeng_submit_task, jimeng_get_task_result
+from prompt_parser import parse_prompt_response, PromptParseError
+from storage import create_storage_from_env, AsyncUploader
+from answer_normalizer import normalize_answer
+from invitations import InvitationCodeLoader, read_codes, export_codes, redeem_code
+from image_fingerprint import sha256_hex, dhash, hamming, is_distinctive, phash_bands, to_signed64, from_signed64
+from rollups import create_rollup_recorder_from_env, default_since, GRANULARITY_HOUR, GRANULARITY_DAY
+from retention import RetentionPolicy, RetentionSweeper, TIER_HOT, TIER_DELETED, KIND_GENERATED, KIND_UPLOAD
+from user_versions import create_version_store_from_env, PageCache, LocalVersionStore, DisabledVersionStore
+from tracing import configure_tracer, instrument_flask
+from replica_pool import create_replica_pool_from_env
+from profiling import create_profiler_from_env, instrument_profiling
+from cassette import get_cassette, response_to_dict, response_from_dict
+from admission import (AdmissionRejected, UserRateLimiter, UpstreamBudget,
+                       PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_RETRY, PRIORITY_BACKGROUND)
+from pipeline import Pipeline, Stage, GenerationContext
+from task_poller import create_task_poller_from_env, TASK_PENDING, TASK_DONE, TASK_FAILED
 
 # 应用配置
 app = Flask(__name__)
@@ -30,10 +62,38 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'a_very_secret_key_for_sessio
 app.config.update(SESSION_COOKIE_SAMESITE='None')
 app.config['CORS_HEADERS'] = 'Content-Type'
 
-# 从环境变量中获取新加坡服务的URL
-SINGAPORE_GEMINI_API_URL = os.getenv('SINGAPORE_GEMINI_API_URL')
-if not SINGAPORE_GEMINI_API_URL:
-    logging.critical("SINGAPORE_GEMINI_API_URL is not set in environment variables!")
+
+def build_engine_options(database_uri):
+    """
+    根据环境变量构建 SQLAlchemy 连接池配置。
+    生成流程不会在上游调用期间占用连接，连接池只需按数据库工作量而不是等待时间来配置。
+    """
+    options = {
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true',
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    }
+    if database_uri.startswith('sqlite'):
+        return options
+    options.update({
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+    })
+    statement_timeout_ms = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+    if statement_timeout_ms > 0 and database_uri.startswith('postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout_ms}'}
+    return options
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = build_engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+
+# 从环境变量中获取新加坡服务的URL：SINGAPORE_GEMINI_API_URLS 为逗号分隔的多个副本，未配置时使用单个 SINGAPORE_GEMINI_API_URL
+SINGAPORE_GEMINI_API_URLS = [
+    url.strip() for url in os.getenv('SINGAPORE_GEMINI_API_URLS', os.getenv('SINGAPORE_GEMINI_API_URL', '')).split(',')
+    if url.strip()
+]
+if not SINGAPORE_GEMINI_API_URLS:
+    logging.critical("SINGAPORE_GEMINI_API_URL(S) is not set in environment variables!")
     sys.exit(1)
 
 # 初始化扩展
@@ -46,12 +106,11 @@ CORS(app, resources={r"/api/*": {"origins":
         os.getenv('NEXT_PUBLIC_API_BASE_URL'), 
         os.getenv("NEXT_PUBLIC_ALLOWED_ORIGINS")
     ], 
-    "supports_credentials": True}}
+    "supports_credentials": True,
+    "expose_headers": ["X-Generation-Id", "X-Variants-Remaining", "X-Trace-Id", "X-Profile-Id"]}}
 )
 
 
-# 配置日志
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logging.info("Flask 应用初始化完成。")
 
 # --- 数据库模型 ---
@@ -67,12 +126,12 @@ class User(db.Model, UserMixin):
     generations = db.relationship('Generation', backref='user', lazy=True)
 
     def set_password(self, password):
-        logging.info(f"Setting password for user: {self.email}")
+        logging.debug("Setting password for user %s", self.id)
         self.password_hash = hashpw(password.encode('utf-8'), gensalt()).decode('utf-8')
-        logging.info(f"Password hash created.")
+        logging.debug("Password hash created.")
 
     def check_password(self, password):
-        logging.info(f"Checking password for user: {self.email}")
+        logging.debug("Checking password for user %s", self.id)
         return checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
 
 class InvitationCode(db.Model):
@@ -83,6 +142,8 @@ class InvitationCode(db.Model):
     is_used = db.Column(db.Boolean, nullable=False, default=False)
     used_by_user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
     created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=datetime.now(timezone.utc))
+    # 批量发放的活动标签，按活动导出
+    campaign = db.Column(db.String(64), index=True)
 
 class Generation(db.Model):
     __tablename__ = 'generations'
@@ -93,15 +154,1387 @@ class Generation(db.Model):
     image_url = db.Column(db.String(512))
     status = db.Column(db.String(20), nullable=False, default='pending')
     created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=datetime.now(timezone.utc))
+    # 谜底结果缓存：归一化谜底 + 尺寸；复用的结果记录来源生成记录；被判定为质量差的结果不再被复用
+    answer_key = db.Column(db.String(255))
+    size = db.Column(db.String(20))
+    source_generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='SET NULL'), index=True)
+    cache_excluded = db.Column(db.Boolean, nullable=False, default=False)
+    # 流水线检查点：最后完成的阶段和各阶段产出（JSON），失败后的重试从这里继续；updated_at 兼作进行中任务的心跳
+    checkpoint_stage = db.Column(db.String(20))
+    checkpoint = db.Column(db.Text)
+    # 进行中的即梦异步任务 ID：任务完成的回调据此找到持有该任务的生成记录
+    upstream_task_id = db.Column(db.String(64), index=True)
+    updated_at = db.Column(db.TIMESTAMP(timezone=True), default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (db.Index('idx_generations_answer_cache', 'answer_key', 'size', 'status'),
+                      db.Index('idx_generations_status_updated', 'status', 'updated_at'))
+
+class GenerationVariant(db.Model):
+    __tablename__ = 'generation_variants'
+    __table_args__ = (db.UniqueConstraint('generation_id', 'variant_index', name='uq_generation_variants_index'),)
+    id = db.Column(db.Integer, primary_key=True)
+    generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='CASCADE'), nullable=False)
+    variant_index = db.Column(db.Integer, nullable=False)
+    image_url = db.Column(db.String(512))
+    created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    claimed_at = db.Column(db.TIMESTAMP(timezone=True))
+    claimed_by_generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='SET NULL'))
+
+class ImageAsset(db.Model):
+    __tablename__ = 'image_assets'
+    __table_args__ = (db.Index('idx_image_assets_tier_last_accessed', 'tier', 'last_accessed_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), unique=True, nullable=False)
+    kind = db.Column(db.String(20), nullable=False, default=KIND_GENERATED)
+    generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='SET NULL'), index=True)
+    size_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    tier = db.Column(db.String(20), nullable=False, default=TIER_HOT)
+    created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    last_accessed_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+class PregeneratedItem(db.Model):
+    __tablename__ = 'pregenerated_items'
+    __table_args__ = (db.Index('idx_pregenerated_items_available', 'answer_key', 'size', 'claimed_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    answer_key = db.Column(db.String(255), nullable=False)
+    riddle_answer = db.Column(db.Text, nullable=False)
+    size = db.Column(db.String(20), nullable=False)
+    prompt_text = db.Column(db.Text)
+    image_key = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+    claimed_at = db.Column(db.TIMESTAMP(timezone=True))
+    claimed_by_generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='SET NULL'))
+
+class UploadFingerprint(db.Model):
+    __tablename__ = 'upload_fingerprints'
+    id = db.Column(db.Integer, primary_key=True)
+    generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='CASCADE'), unique=True, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    # 64 位差值哈希（有符号保存）及其 4 段 16 位分段，分段用于近似图片的索引查找
+    phash = db.Column(db.BigInteger)
+    phash_band0 = db.Column(db.Integer, index=True)
+    phash_band1 = db.Column(db.Integer, index=True)
+    phash_band2 = db.Column(db.Integer, index=True)
+    phash_band3 = db.Column(db.Integer, index=True)
+    created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (db.UniqueConstraint('user_id', 'key', name='uq_idempotency_keys_user_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    key = db.Column(db.String(128), nullable=False)
+    endpoint = db.Column(db.String(64), nullable=False)
+    request_hash = db.Column(db.String(64), nullable=False)
+    generation_id = db.Column(db.Integer, db.ForeignKey('generations.id', ondelete='CASCADE'), nullable=False)
+    created_at = db.Column(db.TIMESTAMP(timezone=True), nullable=False, default=lambda: datetime.now(timezone.utc))
+
+# 预聚合统计：按小时/天的生成计数、阶段耗时直方图和热门谜底，见 rollups.py
+class UsageRollup(db.Model):
+    __tablename__ = 'usage_rollups'
+    __table_args__ = (db.UniqueConstraint('granularity', 'bucket_start', 'endpoint', 'source', 'status', 'size',
+                                          name='uq_usage_rollups_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(8), nullable=False)
+    bucket_start = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+    endpoint = db.Column(db.String(32), nullable=False)
+    source = db.Column(db.String(32), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    size = db.Column(db.String(20), nullable=False, default='')
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+
+class LatencyRollup(db.Model):
+    __tablename__ = 'latency_rollups'
+    __table_args__ = (db.UniqueConstraint('granularity', 'bucket_start', 'endpoint', 'stage', 'le_ms',
+                                          name='uq_latency_rollups_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    granularity = db.Column(db.String(8), nullable=False)
+    bucket_start = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+    endpoint = db.Column(db.String(32), nullable=False)
+    stage = db.Column(db.String(32), nullable=False)
+    le_ms = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+    total_ms = db.Column(db.BigInteger, nullable=False, default=0)
+
+class AnswerRollup(db.Model):
+    __tablename__ = 'answer_rollups'
+    __table_args__ = (db.UniqueConstraint('bucket_start', 'answer_key', name='uq_answer_rollups_key'),)
+    id = db.Column(db.Integer, primary_key=True)
+    bucket_start = db.Column(db.TIMESTAMP(timezone=True), nullable=False)
+    answer_key = db.Column(db.String(255), nullable=False)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
 
 # --- Flask-Login 用户加载器 ---
 @login_manager.user_loader
 def load_user(user_id):
-    logging.info(f"Attempting to load user with ID: {user_id}")
+    logging.debug("Loading user %s", user_id)
     return User.query.get(int(user_id))
 
+# --- 连接池监控 ---
+class PoolStats:
+    """通过连接池事件统计连接的借出次数、峰值和平均占用时长。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.total_hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['checkout_at'] = time.monotonic()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        checkout_at = connection_record.info.pop('checkout_at', None)
+        if checkout_at is None:
+            return
+        held = time.monotonic() - checkout_at
+        with self._lock:
+            self.checked_out -= 1
+            self.total_hold_seconds += held
+            self.max_hold_seconds = max(self.max_hold_seconds, held)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "checked_out": self.checked_out,
+                "peak_checked_out": self.peak_checked_out,
+                "avg_hold_ms": round(self.total_hold_seconds * 1000 / self.checkouts, 2) if self.checkouts else 0,
+                "max_hold_ms": round(self.max_hold_seconds * 1000, 2),
+            }
+
+
+pool_stats = PoolStats()
+with app.app_context():
+    event.listen(db.engine, 'checkout', pool_stats.on_checkout)
+    event.listen(db.engine, 'checkin', pool_stats.on_checkin)
+
+
+# --- 预聚合统计 ---
+# 生成结果和各阶段耗时在内存中累加，定期合并写入 usage_rollups / latency_rollups / answer_rollups；
+# /api/admin/stats 只读这些预聚合表，不扫描 generations，不与历史记录查询争抢
+rollups = create_rollup_recorder_from_env(app, db, UsageRollup, LatencyRollup, AnswerRollup)
+
+
+# --- 分布式追踪 ---
+# 每个请求一个入口 Span；Gemini 代理调用通过 traceparent 请求头延续同一个 trace，
+# 即梦调用、提示词解析和数据库提交各自记录子 Span。最慢的请求可通过 /api/admin/traces 查询
+tracer = configure_tracer(os.getenv('TRACING_SERVICE_NAME', 'meme-backend'))
+instrument_flask(app, tracer)
+
+
+def start_commit_span(session):
+    """只在请求内记录提交耗时（含 flush），命令行批处理不产生孤立的 Span。"""
+    if tracer.current_span() is not None:
+        session.info['trace_commit_span'] = tracer.start_span('db.commit')
+
+
+def end_commit_span(session, rolled_back=False):
+    span = session.info.pop('trace_commit_span', None)
+    if span is not None:
+        if rolled_back:
+            span.set_attribute('db.rolled_back', True)
+        span.end()
+
+
+event.listen(db.session, 'before_commit', start_commit_span)
+event.listen(db.session, 'after_commit', end_commit_span)
+event.listen(db.session, 'after_rollback', lambda session: end_commit_span(session, rolled_back=True))
+
+
+# --- 管理员鉴权 ---
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+ADMIN_EMAILS = {e.strip().lower() for e in os.getenv('ADMIN_EMAILS', '').split(',') if e.strip()}
+
+
+def is_admin_request():
+    """X-Admin-Token 请求头与 ADMIN_TOKEN 一致，或登录用户的邮箱在 ADMIN_EMAILS 中。"""
+    token = request.headers.get('X-Admin-Token', '')
+    if ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN):
+        return True
+    return current_user.is_authenticated and current_user.email.lower() in ADMIN_EMAILS
+
+
+def admin_required(view):
+    """管理接口鉴权，见 is_admin_request。"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if is_admin_request():
+            return view(*args, **kwargs)
+        logging.warning("Unauthorized admin request to %s", request.path)
+        return jsonify({"message": "Forbidden."}), 403
+    return wrapper
+
+
+# --- 按需请求分析 ---
+# 管理员在请求上加 X-Profile: 1 请求头或 ?profile=1（或使用 PROFILE_TOKEN），也可按 PROFILE_SAMPLE_RATE 抽样；
+# 调用栈采样结果保存在磁盘环形缓冲中，通过 /api/admin/profiles 查看。未分析的请求几乎没有额外开销。
+profiler = create_profiler_from_env(os.getenv('TRACING_SERVICE_NAME', 'meme-backend'), authorize=is_admin_request)
+instrument_profiling(app, profiler)
+
+
+# --- 条件请求（ETag） ---
+# 前端轮询 /api/user、/api/history：每个用户一个版本号，额度或生成记录变化时递增。
+# ETag 由版本号派生，命中时直接返回 304，不加载用户也不查询数据库；历史记录的序列化结果按版本号缓存。
+user_versions = create_version_store_from_env()
+history_page_cache = PageCache(int(os.getenv('HISTORY_CACHE_SIZE', '1024')))
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def bump_user_version(*user_ids):
+    """在事务提交后调用：用户的额度或生成记录发生了变化，使其 ETag 和历史记录缓存失效。"""
+    for user_id in user_ids:
+        if user_id is not None:
+            user_versions.bump(user_id)
+
+
+def conditional_user_get(scope):
+    """
+    为按用户区分的 GET 接口提供 ETag / 304 支持，放在 login_required 之前。
+    会话中的用户 ID 由 Flask-Login 写入，读取它不需要访问数据库。
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            user_id = session.get('_user_id')
+            token = user_versions.token(user_id) if user_id is not None else None
+            if token is None:
+                return view(*args, **kwargs)
+
+            # 版本号必须在查询数据之前读取：并发更新时 ETag 只会偏旧，下次轮询重新获取，不会缓存新数据
+            etag = f"{scope}-{user_id}-{token}"
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                g.user_version = token
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
 # --- API 路由 ---
-PROMPT_PATTERN = r'```json(.*?)```'
+
+# --- 新加坡 Gemini 代理调用 ---
+# 跨境链路（中国 -> 新加坡）上每一次 TCP/TLS 握手和每一个字节都很昂贵：
+# 使用长连接会话复用连接，请求体按需 gzip 压缩，并只向代理索取需要的字段。
+# 只实现了 HTTP/1.1 连接复用（keep-alive 连接池）；requests 不支持 HTTP/2，同一连接上没有多路复用，
+# 并发请求各占一条连接（每个副本最多 GEMINI_PROXY_POOL_SIZE 条）。
+GEMINI_PROXY_TIMEOUT = int(os.getenv('GEMINI_PROXY_TIMEOUT', '60'))
+GEMINI_PROXY_GZIP = os.getenv('GEMINI_PROXY_GZIP', 'true').lower() == 'true'
+GEMINI_PROXY_GZIP_MIN_BYTES = int(os.getenv('GEMINI_PROXY_GZIP_MIN_BYTES', '512'))
+GEMINI_PROXY_POOL_SIZE = int(os.getenv('GEMINI_PROXY_POOL_SIZE', '20'))
+# 精简响应模式：逗号分隔的字段列表（prompt, chinese_prompt, english_prompt, answer, rationale），为空则返回全部字段。
+# 默认只取解析后会用到的字段：chinese_prompt 用于生图，连同 english_prompt、rationale（设计说明）
+# 组成保存在生成记录和预生成池中的 prompt_text；不再索取 Gemini 原始回答（prompt），它重复包含这些内容
+GEMINI_PROXY_FIELDS = [f.strip() for f in os.getenv('GEMINI_PROXY_FIELDS', 'chinese_prompt,english_prompt,rationale').split(',')
+                       if f.strip()]
+
+gemini_proxy_session = requests.Session()
+gemini_proxy_session.headers.update({'Accept-Encoding': 'gzip'})
+# 每个副本一个连接池，避免在副本之间切换时丢弃长连接
+_gemini_proxy_adapter = HTTPAdapter(pool_connections=len(SINGAPORE_GEMINI_API_URLS), pool_maxsize=GEMINI_PROXY_POOL_SIZE)
+gemini_proxy_session.mount('http://', _gemini_proxy_adapter)
+gemini_proxy_session.mount('https://', _gemini_proxy_adapter)
+
+# 多个代理副本之间的客户端负载均衡：最少进行中请求 + 延迟 EWMA，连续失败摘除，/healthz 探测恢复
+gemini_replicas = create_replica_pool_from_env(SINGAPORE_GEMINI_API_URLS)
+
+
+def post_to_gemini_proxy(body, headers):
+    """
+    选择一个代理副本发送请求。连接失败时换一个副本重试一次（提示词生成没有副作用，重复请求只多一次调用成本）；
+    超时不重试，避免把等待时间翻倍。
+    """
+    tried = []
+    while True:
+        replica = gemini_replicas.choose(exclude=tried)
+        tried.append(replica)
+        span = tracer.current_span()
+        if span is not None:
+            span.set_attribute('http.url', replica.url)
+        try:
+            with gemini_replicas.track(replica) as mark_failed:
+                response = gemini_proxy_session.post(replica.url, data=body, headers=headers, timeout=GEMINI_PROXY_TIMEOUT)
+                if response.status_code >= 500:
+                    mark_failed()
+                return response
+        except requests.ConnectionError as e:
+            if len(tried) >= min(2, len(gemini_replicas.replicas)):
+                raise
+            logging.warning("Gemini proxy replica %s unreachable (%s), retrying on another replica", replica.url, e)
+
+
+def call_gemini_proxy(answer):
+    """
+    通过长连接会话调用新加坡 Gemini 代理，返回解析后的 JSON 字典。
+    请求体超过阈值时使用 gzip 压缩；响应的 gzip 解压由 requests 自动完成。
+    """
+    payload = {'answer': answer}
+    if GEMINI_PROXY_FIELDS:
+        payload['fields'] = GEMINI_PROXY_FIELDS
+    # ensure_ascii=False: 中文按 UTF-8 传输（3 字节/字），而不是 \uXXXX 转义（6 字节/字）
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+    if GEMINI_PROXY_GZIP and len(body) >= GEMINI_PROXY_GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+
+    with tracer.span('gemini_proxy.call') as span:
+        # 代理服务从 traceparent 请求头延续同一个 trace
+        tracer.inject(headers)
+        # 录制/回放层按请求内容匹配，回放时不访问代理，性能测试可在无网络环境下重复运行
+        response = get_cassette().call(
+            'gemini_proxy', payload, lambda: post_to_gemini_proxy(body, headers),
+            encode=response_to_dict, decode=response_from_dict,
+        )
+        span.set_attribute('http.status_code', response.status_code)
+        response.raise_for_status()
+    logging.info("Gemini proxy responded in %.2fs, wire bytes: %s, encoding: %s",
+                 response.elapsed.total_seconds(), response.headers.get('Content-Length', 'unknown'),
+                 response.headers.get('Content-Encoding', 'identity'))
+    return response.json()
+
+
+# --- 图片存储 ---
+# 本地磁盘（默认）或 S3 兼容对象存储。使用对象存储时，图片在请求返回后异步上传，
+# 之后由预签名 URL 或 CDN 地址提供下载，应用节点之间无需共享磁盘。
+IMAGES_PATH = os.getenv("IMAGES_PATH", "./images")
+IMAGE_URL_PREFIX = '/generated_images/'
+STORAGE_KEEP_LOCAL_COPY = os.getenv('STORAGE_KEEP_LOCAL_COPY', 'true').lower() == 'true'
+image_storage = create_storage_from_env()
+image_uploader = AsyncUploader(image_storage, int(os.getenv('STORAGE_UPLOAD_WORKERS', '4'))) if image_storage.is_remote else None
+
+
+def image_key_from_url(image_url):
+    """将 Generation.image_url（/generated_images/<key>）还原为存储中的对象键。"""
+    return image_url[len(IMAGE_URL_PREFIX):] if image_url.startswith(IMAGE_URL_PREFIX) else os.path.basename(image_url)
+
+
+def publish_generated_image(generation_id, image_path, model=Generation):
+    """
+    生成记录完成后调用：使用对象存储时在后台上传图片。
+    上传完成后，如配置了 CDN 地址则把记录（默认 Generation，多版本图片为 GenerationVariant）的 image_url
+    更新为该地址，并按配置删除本地副本。
+    """
+    if image_uploader is None:
+        return
+
+    def on_uploaded(key):
+        public_url = image_storage.public_url(key)
+        if public_url:
+            with app.app_context():
+                statement = update(model).where(model.id == generation_id).values(image_url=public_url)
+                owner_id = None
+                if model is Generation:
+                    owner_id = db.session.execute(statement.returning(Generation.user_id)).scalar()
+                else:
+                    db.session.execute(statement)
+                db.session.commit()
+                db.session.remove()
+                bump_user_version(owner_id)
+        if not STORAGE_KEEP_LOCAL_COPY:
+            os.remove(image_path)
+
+    image_uploader.submit(image_path, os.path.basename(image_path), on_done=on_uploaded)
+
+
+# --- 图片保留策略 ---
+# 访问时间只在内存中节流后写回数据库，避免每次下载图片都产生一次写操作
+RETENTION_TOUCH_INTERVAL = int(os.getenv('RETENTION_TOUCH_INTERVAL_SECONDS', '300'))
+_image_last_touched = {}
+_image_touch_lock = threading.Lock()
+
+
+def touch_image_asset(key):
+    """记录图片被访问，用于冷热分级和 LRU 淘汰。"""
+    now = time.monotonic()
+    with _image_touch_lock:
+        if now - _image_last_touched.get(key, float('-inf')) < RETENTION_TOUCH_INTERVAL:
+            return
+        _image_last_touched[key] = now
+        if len(_image_last_touched) > 100000:
+            _image_last_touched.clear()
+    db.session.execute(
+        update(ImageAsset)
+        .where(ImageAsset.key == key, ImageAsset.tier != TIER_DELETED)
+        .values(last_accessed_at=datetime.now(timezone.utc))
+    )
+    db.session.commit()
+
+
+def register_image_asset(key, kind, generation_id, path):
+    """登记一个新文件（不提交事务，由调用方的事务一并提交）。"""
+    db.session.add(ImageAsset(key=key, kind=kind, generation_id=generation_id, size_bytes=os.path.getsize(path)))
+
+
+def serve_image(image_url):
+    """
+    返回图片：CDN 地址直接重定向；本地有副本时直接发送文件；否则重定向到对象存储的预签名 URL。
+    已被保留策略删除的图片返回 410。
+    """
+    if not image_url:
+        return jsonify({"message": "图片已过期。"}), 410
+    if image_url.startswith(('http://', 'https://')):
+        return redirect(image_url)
+
+    key = image_key_from_url(image_url)
+    full_path = safe_join(IMAGES_PATH, key)
+    if full_path is None:
+        return "File not found", 404
+    if os.path.exists(full_path):
+        touch_image_asset(key)
+        # mimetype 'image/jpeg' 或 'image/png' 根据实际情况调整
+        return send_file(full_path, mimetype='image/jpeg')
+    if ImageAsset.query.filter_by(key=key, tier=TIER_DELETED).first():
+        return jsonify({"message": "图片已过期。"}), 410
+    if image_storage.is_remote:
+        touch_image_asset(key)
+        return redirect(image_storage.url_for(key))
+    return "File not found", 404
+
+
+# --- 谜底结果缓存 ---
+# 不同用户经常输入相同或等价的谜底：按归一化谜底 + 尺寸查找已完成的生成结果，由用户选择直接复用或重新生成
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_PINYIN = os.getenv('ANSWER_CACHE_PINYIN', 'false').lower() == 'true'
+# 复用缓存结果消耗的额度
+ANSWER_CACHE_HIT_CREDITS = int(os.getenv('ANSWER_CACHE_HIT_CREDITS', '0'))
+
+
+class AnswerCacheStats:
+    """谜底结果缓存的命中统计（进程内）。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"lookups": 0, "hits": 0, "misses": 0, "reused": 0, "invalidated": 0}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        return stats
+
+
+answer_cache_stats = AnswerCacheStats()
+
+
+def answer_cache_key(answer):
+    return normalize_answer(answer, use_pinyin=ANSWER_CACHE_PINYIN)
+
+
+def answer_digest(answer):
+    """谜底的短摘要：INFO 及以上级别的日志用它关联同一个谜底，不记录谜底原文"""
+    return sha256_hex(answer.encode('utf-8'))[:12]
+
+
+def find_cached_generation(answer_key, size):
+    """查找同一归一化谜底和尺寸下最新的可复用生成记录（只返回原始生成，不返回复用记录）。"""
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    answer_cache_stats.incr("lookups")
+    cached = Generation.query.filter(
+        Generation.answer_key == answer_key,
+        Generation.size == size,
+        Generation.status == 'completed',
+        Generation.image_url.isnot(None),
+        Generation.source_generation_id.is_(None),
+        Generation.cache_excluded.is_(False),
+    ).order_by(Generation.created_at.desc()).first()
+    answer_cache_stats.incr("hits" if cached else "misses")
+    return cached
+
+
+def reuse_cached_generation(user_id, riddle_answer, cached, credits=None):
+    """
+    为用户创建一条复用缓存结果的已完成生成记录，按 credits（默认 ANSWER_CACHE_HIT_CREDITS）扣除额度。
+    返回新记录的 ID；额度不足时不创建记录并抛出 InsufficientCredits。
+    """
+    if credits is None:
+        credits = ANSWER_CACHE_HIT_CREDITS
+    reused = Generation(
+        user_id=user_id, riddle_answer=riddle_answer, status='completed',
+        prompt_text=cached.prompt_text, image_url=cached.image_url,
+        answer_key=cached.answer_key, size=cached.size, source_generation_id=cached.id,
+    )
+    db.session.add(reused)
+    if credits:
+        deduct_credits(user_id, credits)
+    db.session.commit()
+    bump_user_version(user_id)
+    answer_cache_stats.incr("reused")
+    return reused.id
+
+
+# --- 梗图生成步骤 ---
+# --- 上传图片指纹（立体雕塑结果复用） ---
+# 用户经常反复上传同一张头像或表情图：每次上传记录 SHA-256 和感知哈希，关联到生成记录；
+# 用户选择复用时，相同或近似图片的已完成结果直接交付，不调用上游服务
+FIGURINE_CACHE_ENABLED = os.getenv('FIGURINE_CACHE_ENABLED', 'true').lower() == 'true'
+# 近似图片的最大汉明距离（64 位 dHash）；分段索引保证不超过 3 时不会漏查
+FIGURINE_CACHE_MAX_DISTANCE = int(os.getenv('FIGURINE_CACHE_MAX_DISTANCE', '3'))
+FIGURINE_CACHE_HIT_CREDITS = int(os.getenv('FIGURINE_CACHE_HIT_CREDITS', '0'))
+FIGURINE_CACHE_MAX_CANDIDATES = 200
+
+
+def fingerprint_upload(data):
+    """返回上传图片的 (SHA-256, 无符号 dHash)；无法解码为图片时 dHash 为 None"""
+    return sha256_hex(data), dhash(data)
+
+
+def record_upload_fingerprint(generation_id, sha256, phash):
+    """在当前事务中登记上传图片的指纹（随调用方提交）"""
+    bands = phash_bands(phash) if phash is not None else [None] * 4
+    db.session.add(UploadFingerprint(
+        generation_id=generation_id, sha256=sha256,
+        phash=to_signed64(phash) if phash is not None else None,
+        phash_band0=bands[0], phash_band1=bands[1], phash_band2=bands[2], phash_band3=bands[3],
+    ))
+
+
+def find_figurine_by_fingerprint(sha256, phash):
+    """
+    查找相同或近似上传图片的最新可复用生成记录。
+    返回 (Generation, 'exact' / 'near')，没有时返回 (None, None)
+    """
+    if not FIGURINE_CACHE_ENABLED:
+        return None, None
+    reusable = db.session.query(Generation, UploadFingerprint.phash).join(
+        UploadFingerprint, UploadFingerprint.generation_id == Generation.id
+    ).filter(
+        Generation.status == 'completed',
+        Generation.image_url.isnot(None),
+        Generation.source_generation_id.is_(None),
+        Generation.cache_excluded.is_(False),
+    )
+    exact = reusable.filter(UploadFingerprint.sha256 == sha256).order_by(Generation.created_at.desc()).first()
+    if exact is not None:
+        return exact[0], 'exact'
+    if not is_distinctive(phash) or FIGURINE_CACHE_MAX_DISTANCE < 0:
+        return None, None
+
+    # 至少有一段完全相同的指纹才可能在距离阈值内：按段走索引取候选，再逐个计算汉明距离
+    bands = phash_bands(phash)
+    candidates = reusable.filter(db.or_(
+        UploadFingerprint.phash_band0 == bands[0], UploadFingerprint.phash_band1 == bands[1],
+        UploadFingerprint.phash_band2 == bands[2], UploadFingerprint.phash_band3 == bands[3],
+    )).order_by(Generation.created_at.desc()).limit(FIGURINE_CACHE_MAX_CANDIDATES).all()
+    best, best_distance = None, FIGURINE_CACHE_MAX_DISTANCE + 1
+    for generation, other in candidates:
+        distance = hamming(phash, from_signed64(other))
+        if distance < best_distance:
+            best, best_distance = generation, distance
+    return (best, 'near') if best is not None else (None, None)
+
+
+MEME_SIZE_MAP = {
+    'vertical': {'width': 1024, 'height': 1920},
+    'horizontal': {'width': 1920, 'height': 1024},
+    'square': {'width': 1024, 'height': 1024}
+}
+
+
+def compose_prompt_text(gemini_data):
+    """精简响应模式下没有原始回答：用解析后的英文提示词、中文提示词和设计说明拼出要保存的 prompt_text"""
+    parts = [gemini_data.get('english_prompt'), gemini_data.get('chinese_prompt'), gemini_data.get('rationale')]
+    return '\n\n'.join(part for part in parts if part) or None
+
+
+def generate_meme_prompt(answer):
+    """
+    调用 Gemini 代理生成提示词，返回 (要保存的提示词文本, 中文提示词)。
+    保存的文本为原始回答；精简响应模式下没有原始回答时由解析后的字段拼成。
+    """
+    gemini_data = call_gemini_proxy(answer)
+    raw_prompt_text = gemini_data.get('prompt')
+    chinese_prompt = gemini_data.get('chinese_prompt')
+
+    if not chinese_prompt:
+        # 兼容只返回原始文本的旧版代理：在本地解析
+        if not raw_prompt_text:
+            raise ValueError("Gemini API proxy returned an empty response.")
+        try:
+            with tracer.span('prompt.parse'):
+                chinese_prompt = parse_prompt_response(raw_prompt_text)['zh_prompt']
+        except PromptParseError:
+            logging.error("Failed to parse Gemini response (%d chars).", len(raw_prompt_text))
+            logging.debug("Unparseable Gemini response: %s", raw_prompt_text)
+            raise ValueError("Gemini 响应格式不正确。")
+    return raw_prompt_text or compose_prompt_text(gemini_data), chinese_prompt
+
+
+# --- 即梦多版本图片 ---
+# 一次即梦请求生成同一提示词的多个版本：第一张作为结果返回，其余保存为 generation_variants，
+# 用户点击"换一个版本"时直接交付下一张，不再调用上游服务
+JIMENG_VARIANTS = int(os.getenv('JIMENG_VARIANTS', '4'))
+JIMENG_VARIANT_CREDITS = int(os.getenv('JIMENG_VARIANT_CREDITS', '1'))
+
+
+def store_generation_variants(generation_id, image_paths):
+    """登记生成记录的其余版本（不提交事务，由 complete_generation 一并提交）。"""
+    for variant_index, image_path in enumerate(image_paths, start=1):
+        image_key = os.path.basename(image_path)
+        register_image_asset(image_key, KIND_GENERATED, generation_id, image_path)
+        db.session.add(GenerationVariant(
+            generation_id=generation_id, variant_index=variant_index, image_url=f"{IMAGE_URL_PREFIX}{image_key}",
+        ))
+
+
+def publish_generation_variants(generation_id):
+    """使用对象存储时在后台上传生成记录的其余版本。"""
+    if image_uploader is None:
+        return
+    for variant in GenerationVariant.query.filter_by(generation_id=generation_id).all():
+        publish_generated_image(variant.id, os.path.join(IMAGES_PATH, image_key_from_url(variant.image_url)),
+                                model=GenerationVariant)
+
+
+def claim_next_variant(generation_id):
+    """按版本顺序原子地领取下一个未交付的版本（并发请求不会领到同一个），没有则返回 None。"""
+    variant = db.session.execute(
+        select(GenerationVariant)
+        .where(GenerationVariant.generation_id == generation_id, GenerationVariant.claimed_at.is_(None),
+               GenerationVariant.image_url.isnot(None))
+        .order_by(GenerationVariant.variant_index)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).scalar_one_or_none()
+    if variant is not None:
+        variant.claimed_at = datetime.now(timezone.utc)
+    return variant
+
+
+def with_variant_headers(response, generation_id, parent_id=None):
+    """在图片响应上附加生成记录 ID 和剩余可交付的版本数，供前端展示"换一个版本"。"""
+    remaining = GenerationVariant.query.filter(
+        GenerationVariant.generation_id == (parent_id or generation_id),
+        GenerationVariant.claimed_at.is_(None),
+        GenerationVariant.image_url.isnot(None),
+    ).count()
+    response = app.make_response(response)
+    response.headers['X-Generation-Id'] = str(generation_id)
+    response.headers['X-Variants-Remaining'] = str(remaining)
+    return response
+
+
+# --- 热门谜底预生成池 ---
+# 低峰期按最近的请求热度为热门谜底预先生成图片；高峰期命中时直接交付，不再调用上游服务
+PREGEN_LOOKBACK_DAYS = int(os.getenv('PREGEN_LOOKBACK_DAYS', '7'))
+PREGEN_MIN_REQUESTS = int(os.getenv('PREGEN_MIN_REQUESTS', '3'))
+PREGEN_POOL_DEPTH = int(os.getenv('PREGEN_POOL_DEPTH', '2'))
+PREGEN_MAX_PER_RUN = int(os.getenv('PREGEN_MAX_PER_RUN', '20'))
+PREGEN_DAILY_BUDGET = int(os.getenv('PREGEN_DAILY_BUDGET', '200'))
+PREGEN_TTL_DAYS = int(os.getenv('PREGEN_TTL_DAYS', '14'))
+# 低峰时段（本地时间的小时区间，含起点不含终点），例如 "1-7"
+PREGEN_OFFPEAK_HOURS = os.getenv('PREGEN_OFFPEAK_HOURS', '1-7')
+
+
+def claim_pregenerated_item(answer_key, size):
+    """原子地领取一个可用的预生成结果（并发请求不会领到同一个），没有则返回 None。"""
+    item = db.session.execute(
+        select(PregeneratedItem)
+        .where(PregeneratedItem.answer_key == answer_key, PregeneratedItem.size == size,
+               PregeneratedItem.claimed_at.is_(None))
+        .order_by(PregeneratedItem.created_at)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    ).scalar_one_or_none()
+    if item is None:
+        db.session.rollback()
+        return None
+    item.claimed_at = datetime.now(timezone.utc)
+    db.session.commit()
+    return item
+
+
+def release_pregenerated_item(item_id):
+    """领取后未能交付（例如幂等键冲突）时归还到池中。"""
+    db.session.execute(update(PregeneratedItem).where(PregeneratedItem.id == item_id).values(claimed_at=None))
+    db.session.commit()
+
+
+def is_offpeak(now=None):
+    start, end = (int(h) for h in PREGEN_OFFPEAK_HOURS.split('-'))
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+
+def fill_pregeneration_pool(max_items):
+    """
+    挖掘最近的热门谜底并补充预生成池，受单次上限和每日预算约束。
+    返回本轮生成的数量。
+    """
+    now = datetime.now(timezone.utc)
+    # 清理过期未领取的结果
+    for item in PregeneratedItem.query.filter(
+        PregeneratedItem.claimed_at.is_(None),
+        PregeneratedItem.created_at < now - timedelta(days=PREGEN_TTL_DAYS),
+    ).all():
+        image_path = os.path.join(IMAGES_PATH, item.image_key)
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        db.session.delete(item)
+    db.session.commit()
+
+    used_today = PregeneratedItem.query.filter(
+        PregeneratedItem.created_at >= now.replace(hour=0, minute=0, second=0, microsecond=0)
+    ).count()
+    budget = min(max_items, PREGEN_DAILY_BUDGET - used_today)
+    if budget <= 0:
+        logging.info("Pre-generation budget exhausted (%s/%s today).", used_today, PREGEN_DAILY_BUDGET)
+        return 0
+
+    request_count = func.count(Generation.id).label('request_count')
+    trending = db.session.query(
+        Generation.answer_key, Generation.size, func.max(Generation.riddle_answer), request_count
+    ).filter(
+        Generation.answer_key.isnot(None),
+        Generation.created_at >= now - timedelta(days=PREGEN_LOOKBACK_DAYS),
+    ).group_by(Generation.answer_key, Generation.size).having(
+        request_count >= PREGEN_MIN_REQUESTS
+    ).order_by(request_count.desc()).limit(PREGEN_MAX_PER_RUN * 5).all()
+
+    available = dict(
+        ((answer_key, size), count) for answer_key, size, count in db.session.query(
+            PregeneratedItem.answer_key, PregeneratedItem.size, func.count(PregeneratedItem.id)
+        ).filter(PregeneratedItem.claimed_at.is_(None)).group_by(PregeneratedItem.answer_key, PregeneratedItem.size)
+    )
+    db.session.remove()
+
+    generated = 0
+    for answer_key, size, riddle_answer, count in trending:
+        missing = PREGEN_POOL_DEPTH - available.get((answer_key, size), 0)
+        for _ in range(missing):
+            if generated >= budget:
+                return generated
+            ctx = GenerationContext('pregen', user_id=0, priority=PRIORITY_BACKGROUND,
+                                    inputs={'answer': riddle_answer, 'answer_key': answer_key, 'size': size})
+            try:
+                pregen_pipeline.run(ctx)
+            except Exception as e:
+                logging.error("Pre-generation failed for answer %s at stage %s: %s", answer_digest(answer_key),
+                              ctx.failed_stage, e, exc_info=True)
+                db.session.rollback()
+                for image_path in ctx.temp_paths:
+                    if os.path.exists(image_path):
+                        os.remove(image_path)
+                break
+            generated += 1
+            logging.info("Pre-generated image for trending answer %s (%s, %s recent requests).",
+                         answer_digest(answer_key), size, count)
+            logging.debug("Pre-generated answer %s: %s", answer_digest(answer_key), riddle_answer)
+    return generated
+
+
+# --- 幂等键 ---
+# 移动端在网络超时后会重试生成请求；携带相同 Idempotency-Key 的重试会复用已有的生成任务，
+# 进行中的任务等待其完成，已完成的任务直接返回存储的结果，不再调用任何上游服务。
+IDEMPOTENCY_KEY_MAX_LENGTH = 128
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv('IDEMPOTENCY_TTL_HOURS', '24')))
+IDEMPOTENCY_WAIT_SECONDS = int(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '90'))
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv('IDEMPOTENCY_POLL_INTERVAL', '1.0'))
+
+
+def request_fingerprint(*parts):
+    """计算请求内容的指纹，用于识别复用同一个幂等键却提交了不同内容的请求。"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def replay_idempotent_request(user_id, key, endpoint, fingerprint):
+    """
+    查找幂等键对应的历史请求并返回其结果。
+    返回 None 表示没有可复用的结果（新键、已过期或上一次生成失败），调用方应正常执行生成流程。
+    """
+    expired = IdempotencyKey.query.filter(
+        IdempotencyKey.user_id == user_id,
+        IdempotencyKey.key == key,
+        IdempotencyKey.created_at < datetime.now(timezone.utc) - IDEMPOTENCY_TTL,
+    ).delete(synchronize_session=False)
+    if expired:
+        logging.info("Idempotency key %s for user %s has expired, starting a new request.", key, user_id)
+        db.session.commit()
+        return None
+
+    record = IdempotencyKey.query.filter_by(user_id=user_id, key=key).first()
+    if record is None:
+        return None
+
+    if record.endpoint != endpoint or record.request_hash != fingerprint:
+        logging.warning("Idempotency key %s for user %s was reused with a different request.", key, user_id)
+        return jsonify({"message": "Idempotency-Key 已被用于另一个不同的请求。"}), 422
+
+    generation_id = record.generation_id
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        generation = db.session.get(Generation, generation_id)
+        if generation.status == 'completed':
+            logging.info("Replaying completed generation %s for idempotency key %s.", generation_id, key)
+            response = app.make_response(serve_image(generation.image_url))
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        if generation.status == 'failed':
+            # 失败的生成没有扣除额度，释放该键，让这次重试真正重新执行
+            logging.info("Generation %s for idempotency key %s failed, allowing a fresh attempt.", generation_id, key)
+            db.session.delete(record)
+            db.session.commit()
+            return None
+        if time.monotonic() >= deadline:
+            logging.info("Generation %s for idempotency key %s is still in progress.", generation_id, key)
+            response = jsonify({"message": "该请求仍在处理中，请稍后使用相同的 Idempotency-Key 重试。"})
+            response.headers['Retry-After'] = str(int(IDEMPOTENCY_POLL_INTERVAL * 5) or 1)
+            return response, 409
+        # 结束当前事务并归还连接，避免在等待进行中的任务时占用连接池
+        db.session.rollback()
+        time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+def create_pending_generation(user_id, riddle_answer, endpoint, idempotency_key=None, fingerprint=None,
+                              answer_key=None, size=None):
+    """
+    创建 pending 状态的生成记录，并在同一事务中登记幂等键。
+    返回 (generation_id, replay_response)：并发的重复请求抢先登记了同一个键时，generation_id 为 None，
+    replay_response 为复用的结果。
+    """
+    new_generation = Generation(user_id=user_id, riddle_answer=riddle_answer, status='pending',
+                                answer_key=answer_key, size=size)
+    db.session.add(new_generation)
+    db.session.flush()
+    generation_id = new_generation.id
+    if idempotency_key:
+        db.session.add(IdempotencyKey(user_id=user_id, key=idempotency_key, endpoint=endpoint,
+                                      request_hash=fingerprint, generation_id=generation_id))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        logging.info("Idempotency key %s was claimed concurrently, attaching to the existing job.", idempotency_key)
+        replay = replay_idempotent_request(user_id, idempotency_key, endpoint, fingerprint)
+        if replay is None:
+            replay = jsonify({"message": "该请求仍在处理中，请稍后重试。"}), 409
+        return None, replay
+    bump_user_version(user_id)
+    return generation_id, None
+
+
+class InsufficientCredits(Exception):
+    """扣除额度时余额不足（额度已被同一用户的并发请求用完）"""
+
+
+def deduct_credits(user_id, credits):
+    """
+    在当前事务中原子地扣除额度，余额不足时不扣除。
+    返回扣除后的剩余额度；余额不足时回滚当前事务并抛出 InsufficientCredits。
+    """
+    remaining_credits = db.session.execute(
+        update(User)
+        .where(User.id == user_id, User.generation_credits >= credits)
+        .values(generation_credits=User.generation_credits - credits)
+        .returning(User.generation_credits)
+    ).scalar()
+    if remaining_credits is None:
+        db.session.rollback()
+        raise InsufficientCredits()
+    return remaining_credits
+
+
+def insufficient_credits_response():
+    return jsonify({"message": "You have no credits left."}), 402
+
+
+def complete_generation(generation_id, user_id, prompt_text, image_path):
+    """
+    在一个独立的短事务中把生成记录标记为完成、登记图片文件，并原子地扣除一次额度。
+    返回扣除后的剩余额度；额度不足时整个事务回滚并抛出 InsufficientCredits。
+    """
+    image_key = os.path.basename(image_path)
+    image_url = f"{IMAGE_URL_PREFIX}{image_key}"
+    register_image_asset(image_key, KIND_GENERATED, generation_id, image_path)
+    db.session.execute(
+        update(Generation)
+        .where(Generation.id == generation_id)
+        .values(prompt_text=prompt_text, image_url=image_url, status='completed',
+                checkpoint_stage=None, checkpoint=None, updated_at=datetime.now(timezone.utc))
+    )
+    remaining_credits = deduct_credits(user_id, 1)
+    db.session.commit()
+    bump_user_version(user_id)
+    return remaining_credits
+
+
+def fail_generation(generation_id, *image_paths):
+    """
+    在一个独立的短事务中把生成记录标记为失败；已写入磁盘、又没有保存进检查点的图片不再被引用，直接删除。
+    检查点保留，同一用户的重试从最后完成的阶段继续。
+    """
+    db.session.rollback()
+    for image_path in image_paths:
+        if image_path and os.path.exists(image_path):
+            os.remove(image_path)
+    user_id = db.session.execute(
+        update(Generation).where(Generation.id == generation_id)
+        .values(status='failed', updated_at=datetime.now(timezone.utc)).returning(Generation.user_id)
+    ).scalar()
+    db.session.commit()
+    bump_user_version(user_id)
+
+
+def get_idempotency_key():
+    """读取并校验 Idempotency-Key 请求头，返回 (key, error_response)。"""
+    key = request.headers.get('Idempotency-Key', '').strip()
+    if len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        return None, (jsonify({"message": "Idempotency-Key 过长。"}), 400)
+    return key or None, None
+
+
+# --- 上游配额准入控制 ---
+# 每个用户一个令牌桶；Gemini 代理与即梦各自一个全局并发预算，超出的请求按优先级公平排队
+user_rate_limiter = UserRateLimiter(
+    rate_per_minute=float(os.getenv('ADMISSION_USER_RATE_PER_MINUTE', '6')),
+    burst=int(os.getenv('ADMISSION_USER_BURST', '3')),
+)
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '50'))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv('ADMISSION_MAX_WAIT_SECONDS', '30'))
+ADMISSION_MAX_QUEUED_PER_USER = int(os.getenv('ADMISSION_MAX_QUEUED_PER_USER', '2'))
+gemini_budget = UpstreamBudget('gemini', int(os.getenv('GEMINI_MAX_CONCURRENCY', '8')),
+                               ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS, ADMISSION_MAX_QUEUED_PER_USER)
+jimeng_budget = UpstreamBudget('jimeng', int(os.getenv('JIMENG_MAX_CONCURRENCY', '4')),
+                               ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT_SECONDS, ADMISSION_MAX_QUEUED_PER_USER)
+# 额度高于注册赠送额度的用户（购买或获赠过额度）优先
+ADMISSION_HIGH_PRIORITY_CREDITS = int(os.getenv('ADMISSION_HIGH_PRIORITY_CREDITS', '10'))
+# 在此时间窗口内失败过的同一谜底视为免费重试，排在普通请求之后
+ADMISSION_RETRY_WINDOW = timedelta(minutes=int(os.getenv('ADMISSION_RETRY_WINDOW_MINUTES', '10')))
+
+
+def admission_priority(user, riddle_answer):
+    """根据用户额度和最近的失败记录确定排队优先级。"""
+    if user.generation_credits > ADMISSION_HIGH_PRIORITY_CREDITS:
+        return PRIORITY_HIGH
+    recent_failure = Generation.query.filter(
+        Generation.user_id == user.id,
+        Generation.riddle_answer == riddle_answer,
+        Generation.status == 'failed',
+        Generation.created_at >= datetime.now(timezone.utc) - ADMISSION_RETRY_WINDOW,
+    ).first()
+    return PRIORITY_RETRY if recent_failure else PRIORITY_NORMAL
+
+
+def admission_rejected_response(rejection):
+    """构造 429 响应，附带 Retry-After 和排队位置提示。"""
+    body = {"message": "当前生成请求较多，请稍后再试。", "reason": rejection.reason, "retry_after": rejection.retry_after}
+    if rejection.queue_position is not None:
+        body["queue_position"] = rejection.queue_position
+    response = jsonify(body)
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response, 429
+
+
+# --- 生成流水线 ---
+# 每种生成是一条按顺序执行的阶段流水线（prompt → image → store → finalize），各阶段的并发预算、超时和重试
+# 在这里声明（可用 PIPELINE_<流水线>_<阶段>_* 环境变量覆盖）；失败处理、状态回滚和统计由 run_generation 统一完成
+FIGURINE_PROMPT = (
+    "First ask me to upload an image and then create a 1/7 scale commercialized figurine of the characters in the picture, "
+    "in a realistic style, in a real environment. The figurine is placed on a computer desk. "
+    "The figurine has a round transparent acrylic base, with no text on the base. "
+    "The content on the computer screen is a 3D modeling process of this figurine. "
+    "Next to the computer screen is a toy packaging box, designed in a style reminiscent of high-quality collectible figures, "
+    "printed with original artwork. The packaging features two-dimensional flat illustrations."
+)
+# 只重试确定没有到达上游的失败（连接失败），避免重复计费
+UPSTREAM_RETRYABLE = (requests.exceptions.ConnectionError,)
+
+
+def meme_prompt_stage(ctx):
+    """调用部署在新加坡的 Gemini API 代理生成提示词。"""
+    logging.info("Calling remote Gemini API proxy for generation %s.", ctx.generation_id)
+    raw_prompt_text, chinese_prompt = generate_meme_prompt(ctx.inputs['answer'])
+    ctx.outputs.update(raw_prompt_text=raw_prompt_text, prompt=chinese_prompt)
+
+
+def figurine_prompt_stage(ctx):
+    ctx.outputs['prompt'] = FIGURINE_PROMPT
+
+
+def meme_image_stage(ctx):
+    """一次即梦请求生成多个版本，第一张为结果，其余留给"换一个版本"。"""
+    dimensions = MEME_SIZE_MAP.get(ctx.inputs.get('size'), MEME_SIZE_MAP['vertical'])
+    if JIMENG_ASYNC_ENABLED:
+        jimeng_task_stage(ctx, dimensions, JIMENG_VARIANTS)
+        return
+    image_paths = jimeng_generate_variants(ctx.outputs['prompt'], dimensions['width'], dimensions['height'],
+                                           JIMENG_VARIANTS)
+    if not image_paths:
+        raise Exception("图片生成失败。")
+    ctx.temp_paths.extend(image_paths)
+    ctx.outputs['image_keys'] = [os.path.basename(image_path) for image_path in image_paths]
+    logging.info("Image saved at: %s, %d extra variants.", image_paths[0], len(image_paths) - 1)
+
+
+def single_image_stage(ctx):
+    """生成单张图片（尺寸取 image_size，其次 size）。"""
+    dimensions = MEME_SIZE_MAP.get(ctx.inputs.get('image_size', ctx.inputs.get('size')), MEME_SIZE_MAP['vertical'])
+    if JIMENG_ASYNC_ENABLED:
+        jimeng_task_stage(ctx, dimensions, 1)
+        return
+    image_path = jimeng_generate_api(ctx.outputs['prompt'], dimensions['width'], dimensions['height'])
+    if not image_path:
+        raise Exception("图片生成服务未能返回结果。")
+    ctx.temp_paths.append(image_path)
+    ctx.outputs['image_keys'] = [os.path.basename(image_path)]
+    logging.info("Image saved at: %s", image_path)
+
+
+def generation_store_stage(ctx):
+    """登记图片和其余版本，把生成记录标记为完成并扣除额度。"""
+    image_paths = [os.path.join(IMAGES_PATH, image_key) for image_key in ctx.outputs['image_keys']]
+    image_path, variant_paths = image_paths[0], image_paths[1:]
+    store_generation_variants(ctx.generation_id, variant_paths)
+    prompt_text = ctx.outputs.get('raw_prompt_text') or ctx.outputs['prompt']
+    ctx.outputs['remaining_credits'] = complete_generation(ctx.generation_id, ctx.user_id, prompt_text, image_path)
+    ctx.committed = True
+
+
+def pregenerated_store_stage(ctx):
+    """把预生成的图片放入预生成池。"""
+    db.session.add(PregeneratedItem(
+        answer_key=ctx.inputs['answer_key'], riddle_answer=ctx.inputs['answer'], size=ctx.inputs['size'],
+        prompt_text=ctx.outputs.get('raw_prompt_text') or ctx.outputs['prompt'], image_key=ctx.outputs['image_keys'][0],
+    ))
+    db.session.commit()
+
+
+def generation_finalize_stage(ctx):
+    """构造图片响应，并在后台把结果上传到对象存储。"""
+    image_path = os.path.join(IMAGES_PATH, ctx.outputs['image_keys'][0])
+    ctx.response = with_variant_headers(send_file(image_path, mimetype='image/png'), ctx.generation_id)
+    publish_generated_image(ctx.generation_id, image_path)
+    publish_generation_variants(ctx.generation_id)
+
+
+# --- 即梦异步任务 ---
+# JIMENG_ASYNC_ENABLED 时图片阶段改用提交任务 + 查询结果（默认关闭，上线步骤见 README）：
+# 提交后立即把 task_id 写入检查点，所有进行中的任务由一个轮询器统一查询，等待期间不占用与即梦之间的连接。
+# 任务完成的回调在轮询线程中归还即梦并发槽位、把图片写入持有该任务的生成记录的检查点；
+# 请求已超时或进程重启后的重试直接接管结果，不会重新提交
+JIMENG_ASYNC_ENABLED = os.getenv('JIMENG_ASYNC_ENABLED', 'false').lower() == 'true'
+# 请求最多等待任务完成的时间（秒）；超时后任务继续在后台完成，结果留给重试
+JIMENG_TASK_WAIT_SECONDS = float(os.getenv('JIMENG_TASK_WAIT_SECONDS', '300'))
+# 本进程提交、尚未完成的任务 -> 占用即梦并发槽位的起始时间
+_jimeng_task_slots = {}
+
+
+def fetch_jimeng_task(task_id):
+    result = jimeng_get_task_result(task_id)
+    if result['status'] == 'done':
+        return TASK_DONE, result['image_paths']
+    if result['status'] == 'failed':
+        return TASK_FAILED, result['message']
+    return TASK_PENDING, None
+
+
+jimeng_poller = create_task_poller_from_env('jimeng', fetch_jimeng_task)
+
+
+def finish_jimeng_task(task_id, image_paths, error):
+    """
+    即梦任务结束的回调（轮询线程，先于等待方执行）：
+    成功时把图片写入持有该任务的生成记录的检查点（检查点停在 image_task，包括请求超时后已标记为失败的）；
+    失败时从检查点中移除该任务，重试会重新提交。任务已不属于任何生成记录时删除下载的图片。
+    """
+    hold_started = _jimeng_task_slots.pop(task_id, None)
+    if hold_started is not None:
+        jimeng_budget.release(time.monotonic() - hold_started)
+    with app.app_context():
+        owner = db.session.execute(
+            select(Generation.id, Generation.checkpoint)
+            .where(Generation.upstream_task_id == task_id, Generation.checkpoint_stage == 'image_task',
+                   Generation.status != 'completed')
+            .order_by(Generation.id.desc())
+            .limit(1)
+        ).one_or_none()
+        if owner is None:
+            if error is None and db.session.execute(
+                select(Generation.id).where(Generation.upstream_task_id == task_id).limit(1)
+            ).first() is not None:
+                for image_path in image_paths:
+                    os.remove(image_path)
+            return image_paths
+        state = json.loads(owner.checkpoint)
+        if error is None:
+            state['completed'].append('image')
+            state['outputs']['image_keys'] = [os.path.basename(image_path) for image_path in image_paths]
+            values = {'checkpoint_stage': 'image', 'checkpoint': json.dumps(state, ensure_ascii=False)}
+        else:
+            state['outputs'].pop('image_task_id', None)
+            values = {'checkpoint_stage': state['completed'][-1] if state['completed'] else None,
+                      'checkpoint': json.dumps(state, ensure_ascii=False) if state['completed'] else None,
+                      'upstream_task_id': None}
+        db.session.execute(
+            update(Generation)
+            .where(Generation.id == owner.id, Generation.checkpoint_stage == 'image_task')
+            .values(updated_at=datetime.now(timezone.utc), **values)
+        )
+        db.session.commit()
+    return image_paths
+
+
+def jimeng_task_stage(ctx, dimensions, count):
+    """
+    异步模式的图片阶段：提交任务（已有 task_id 时直接接着等待），交给轮询器跟踪，等待完成回调写入的检查点。
+    即梦并发槽位从提交起占用到任务结束，与同步模式一样限制同时进行的渲染数。
+    """
+    task_id = ctx.outputs.get('image_task_id')
+    if task_id is None:
+        with tracer.span('admission.jimeng', priority=ctx.priority):
+            jimeng_budget.acquire(ctx.user_id, ctx.priority)
+        try:
+            task_id = jimeng_submit_task(ctx.outputs['prompt'], dimensions['width'], dimensions['height'], count)
+        except Exception:
+            jimeng_budget.release()
+            raise
+        if not task_id:
+            jimeng_budget.release()
+            raise Exception("图片生成任务提交失败。")
+        _jimeng_task_slots[task_id] = time.monotonic()
+        ctx.outputs['image_task_id'] = task_id
+        save_checkpoint(ctx, 'image_task')
+    else:
+        logging.info("Generation %s resumes Jimeng task %s.", ctx.generation_id, task_id)
+    image_paths = jimeng_poller.watch(task_id, on_done=finish_jimeng_task).result(timeout=JIMENG_TASK_WAIT_SECONDS)
+    if ctx.generation_id is None:
+        ctx.temp_paths.extend(image_paths)
+        ctx.outputs['image_keys'] = [os.path.basename(image_path) for image_path in image_paths]
+        return
+    checkpoint_stage, checkpoint = db.session.execute(
+        select(Generation.checkpoint_stage, Generation.checkpoint).where(Generation.id == ctx.generation_id)
+    ).one()
+    db.session.rollback()
+    if checkpoint_stage != 'image':
+        raise Exception("图片生成结果未能保存。")
+    ctx.outputs['image_keys'] = json.loads(checkpoint)['outputs']['image_keys']
+    logging.info("Jimeng task %s finished with %d images.", task_id, len(ctx.outputs['image_keys']))
+
+
+def record_stage_latency(ctx, stage, elapsed_ms):
+    rollups.record_latency(ctx.endpoint, stage, elapsed_ms)
+
+
+# --- 阶段检查点 ---
+# 每个上游阶段完成后把产出（提示词、图片文件名）写入生成记录；失败时保留检查点，同一用户在
+# GENERATION_CHECKPOINT_TTL_HOURS 内重试同一谜底（或同一张上传图片）时接管该检查点，只执行未完成的阶段。
+# 额度只在 complete_generation 中与完成状态一起扣除，失败或中断的生成不占用额度，无需退还
+GENERATION_CHECKPOINT_TTL = timedelta(hours=int(os.getenv('GENERATION_CHECKPOINT_TTL_HOURS', '24')))
+# pending 状态超过该时间没有任何进展（进程崩溃或被强制结束）视为中断
+GENERATION_STALE_AFTER = timedelta(minutes=int(os.getenv('GENERATION_STALE_MINUTES', '30')))
+
+
+def save_checkpoint(ctx, stage=None):
+    """
+    在一个独立的短事务中保存检查点；保存后已生成的图片归检查点所有，失败时不再删除。
+    stage 为阶段内部的检查点名称（如已提交任务的 image_task），默认为最后完成的阶段。
+    """
+    if ctx.generation_id is None:
+        return
+    db.session.execute(
+        update(Generation)
+        .where(Generation.id == ctx.generation_id, Generation.status == 'pending')
+        .values(checkpoint_stage=stage or ctx.completed[-1], upstream_task_id=ctx.outputs.get('image_task_id'),
+                checkpoint=json.dumps({'completed': ctx.completed, 'outputs': ctx.outputs}, ensure_ascii=False),
+                updated_at=datetime.now(timezone.utc))
+    )
+    db.session.commit()
+    ctx.temp_paths.clear()
+
+
+def find_resumable_generation(user_id, *criteria):
+    """查找该用户最近一次留有检查点、仍在有效期内的失败生成，返回其 ID 或 None。"""
+    return db.session.execute(
+        select(Generation.id)
+        .where(Generation.user_id == user_id, Generation.status == 'failed', Generation.checkpoint_stage.isnot(None),
+               Generation.updated_at >= datetime.now(timezone.utc) - GENERATION_CHECKPOINT_TTL, *criteria)
+        .order_by(Generation.id.desc())
+        .limit(1)
+    ).scalar()
+
+
+def resume_from_checkpoint(ctx, source_id):
+    """
+    把失败生成的检查点移交给新的生成记录并恢复到上下文中。带条件的 UPDATE 保证并发的重试只有一个接管成功。
+    返回是否接管成功。
+    """
+    checkpoint_stage, checkpoint = db.session.execute(
+        select(Generation.checkpoint_stage, Generation.checkpoint).where(Generation.id == source_id)
+    ).one()
+    claimed = db.session.execute(
+        update(Generation)
+        .where(Generation.id == source_id, Generation.checkpoint_stage.isnot(None))
+        .values(checkpoint_stage=None, checkpoint=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+    if not claimed or checkpoint is None:
+        db.session.rollback()
+        return False
+    state = json.loads(checkpoint)
+    db.session.execute(
+        update(Generation).where(Generation.id == ctx.generation_id)
+        .values(checkpoint_stage=checkpoint_stage, checkpoint=checkpoint,
+                upstream_task_id=state['outputs'].get('image_task_id'), updated_at=datetime.now(timezone.utc))
+    )
+    db.session.commit()
+    ctx.completed = state['completed']
+    ctx.outputs.update(state['outputs'])
+    logging.info("Generation %s resumes from stage '%s' of failed generation %s.",
+                 ctx.generation_id, checkpoint_stage, source_id)
+    return True
+
+
+def recover_generations(batch_size=500):
+    """
+    回收中断和过期的生成（建议通过 cron 定期执行）：
+    1. 超过 GENERATION_STALE_MINUTES 没有进展的 pending 生成标记为失败，检查点保留给用户重试；
+       等待中的幂等重试随之得到"失败"结果并重新执行
+    2. 超过 GENERATION_CHECKPOINT_TTL_HOURS 未被接管的检查点连同其图片文件一并删除
+    返回 {"stale": 数量, "expired_checkpoints": 数量}
+    """
+    now = datetime.now(timezone.utc)
+    stale_users = db.session.execute(
+        update(Generation)
+        .where(Generation.id.in_(
+            select(Generation.id)
+            .where(Generation.status == 'pending', func.coalesce(Generation.updated_at, Generation.created_at)
+                   < now - GENERATION_STALE_AFTER)
+            .limit(batch_size)
+        ))
+        .values(status='failed', updated_at=now)
+        .returning(Generation.user_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    db.session.commit()
+    if stale_users:
+        bump_user_version(*set(stale_users))
+
+    expired = db.session.execute(
+        select(Generation.id, Generation.checkpoint)
+        .where(Generation.status == 'failed', Generation.checkpoint_stage.isnot(None),
+               Generation.updated_at < now - GENERATION_CHECKPOINT_TTL)
+        .limit(batch_size)
+    ).all()
+    for generation_id, checkpoint in expired:
+        claimed = db.session.execute(
+            update(Generation)
+            .where(Generation.id == generation_id, Generation.checkpoint_stage.isnot(None))
+            .values(checkpoint_stage=None, checkpoint=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount == 1
+        db.session.commit()
+        if not claimed:
+            continue
+        for image_key in json.loads(checkpoint or '{}').get('outputs', {}).get('image_keys', []):
+            image_path = os.path.join(IMAGES_PATH, image_key)
+            if os.path.exists(image_path):
+                os.remove(image_path)
+    return {'stale': len(stale_users), 'expired_checkpoints': len(expired)}
+
+
+# 异步模式下由 jimeng_task_stage 自己占用即梦并发槽位，直到任务结束才归还
+JIMENG_STAGE_BUDGET = None if JIMENG_ASYNC_ENABLED else jimeng_budget
+meme_pipeline = Pipeline('meme', [
+    Stage.from_env('meme', 'prompt', meme_prompt_stage, budget=gemini_budget, retry_on=UPSTREAM_RETRYABLE),
+    Stage.from_env('meme', 'image', meme_image_stage, budget=JIMENG_STAGE_BUDGET, retry_on=UPSTREAM_RETRYABLE),
+    Stage.from_env('meme', 'store', generation_store_stage, checkpoint=False),
+    Stage.from_env('meme', 'finalize', generation_finalize_stage, checkpoint=False),
+], on_stage_done=record_stage_latency, on_checkpoint=save_checkpoint)
+figurine_pipeline = Pipeline('figurine', [
+    Stage.from_env('figurine', 'prompt', figurine_prompt_stage, checkpoint=False),
+    Stage.from_env('figurine', 'image', single_image_stage, budget=JIMENG_STAGE_BUDGET, retry_on=UPSTREAM_RETRYABLE),
+    Stage.from_env('figurine', 'store', generation_store_stage, checkpoint=False),
+    Stage.from_env('figurine', 'finalize', generation_finalize_stage, checkpoint=False),
+], on_stage_done=record_stage_latency, on_checkpoint=save_checkpoint)
+pregen_pipeline = Pipeline('pregen', [
+    Stage.from_env('pregen', 'prompt', meme_prompt_stage, budget=gemini_budget, retry_on=UPSTREAM_RETRYABLE),
+    Stage.from_env('pregen', 'image', single_image_stage, budget=JIMENG_STAGE_BUDGET, retry_on=UPSTREAM_RETRYABLE),
+    Stage.from_env('pregen', 'store', pregenerated_store_stage, checkpoint=False),
+], on_stage_done=record_stage_latency, on_checkpoint=save_checkpoint)
+
+MEME_ERROR_MESSAGES = [
+    (ValueError, "内容生成或解析失败，请尝试其他词语。"),
+    (requests.exceptions.RequestException, "无法连接到海外服务，请稍后再试。"),
+    (Exception, "哎呀，出了点小问题，请稍后再试。"),
+]
+FIGURINE_ERROR_MESSAGES = [
+    (Exception, "生成手办时发生未知错误，请稍后再试。"),
+]
+
+
+def committed_generation_response(ctx, error):
+    """
+    结果已提交（记录已完成、额度已扣除）之后的阶段失败（如构造响应、发布到对象存储）：
+    不调用 fail_generation，记录保持完成状态、图片保留；尽量照常返回图片，
+    图片也无法返回时提示用户到历史记录中查看（携带同一幂等键的重试会直接返回该结果）。
+    """
+    logging.error("Generation %s completed but stage %s failed: %s", ctx.generation_id, ctx.failed_stage, error,
+                  exc_info=True)
+    if ctx.response is not None:
+        return ctx.response
+    try:
+        return send_file(os.path.join(IMAGES_PATH, ctx.outputs['image_keys'][0]), mimetype='image/png')
+    except Exception as e:
+        logging.error("Generation %s image could not be sent: %s", ctx.generation_id, e)
+        return jsonify({"message": "图片已生成，请在历史记录中查看。", "generation_id": ctx.generation_id}), 500
+
+
+def run_generation(pipeline, ctx, error_messages):
+    """
+    执行生成流水线并返回响应：任一阶段失败时把生成记录标记为失败、删除已写入的图片，
+    按 error_messages 中第一个匹配的异常类型返回通用错误信息（不暴露内部细节）；准入控制拒绝时返回 429，
+    完成时额度已被并发请求用完则返回 402（检查点保留，补充额度后重试从最后完成的阶段继续）。
+    结果提交之后的阶段失败见 committed_generation_response，记录保持完成状态。
+    """
+    outcome = 'failed'
+    try:
+        pipeline.run(ctx)
+        outcome = 'completed'
+        rollups.record_latency(ctx.endpoint, 'total', (time.perf_counter() - ctx.started) * 1000)
+        logging.info("Generation %s completed. Remaining credits for user %s: %s",
+                     ctx.generation_id, ctx.user_id, ctx.outputs.get('remaining_credits'))
+        return ctx.response
+    except AdmissionRejected as ar:
+        logging.warning("Generation %s rejected by admission control at stage %s (%s), queue position: %s",
+                        ctx.generation_id, ctx.failed_stage, ar.reason, ar.queue_position)
+        outcome = 'rejected'
+        fail_generation(ctx.generation_id, *ctx.temp_paths)
+        return admission_rejected_response(ar)
+    except InsufficientCredits:
+        logging.warning("Generation %s failed: user %s ran out of credits.", ctx.generation_id, ctx.user_id)
+        fail_generation(ctx.generation_id, *ctx.temp_paths)
+        return insufficient_credits_response()
+    except Exception as e:
+        if ctx.committed:
+            outcome = 'completed'
+            return committed_generation_response(ctx, e)
+        logging.error("Generation %s failed at stage %s: %s", ctx.generation_id, ctx.failed_stage, e, exc_info=True)
+        fail_generation(ctx.generation_id, *ctx.temp_paths)
+        message = next(message for error_type, message in error_messages if isinstance(e, error_type))
+        return jsonify({"message": message}), 500
+    finally:
+        rollups.record_generation(ctx.endpoint, 'upstream', outcome, ctx.inputs.get('size'), ctx.inputs.get('answer_key'))
 
 
 @app.errorhandler(Exception)
@@ -109,7 +1542,7 @@ def handle_unexpected_error(e):
     """
     统一处理所有未预料的异常，返回通用错误信息。
     """
-    logging.error(f"An unhandled exception occurred: {e}", exc_info=True)
+    logging.error("An unhandled exception occurred: %s", e, exc_info=True)
     # 对于 HTTP 异常，可以返回其自身的信息
     if isinstance(e, HTTPException):
         return jsonify({"message": e.description}), e.code
@@ -120,15 +1553,30 @@ def handle_unexpected_error(e):
 
 
 @app.route('/api/history', methods=['GET'])
+@conditional_user_get('history')
 @login_required
 def get_history():
     """
-    获取当前用户的所有历史生成记录
+    获取当前用户的历史生成记录；可选分页参数 page（从 1 开始）和 page_size，不传时返回全部记录
     """
-    logging.info(f"API route /api/history called for user: {current_user.email}")
-    
-    # 查询当前用户的所有生成记录，按创建时间降序排列
-    user_generations = Generation.query.filter_by(user_id=current_user.id).order_by(Generation.created_at.desc()).all()
+    logging.info("API route /api/history called for user %s", current_user.id, extra=SAMPLE_POLL)
+    page = request.args.get('page', type=int)
+    page_size = min(request.args.get('page_size', 20, type=int), HISTORY_MAX_PAGE_SIZE)
+    if page is not None and (page < 1 or page_size < 1):
+        return jsonify({"message": "Invalid pagination parameters."}), 400
+
+    # 同一版本号下的序列化结果直接复用
+    token = g.get('user_version') or user_versions.token(current_user.id)
+    cache_key = (current_user.id, page, page_size if page is not None else None)
+    body = history_page_cache.get(cache_key, token)
+    if body is not None:
+        return app.response_class(body, mimetype='application/json')
+
+    # 查询当前用户的生成记录，按创建时间降序排列
+    query = Generation.query.filter_by(user_id=current_user.id).order_by(Generation.created_at.desc())
+    if page is not None:
+        query = query.offset((page - 1) * page_size).limit(page_size)
+    user_generations = query.all()
     
     history_list = []
     for gen in user_generations:
@@ -139,25 +1587,17 @@ def get_history():
             "created_at": gen.created_at.isoformat()
         })
     
-    logging.info(f"Returning {len(history_list)} history records for user {current_user.email}")
-    return jsonify(history_list), 200
+    logging.info("Returning %d history records for user %s", len(history_list), current_user.id, extra=SAMPLE_POLL)
+    response = jsonify(history_list)
+    history_page_cache.put(cache_key, token, response.get_data())
+    return response, 200
 
 @app.route('/generated_images/<path:filename>')
 def serve_generated_image(filename):
     """
-    通过 HTTP 接口向前端提供生成的图片文件
+    通过 HTTP 接口向前端提供生成的图片文件（本地没有副本时重定向到对象存储）
     """
-    # 构造完整的本地文件路径
-    image_dir = os.getenv("IMAGES_PATH", "./images")
-    full_path = os.path.join(image_dir, filename)
-    
-    # 检查文件是否存在
-    if not os.path.exists(full_path):
-        return "File not found", 404
-
-    # 使用 Flask 的 send_file 发送文件
-    # mimetype 'image/jpeg' 或 'image/png' 根据实际情况调整
-    return send_file(full_path, mimetype='image/jpeg')
+    return serve_image(IMAGE_URL_PREFIX + filename)
 
 @app.route('/api/register', methods=['POST'])
 def register():
@@ -171,12 +1611,15 @@ def register():
         logging.warning("Registration failed: Missing required fields.")
         return jsonify({"message": "Missing required fields."}), 400
 
-    logging.info(f"Attempting registration for email: {email}")
+    logging.info("Attempting registration.")
 
-    # 1. 验证邀请码
-    code_record = InvitationCode.query.filter_by(code=invitation_code).first()
+    # 1. 验证邀请码（走 code 的唯一索引；过期检查和真正的占用在下面的条件 UPDATE 中完成）
+    invitation_code = invitation_code.strip()
+    code_record = db.session.execute(
+        select(InvitationCode.is_used).where(InvitationCode.code == invitation_code)
+    ).first()
     if not code_record or code_record.is_used:
-        logging.warning(f"Registration failed for email {email}: Invalid or used invitation code provided.")
+        logging.warning("Registration failed: Invalid or used invitation code provided.")
         # 在这里直接返回错误，而不是抛出异常
         return jsonify({"message": "Invalid or used invitation code."}), 400
 
@@ -184,7 +1627,7 @@ def register():
 
     # 2. 验证邮箱是否已注册
     if User.query.filter_by(email=email).first():
-        logging.warning(f"Registration failed: Email {email} is already registered.")
+        logging.warning("Registration failed: Email is already registered.")
         return jsonify({"message": "Email already registered."}), 409
 
     try:
@@ -195,17 +1638,19 @@ def register():
         db.session.add(new_user)
         db.session.flush()
 
-        # 4. 更新邀请码状态
-        logging.info(f"Updating invitation code {invitation_code} status.")
-        code_record.is_used = True
-        code_record.used_by_user_id = new_user.id
-        
+        # 4. 占用邀请码：并发使用同一邀请码时只有一个请求能成功
+        logging.info("Updating invitation code status for user %s.", new_user.id)
+        if not redeem_code(db.session, InvitationCode, invitation_code, new_user.id):
+            db.session.rollback()
+            logging.warning("Registration failed: invitation code expired or was used concurrently.")
+            return jsonify({"message": "Invalid or used invitation code."}), 400
+
         db.session.commit()
-        logging.info(f"User {email} registered successfully.")
+        logging.info("User %s registered successfully.", new_user.id)
         return jsonify({"message": "Registration successful."}), 201
     except Exception as e:
         db.session.rollback()
-        logging.error(f"Registration failed for email {email}: {e}", exc_info=True)
+        logging.error("Registration failed: %s", e, exc_info=True)
         return jsonify({"message": "An error occurred during registration."}), 500
 
 @app.route('/api/login', methods=['POST'])
@@ -215,134 +1660,178 @@ def login():
     email = data.get('email')
     password = data.get('password')
 
-    logging.info(f"Attempting login for email: {email}")
     user = User.query.filter_by(email=email).first()
 
     if user and user.check_password(password):
         login_user(user)
-        logging.info(f"Login successful for user: {email}. Credits: {user.generation_credits}")
+        logging.info("Login successful for user %s. Credits: %s", user.id, user.generation_credits)
         return jsonify({"message": "Login successful.", "email": user.email, "credits": user.generation_credits}), 200
     else:
-        logging.warning(f"Login failed for email {email}: Invalid credentials.")
+        logging.warning("Login failed: Invalid credentials.")
         return jsonify({"message": "Invalid email or password."}), 401
 
 @app.route('/api/logout')
 @login_required
 def logout():
-    logging.info(f"User {current_user.email} is logging out.")
+    logging.info("User %s is logging out.", current_user.id)
     logout_user()
     logging.info("Logout successful.")
     return jsonify({"message": "Logout successful."}), 200
 
 @app.route('/api/user', methods=['GET'])
+@conditional_user_get('user')
 @login_required
 def get_user_info():
-    logging.info(f"API route /api/user called for user: {current_user.email}")
+    logging.info("API route /api/user called for user %s", current_user.id, extra=SAMPLE_POLL)
     return jsonify({
         "email": current_user.email,
         "credits": current_user.generation_credits
     }), 200
 
+@app.route('/api/answer_cache', methods=['GET'])
+@login_required
+def lookup_answer_cache():
+    """
+    查询等价谜底是否已有可复用的结果，前端据此让用户选择“直接使用”或“重新生成”
+    """
+    answer = request.args.get('answer')
+    if not answer:
+        return jsonify({"message": "Missing 'answer' parameter."}), 400
+    selected_size = request.args.get('selectedSize', 'vertical')
+    cached = find_cached_generation(answer_cache_key(answer), selected_size)
+    if cached is None:
+        return jsonify({"available": False}), 200
+    return jsonify({
+        "available": True,
+        "riddle_answer": cached.riddle_answer,
+        "image_url": cached.image_url,
+        "credits_cost": ANSWER_CACHE_HIT_CREDITS,
+    }), 200
+
+@app.route('/api/figurine_cache', methods=['POST'])
+@login_required
+def lookup_figurine_cache():
+    """
+    查询上传的图片（相同或近似）是否已有可复用的立体雕塑结果，前端据此让用户选择“直接使用”（reuse=true）或“重新生成”
+    """
+    file = request.files.get('image')
+    if file is None or file.filename == '':
+        return jsonify({"message": "未找到上传的图片文件。"}), 400
+    cached, match = find_figurine_by_fingerprint(*fingerprint_upload(file.read()))
+    if cached is None:
+        return jsonify({"available": False}), 200
+    return jsonify({
+        "available": True,
+        "match": match,
+        "image_url": cached.image_url,
+        "credits_cost": FIGURINE_CACHE_HIT_CREDITS,
+    }), 200
+
 @app.route('/api/generate_meme', methods=['POST'])
 @login_required
 def generate_meme():
-    logging.info(f"API route /api/generate_meme called by user: {current_user.email}")
+    request_started = time.perf_counter()
+    logging.info("API route /api/generate_meme called by user %s", current_user.id)
     data = request.get_json()
     answer = data.get('answer')
     selected_size = data.get('selectedSize', 'vertical') # 接收新参数，并设置默认值
-    logging.info(f"Received request for meme generation. Answer: {answer}")
+    logging.debug("Received request for meme generation. Answer: %s", answer)
 
     if not answer:
         logging.warning("Meme generation failed: Missing 'answer' parameter.")
         return jsonify({"message": "Missing 'answer' parameter."}), 400
+
+    # 幂等重试：在额度检查之前复用已有结果（已完成的请求可能刚好用掉了最后一次额度）
+    idempotency_key, error_response = get_idempotency_key()
+    if error_response:
+        return error_response
+    fingerprint = request_fingerprint('generate_meme', answer, selected_size)
+    if idempotency_key:
+        replay = replay_idempotent_request(current_user.id, idempotency_key, 'generate_meme', fingerprint)
+        if replay is not None:
+            return replay
     
     # 商业化逻辑: 检查用户额度
-    logging.info(f"Checking credits for user {current_user.email}. Current credits: {current_user.generation_credits}")
+    logging.debug("Checking credits for user %s. Current credits: %s", current_user.id, current_user.generation_credits)
     if current_user.generation_credits <= 0:
-        logging.warning(f"Meme generation failed for user {current_user.email}: No credits left.")
+        logging.warning("Meme generation failed for user %s: No credits left.", current_user.id)
         return jsonify({"message": "You have no credits left."}), 402
 
+    # 用户限流在额度检查之后、任何交付方式（谜底缓存、预生成池、上游生成）之前执行，与立体雕塑接口一致
+    try:
+        user_rate_limiter.check(current_user.id)
+    except AdmissionRejected as ar:
+        logging.warning("Meme generation rate limited for user %s, retry after %ss.", current_user.id, ar.retry_after)
+        return admission_rejected_response(ar)
+
+    # 用户选择复用等价谜底的已有结果：立即返回，不调用任何上游服务
+    answer_key = answer_cache_key(answer)
+    if data.get('reuse'):
+        cached = find_cached_generation(answer_key, selected_size)
+        if cached is not None:
+            try:
+                reused_id = reuse_cached_generation(current_user.id, answer, cached)
+            except InsufficientCredits:
+                return insufficient_credits_response()
+            rollups.record_generation('generate_meme', 'answer_cache', 'completed', selected_size, answer_key)
+            logging.info("Served generation %s from answer cache (source generation %s).", reused_id, cached.id)
+            response = with_variant_headers(serve_image(cached.image_url), reused_id, cached.id)
+            response.headers['X-Answer-Cache'] = 'hit'
+            return response
+        logging.info("No reusable result in answer cache, generating a fresh one.")
+
+    user_id = current_user.id
+
+    # 热门谜底命中预生成池：直接交付，不调用上游服务
+    pooled = claim_pregenerated_item(answer_key, selected_size)
+    if pooled is not None:
+        generation_id, replay = create_pending_generation(user_id, answer, 'generate_meme', idempotency_key, fingerprint,
+                                                          answer_key=answer_key, size=selected_size)
+        if replay is not None:
+            release_pregenerated_item(pooled.id)
+            return replay
+        image_path = os.path.join(IMAGES_PATH, pooled.image_key)
+        db.session.execute(update(PregeneratedItem).where(PregeneratedItem.id == pooled.id)
+                           .values(claimed_by_generation_id=generation_id))
+        try:
+            remaining_credits = complete_generation(generation_id, user_id, pooled.prompt_text, image_path)
+        except InsufficientCredits:
+            fail_generation(generation_id)
+            release_pregenerated_item(pooled.id)
+            return insufficient_credits_response()
+        rollups.record_generation('generate_meme', 'pregenerated', 'completed', selected_size, answer_key)
+        logging.info("Served generation %s from pre-generation pool. Remaining credits: %s", generation_id, remaining_credits)
+        response = with_variant_headers(send_file(image_path, mimetype='image/png'), generation_id)
+        response.headers['X-Pregenerated'] = 'true'
+        publish_generated_image(generation_id, image_path)
+        return response
+
+    priority = admission_priority(current_user, answer)
+
     # 创建生成记录，初始状态为 pending
     logging.info("Creating new generation record in the database.")
-    new_generation = Generation(user_id=current_user.id, riddle_answer=answer, status='pending')
-    db.session.add(new_generation)
-    db.session.commit()
-    logging.info(f"New generation record created with ID: {new_generation.id}")
+    generation_id, replay = create_pending_generation(user_id, answer, 'generate_meme', idempotency_key, fingerprint,
+                                                      answer_key=answer_key, size=selected_size)
+    if replay is not None:
+        return replay
+    logging.info("New generation record created with ID: %s", generation_id)
+    ctx = GenerationContext('generate_meme', user_id, generation_id, priority, started=request_started,
+                            inputs={'answer': answer, 'size': selected_size, 'answer_key': answer_key})
+    # 同一谜底上次失败在某个阶段之后：从检查点继续，不再重复已完成的上游调用
+    resumable_id = find_resumable_generation(user_id, Generation.answer_key == answer_key, Generation.size == selected_size)
+    if resumable_id is not None:
+        resume_from_checkpoint(ctx, resumable_id)
+    # 上游调用耗时 60~90 秒：先归还数据库连接并清空会话，避免连接和过期的对象状态跨越整个等待过程
+    db.session.remove()
 
-    try:
-        # 1. 调用部署在新加坡的 Gemini API 代理服务
-        logging.info("Step 1: Calling remote Gemini API proxy.")
-        gemini_response = requests.post(SINGAPORE_GEMINI_API_URL, json={'answer': answer}, timeout=60)
-        gemini_response.raise_for_status()
-        
-        gemini_data = gemini_response.json()
-        raw_prompt_text = gemini_data.get('prompt')
-
-        if not raw_prompt_text:
-            raise ValueError("Gemini API proxy returned an empty response.")
-        
-        matches = re.findall(PROMPT_PATTERN, raw_prompt_text, re.DOTALL)
-        if not matches or len(matches) < 2:
-            logging.error(f"Failed to parse Gemini response. Response was: {raw_prompt_text}")
-            raise ValueError("Gemini 响应格式不正确。")
-        chinese_prompt = matches[1].strip()
-        logging.info("Step 1 complete. Successfully parsed Chinese prompt.")
-        
-        size_map = {
-            'vertical': {'width': 1024, 'height': 1920},
-            'horizontal': {'width': 1920, 'height': 1024},
-            'square': {'width': 1024, 'height': 1024}
-        }
-        dimensions = size_map.get(selected_size, size_map['vertical'])
-
-        # 2. 调用 jimeng_api 生成图片
-        logging.info("Step 2: Calling jimeng_api to generate image.")
-        image_path = jimeng_generate_api(chinese_prompt, dimensions['width'], dimensions['height'])
-        
-        if not image_path:
-            logging.error("Jimeng API call failed. No image path returned.")
-            raise Exception("图片生成失败。")
-        logging.info(f"Step 2 complete. Image saved at: {image_path}")
-            
-        # 3. 成功后，更新数据库记录和用户额度
-        logging.info(f"Step 3: Updating user credits and generation record for ID: {new_generation.id}")
-        current_user.generation_credits -= 1
-        new_generation.prompt_text = raw_prompt_text
-        new_generation.image_url = f"/generated_images/{os.path.basename(image_path)}"
-        new_generation.status = 'completed'
-        db.session.commit()
-        logging.info(f"Database updated successfully. Remaining credits for user {current_user.email}: {current_user.generation_credits}")
-        
-        # 使用 send_file 时，直接返回文件流，不返回 JSON
-        return send_file(image_path, mimetype='image/png')
-        
-    except ValueError as ve:
-        logging.error(f"Processing failed due to a ValueError: {ve}", exc_info=True)
-        db.session.rollback()
-        new_generation.status = 'failed'
-        db.session.commit()
-        # 返回通用错误信息，隐藏内部细节
-        return jsonify({"message": "内容生成或解析失败，请尝试其他词语。"}), 500
-    except requests.exceptions.RequestException as ree:
-        logging.error(f"Failed to connect to Singapore Gemini API proxy: {ree}", exc_info=True)
-        db.session.rollback()
-        new_generation.status = 'failed'
-        db.session.commit()
-        # 返回通用错误信息，隐藏服务URL
-        return jsonify({"message": "无法连接到海外服务，请稍后再试。"}), 500
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during meme generation: {e}", exc_info=True)
-        db.session.rollback()
-        new_generation.status = 'failed'
-        db.session.commit()
-        # 返回通用错误信息，不暴露任何内部信息
-        return jsonify({"message": "哎呀，出了点小问题，请稍后再试。"}), 500
+    return run_generation(meme_pipeline, ctx, MEME_ERROR_MESSAGES)
 
 
 @app.route('/api/generate_figurine', methods=['POST'])
 @login_required
 def generate_figurine():
-    logging.info(f"API route /api/generate_figurine called by user: {current_user.email}")
+    request_started = time.perf_counter()
+    logging.info("API route /api/generate_figurine called by user %s", current_user.id)
 
     # 1. 检查文件是否存在于请求中
     if 'image' not in request.files:
@@ -356,59 +1845,455 @@ def generate_figurine():
         logging.warning("Figurine generation failed: No image file selected.")
         return jsonify({"message": "请选择一个图片文件。"}), 400
 
+    # 幂等重试：以上传图片的内容作为请求指纹
+    idempotency_key, error_response = get_idempotency_key()
+    if error_response:
+        return error_response
+    upload_bytes = file.read()
+    fingerprint = request_fingerprint('generate_figurine', upload_bytes)
+    file.seek(0)
+    if idempotency_key:
+        replay = replay_idempotent_request(current_user.id, idempotency_key, 'generate_figurine', fingerprint)
+        if replay is not None:
+            return replay
+
     # 3. 商业化逻辑: 检查用户额度
-    logging.info(f"Checking credits for user {current_user.email}. Current credits: {current_user.generation_credits}")
+    logging.debug("Checking credits for user %s. Current credits: %s", current_user.id, current_user.generation_credits)
     if current_user.generation_credits <= 0:
-        logging.warning(f"Figurine generation failed for user {current_user.email}: No credits left.")
+        logging.warning("Figurine generation failed for user %s: No credits left.", current_user.id)
         return jsonify({"message": "您的生成额度已用完。"}), 402
 
-    # (可选) 保存上传的文件以备将来使用，这里我们仅验证上传成功
-    filename = secure_filename(file.filename)
-    file.save(os.path.join(os.getenv("UPLOADS"), filename))
+    # 用户限流在额度检查之后、任何交付方式（指纹复用、上游生成）之前执行，与梗图接口一致
+    try:
+        user_rate_limiter.check(current_user.id)
+    except AdmissionRejected as ar:
+        logging.warning("Figurine generation rate limited for user %s, retry after %ss.", current_user.id, ar.retry_after)
+        return admission_rejected_response(ar)
+    priority = admission_priority(current_user, "立体雕塑作品")
+
+    # 用户选择复用：相同或近似图片已有完成的结果时直接交付，不调用任何上游服务
+    upload_sha256, upload_phash = fingerprint_upload(upload_bytes)
+    if request.form.get('reuse', '').lower() in ('1', 'true'):
+        cached, match = find_figurine_by_fingerprint(upload_sha256, upload_phash)
+        if cached is not None:
+            try:
+                reused_id = reuse_cached_generation(current_user.id, "立体雕塑作品", cached, FIGURINE_CACHE_HIT_CREDITS)
+            except InsufficientCredits:
+                return jsonify({"message": "您的生成额度已用完。"}), 402
+            rollups.record_generation('generate_figurine', 'figurine_cache', 'completed')
+            logging.info("Served figurine %s from upload fingerprint cache (%s match, source generation %s).",
+                         reused_id, match, cached.id)
+            response = with_variant_headers(serve_image(cached.image_url), reused_id, cached.id)
+            response.headers['X-Figurine-Cache'] = match
+            return response
+        logging.info("No reusable figurine for this upload, generating a fresh one.")
 
     # 4. 创建生成记录
     logging.info("Creating new generation record for figurine.")
-    new_generation = Generation(user_id=current_user.id, riddle_answer="立体雕塑作品", status='pending')
-    db.session.add(new_generation)
+    user_id = current_user.id
+    generation_id, replay = create_pending_generation(user_id, "立体雕塑作品", 'generate_figurine', idempotency_key, fingerprint)
+    if replay is not None:
+        return replay
+    logging.info("New generation record created with ID: %s", generation_id)
+
+    # (可选) 保存上传的文件以备将来使用；文件名加上生成记录 ID，避免不同用户的同名文件互相覆盖
+    upload_key = f"{generation_id}_{secure_filename(file.filename)}"
+    upload_path = os.path.join(os.getenv("UPLOADS"), upload_key)
+    file.save(upload_path)
+    register_image_asset(upload_key, KIND_UPLOAD, generation_id, upload_path)
+    record_upload_fingerprint(generation_id, upload_sha256, upload_phash)
     db.session.commit()
-    logging.info(f"New generation record created with ID: {new_generation.id}")
 
-    try:
-        # 5. 使用您提供的固定提示词
-        figurine_prompt = (
-            "First ask me to upload an image and then create a 1/7 scale commercialized figurine of the characters in the picture, "
-            "in a realistic style, in a real environment. The figurine is placed on a computer desk. "
-            "The figurine has a round transparent acrylic base, with no text on the base. "
-            "The content on the computer screen is a 3D modeling process of this figurine. "
-            "Next to the computer screen is a toy packaging box, designed in a style reminiscent of high-quality collectible figures, "
-            "printed with original artwork. The packaging features two-dimensional flat illustrations."
-        )
-        
-        # 6. 调用 jimeng_api 生成图片 (使用固定的方形尺寸)
-        logging.info("Calling jimeng_api to generate figurine image.")
-        image_path = jimeng_generate_api(figurine_prompt, 1024, 1024)
-        
-        if not image_path:
-            raise Exception("图片生成服务未能返回结果。")
-        logging.info(f"Image generated and saved at: {image_path}")
-            
-        # 7. 成功后，更新数据库记录和用户额度
-        logging.info(f"Updating database for generation ID: {new_generation.id}")
-        current_user.generation_credits -= 1
-        new_generation.prompt_text = figurine_prompt # 记录使用的prompt
-        new_generation.image_url = f"/generated_images/{os.path.basename(image_path)}"
-        new_generation.status = 'completed'
-        db.session.commit()
-        logging.info(f"Database updated. Remaining credits for {current_user.email}: {current_user.generation_credits}")
-        
-        return send_file(image_path, mimetype='image/png')
-        
-    except Exception as e:
-        logging.error(f"An unexpected error occurred during figurine generation: {e}", exc_info=True)
+    # 手办固定使用方形尺寸
+    ctx = GenerationContext('generate_figurine', user_id, generation_id, priority, started=request_started,
+                            inputs={'image_size': 'square'})
+    # 同一张图片上次生成失败但图片已生成：从检查点继续
+    resumable_id = find_resumable_generation(user_id, Generation.id.in_(
+        select(UploadFingerprint.generation_id).where(UploadFingerprint.sha256 == upload_sha256)
+    ))
+    if resumable_id is not None:
+        resume_from_checkpoint(ctx, resumable_id)
+    # 上游调用期间不占用数据库连接
+    db.session.remove()
+
+    return run_generation(figurine_pipeline, ctx, FIGURINE_ERROR_MESSAGES)
+
+
+@app.route('/api/generations/<int:generation_id>/next_variant', methods=['POST'])
+@login_required
+def next_generation_variant(generation_id):
+    """
+    换一个版本：直接交付同一次生成中保存的下一张图片，不调用上游服务，按 JIMENG_VARIANT_CREDITS 扣除额度
+    """
+    logging.info("API route /api/generations/%s/next_variant called by user %s", generation_id, current_user.id)
+    generation = Generation.query.filter_by(id=generation_id, user_id=current_user.id, status='completed').first()
+    if generation is None:
+        return jsonify({"message": "未找到该生成记录。"}), 404
+    if current_user.generation_credits < JIMENG_VARIANT_CREDITS:
+        return jsonify({"message": "您的生成额度已用完。"}), 402
+
+    # 复用结果（谜底缓存 / 已交付的版本）共享来源记录的版本
+    parent_id = generation.source_generation_id or generation.id
+    variant = claim_next_variant(parent_id)
+    if variant is None:
         db.session.rollback()
-        new_generation.status = 'failed'
-        db.session.commit()
-        return jsonify({"message": "生成手办时发生未知错误，请稍后再试。"}), 500
+        return jsonify({"message": "没有更多版本了，请重新生成。"}), 404
+
+    served = Generation(
+        user_id=current_user.id, riddle_answer=generation.riddle_answer, status='completed',
+        prompt_text=generation.prompt_text, image_url=variant.image_url,
+        answer_key=generation.answer_key, size=generation.size, source_generation_id=parent_id,
+    )
+    db.session.add(served)
+    db.session.flush()
+    variant.claimed_by_generation_id = served.id
+    if JIMENG_VARIANT_CREDITS:
+        try:
+            deduct_credits(current_user.id, JIMENG_VARIANT_CREDITS)
+        except InsufficientCredits:
+            return jsonify({"message": "您的生成额度已用完。"}), 402
+    served_id, image_url = served.id, variant.image_url
+    db.session.commit()
+    bump_user_version(current_user.id)
+    rollups.record_generation('next_variant', 'variant', 'completed', generation.size)
+    logging.info("Served variant %s of generation %s as generation %s.", variant.variant_index, parent_id, served_id)
+    return with_variant_headers(serve_image(image_url), served_id, parent_id)
+
+
+@app.route('/api/admin/traces', methods=['GET'])
+@admin_required
+def get_slowest_traces():
+    """
+    本进程内最近最慢的请求（需要 TRACING_EXPORTER=memory），可用 name 前缀过滤，如 name=POST /api/generate_meme
+    """
+    if not hasattr(tracer.exporter, 'slowest_roots'):
+        return jsonify({"message": "Trace lookup requires TRACING_EXPORTER=memory."}), 404
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    return jsonify(tracer.exporter.slowest_roots(limit, request.args.get('name', ''))), 200
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@admin_required
+def list_profiles():
+    """最近的请求分析结果摘要（所有工作进程共用同一个目录），按时间倒序"""
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    return jsonify(profiler.store.recent(limit)), 200
+
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+@admin_required
+def get_profile(profile_id):
+    """
+    单个分析结果；format=folded 时返回火焰图折叠格式的纯文本，可直接导入 speedscope 或 flamegraph.pl
+    """
+    profile = profiler.store.get(profile_id)
+    if profile is None:
+        return jsonify({"message": "Profile not found."}), 404
+    if request.args.get('format') == 'folded':
+        folded = '\n'.join(f"{stack} {count}" for stack, count in profile['stacks'].items())
+        return app.response_class(folded + '\n', mimetype='text/plain')
+    return jsonify(profile), 200
+
+
+@app.route('/api/admin/traces/<trace_id>', methods=['GET'])
+@admin_required
+def get_trace(trace_id):
+    """
+    单个 trace 在本进程内记录的全部 Span（按开始时间排序）；代理服务的 Span 记录在代理服务自己的导出器中
+    """
+    if not hasattr(tracer.exporter, 'get_trace'):
+        return jsonify({"message": "Trace lookup requires TRACING_EXPORTER=memory."}), 404
+    spans = tracer.exporter.get_trace(trace_id.lower())
+    if not spans:
+        return jsonify({"message": "Trace not found."}), 404
+    return jsonify(spans), 200
+
+
+@app.route('/api/admin/db_pool', methods=['GET'])
+@admin_required
+def get_db_pool_stats():
+    """
+    连接池使用情况：当前池状态 + 累计借出统计
+    """
+    pool = db.engine.pool
+    stats = {"status": pool.status(), **pool_stats.snapshot()}
+    for attr in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, attr):
+            stats[attr] = getattr(pool, attr)()
+    return jsonify(stats), 200
+
+
+@app.route('/api/admin/admission', methods=['GET'])
+@admin_required
+def get_admission_stats():
+    """
+    上游准入控制状态：各上游的并发、排队与拒绝计数
+    """
+    return jsonify({"gemini": gemini_budget.snapshot(), "jimeng": jimeng_budget.snapshot()}), 200
+
+
+@app.route('/api/admin/stats', methods=['GET'])
+@admin_required
+def get_usage_stats():
+    """
+    用量与延迟统计（只读预聚合表）：granularity 为 hour / day，periods 为最近多少个小时或天（含当前），
+    endpoint 只看某个接口；本进程尚未写入的增量最多晚 ROLLUP_FLUSH_INTERVAL 秒出现
+    """
+    granularity = request.args.get('granularity', GRANULARITY_DAY)
+    if granularity not in (GRANULARITY_HOUR, GRANULARITY_DAY):
+        return jsonify({"message": "granularity must be hour or day."}), 400
+    periods = min(max(request.args.get('periods', 7 if granularity == GRANULARITY_DAY else 24, type=int), 1), 400)
+    stats = rollups.summary(db.session, granularity, default_since(granularity, periods),
+                            endpoint=request.args.get('endpoint'),
+                            top_answers=min(request.args.get('top', 20, type=int), 200))
+    return jsonify(stats), 200
+
+
+@app.route('/api/admin/gemini_replicas', methods=['GET'])
+@admin_required
+def get_gemini_replica_stats():
+    """
+    新加坡代理各副本的状态：是否健康、进行中请求、延迟 EWMA、请求与失败计数、摘除次数（本进程内统计）
+    """
+    return jsonify(gemini_replicas.stats()), 200
+
+
+@app.route('/api/admin/jimeng_tasks', methods=['GET'])
+@admin_required
+def get_jimeng_task_stats():
+    """
+    即梦异步任务轮询器的统计：跟踪中的任务数、查询次数与失败次数、完成与失败的任务数、预计完成时间（本进程内统计）
+    """
+    return jsonify(dict(jimeng_poller.snapshot(), enabled=JIMENG_ASYNC_ENABLED)), 200
+
+
+@app.cli.command('retention-sweep')
+@click.option('--batch-size', default=500, show_default=True, help='每一步最多处理的记录数')
+def retention_sweep_command(batch_size):
+    """按保留策略增量清理图片（建议通过 cron 定期执行）。"""
+    sweeper = RetentionSweeper(db, ImageAsset, Generation, image_storage, IMAGES_PATH, os.getenv("UPLOADS"),
+                               IMAGE_URL_PREFIX, RetentionPolicy.from_env(), variant_model=GenerationVariant)
+    stats = sweeper.sweep(batch_size)
+    if any(stats.values()):
+        # 图片地址被批量改写或置空，使所有用户的历史记录 ETag 失效
+        user_versions.bump_all()
+    click.echo(json.dumps(stats))
+
+
+@app.cli.command('generation-recover')
+@click.option('--batch-size', default=500, show_default=True, help='每一步最多处理的记录数')
+def generation_recover_command(batch_size):
+    """回收中断的生成，清理过期的检查点（建议通过 cron 定期执行）。"""
+    click.echo(json.dumps(recover_generations(batch_size)))
+
+
+@app.cli.command('retention-backfill')
+@click.option('--batch-size', default=1000, show_default=True, help='每批提交的记录数')
+def retention_backfill_command(batch_size):
+    """一次性登记上线前已存在的生成图片（逐条流式扫描目录，只需在启用保留策略时运行一次）。"""
+    url_to_generation = dict(
+        db.session.query(Generation.image_url, Generation.id).filter(Generation.image_url.isnot(None)).all()
+    )
+    known_keys = {key for (key,) in db.session.query(ImageAsset.key)}
+    registered = 0
+    with os.scandir(IMAGES_PATH) as entries:
+        for entry in entries:
+            if not entry.is_file() or entry.name in known_keys:
+                continue
+            modified_at = datetime.fromtimestamp(entry.stat().st_mtime, timezone.utc)
+            db.session.add(ImageAsset(
+                key=entry.name, kind=KIND_GENERATED, size_bytes=entry.stat().st_size,
+                generation_id=url_to_generation.get(f"{IMAGE_URL_PREFIX}{entry.name}"),
+                created_at=modified_at, last_accessed_at=modified_at,
+            ))
+            registered += 1
+            if registered % batch_size == 0:
+                db.session.commit()
+    db.session.commit()
+    click.echo(f"Registered {registered} existing images.")
+
+
+@app.route('/api/admin/answer_cache', methods=['GET'])
+@admin_required
+def get_answer_cache_stats():
+    """
+    谜底结果缓存的命中率统计
+    """
+    return jsonify(answer_cache_stats.snapshot()), 200
+
+
+@app.route('/api/admin/answer_cache/invalidate', methods=['POST'])
+@admin_required
+def invalidate_answer_cache():
+    """
+    将质量差的结果移出缓存：按生成记录 ID（generation_id）或谜底（answer，按归一化键匹配所有尺寸）
+    """
+    data = request.get_json() or {}
+    query = Generation.query.filter(Generation.source_generation_id.is_(None))
+    if data.get('generation_id'):
+        query = query.filter(Generation.id == data['generation_id'])
+    elif data.get('answer'):
+        query = query.filter(Generation.answer_key == answer_cache_key(data['answer']))
+    else:
+        return jsonify({"message": "Provide 'generation_id' or 'answer'."}), 400
+    invalidated = query.update({Generation.cache_excluded: True}, synchronize_session=False)
+    db.session.commit()
+    answer_cache_stats.incr("invalidated", invalidated)
+    logging.info("Invalidated %s answer cache entries (generation %s, answer %s).", invalidated,
+                 data.get('generation_id'), answer_digest(answer_cache_key(data['answer'])) if data.get('answer') else None)
+    logging.debug("Answer cache invalidation payload: %s", data)
+    return jsonify({"invalidated": invalidated}), 200
+
+
+# --- 邀请码批量发放 ---
+# PostgreSQL 下用 COPY 批量写入，导出按 id 键集分页流式输出 CSV，见 invitations.py
+INVITATION_BATCH_SIZE = int(os.getenv('INVITATION_BATCH_SIZE', '10000'))
+INVITATION_ISSUE_MAX = int(os.getenv('INVITATION_ISSUE_MAX', '200000'))
+
+
+def invitation_loader():
+    return InvitationCodeLoader(db.engine, InvitationCode.__table__, INVITATION_BATCH_SIZE)
+
+
+def parse_invitation_expiry(expires_at=None, expires_in_days=None):
+    """
+    解析邀请码过期时间：ISO 8601 时间（不带时区按 UTC）或从现在起的天数，都未提供时返回 None（永不过期）
+
+    异常:
+        ValueError: 格式错误
+    """
+    if expires_at:
+        parsed = datetime.fromisoformat(expires_at)
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    if expires_in_days:
+        return datetime.now(timezone.utc) + timedelta(days=float(expires_in_days))
+    return None
+
+
+@app.route('/api/admin/invitations', methods=['POST'])
+@admin_required
+def issue_invitation_codes():
+    """
+    批量生成邀请码：count、campaign（活动标签）、expires_at 或 expires_in_days、length、prefix；
+    生成的邀请码通过 /api/admin/invitations/export?campaign= 导出
+    """
+    data = request.get_json() or {}
+    try:
+        count = int(data.get('count', 0))
+        expires_at = parse_invitation_expiry(data.get('expires_at'), data.get('expires_in_days'))
+        if not 0 < count <= INVITATION_ISSUE_MAX:
+            raise ValueError(f"count must be between 1 and {INVITATION_ISSUE_MAX}")
+        issued = invitation_loader().issue(count, data.get('campaign'), expires_at,
+                                           int(data.get('length', 12)), data.get('prefix', ''))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    logging.info("Issued %s invitation codes for campaign %s.", issued, data.get('campaign'))
+    return jsonify({"issued": issued, "campaign": data.get('campaign'),
+                    "expires_at": expires_at.isoformat() if expires_at else None}), 201
+
+
+@app.route('/api/admin/invitations/import', methods=['POST'])
+@admin_required
+def import_invitation_codes():
+    """
+    导入外部提供的邀请码：表单字段 file（每行一个，或 CSV 第一列），以及 campaign、expires_at / expires_in_days；
+    上传内容逐行读取写入，不整体读入内存
+    """
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"message": "Missing 'file'."}), 400
+    try:
+        expires_at = parse_invitation_expiry(request.form.get('expires_at'), request.form.get('expires_in_days'))
+        lines = io.TextIOWrapper(upload.stream, encoding='utf-8-sig')
+        result = invitation_loader().load(read_codes(lines), request.form.get('campaign'), expires_at)
+    except (ValueError, UnicodeDecodeError) as e:
+        return jsonify({"message": str(e)}), 400
+    logging.info("Imported invitation codes for campaign %s: %s", request.form.get('campaign'), result)
+    return jsonify(result), 201
+
+
+@app.route('/api/admin/invitations/export', methods=['GET'])
+@admin_required
+def export_invitation_codes():
+    """
+    流式导出邀请码 CSV：campaign 过滤活动，status 为 all / unused / used
+    """
+    status = request.args.get('status', 'all')
+    if status not in ('all', 'unused', 'used'):
+        return jsonify({"message": "status must be all, unused or used."}), 400
+    campaign = request.args.get('campaign')
+    filename = secure_filename(f"invitations-{campaign or 'all'}-{status}.csv")
+    rows = export_codes(db.session, InvitationCode, campaign, status)
+    return app.response_class(stream_with_context(rows), mimetype='text/csv',
+                              headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+@app.cli.command('invite-issue')
+@click.option('--count', type=int, required=True, help='生成数量')
+@click.option('--campaign', default=None, help='活动标签')
+@click.option('--expires-at', default=None, help='过期时间（ISO 8601）')
+@click.option('--expires-days', type=float, default=None, help='从现在起多少天后过期')
+@click.option('--length', default=12, show_default=True, help='随机部分长度')
+@click.option('--prefix', default='', help='邀请码前缀')
+def invite_issue_command(count, campaign, expires_at, expires_days, length, prefix):
+    """批量生成邀请码（生成后用 invite-export 导出）。"""
+    expires = parse_invitation_expiry(expires_at, expires_days)
+    issued = invitation_loader().issue(count, campaign, expires, length, prefix)
+    click.echo(f"Issued {issued} invitation codes (campaign={campaign}, expires_at={expires}).", err=True)
+
+
+@app.cli.command('invite-import')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--campaign', default=None, help='活动标签')
+@click.option('--expires-at', default=None, help='过期时间（ISO 8601）')
+@click.option('--expires-days', type=float, default=None, help='从现在起多少天后过期')
+def invite_import_command(source, campaign, expires_at, expires_days):
+    """从文件导入邀请码（每行一个或 CSV 第一列，- 表示标准输入），已存在的跳过。"""
+    result = invitation_loader().load(read_codes(source), campaign, parse_invitation_expiry(expires_at, expires_days))
+    click.echo(json.dumps(result))
+
+
+@app.cli.command('invite-export')
+@click.option('--campaign', default=None, help='只导出该活动')
+@click.option('--status', type=click.Choice(['all', 'unused', 'used']), default='all', show_default=True)
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='输出文件，默认标准输出')
+def invite_export_command(campaign, status, output):
+    """流式导出邀请码 CSV。"""
+    for chunk in export_codes(db.session, InvitationCode, campaign, status):
+        output.write(chunk)
+
+
+@app.cli.command('pregen-fill')
+@click.option('--max-items', default=PREGEN_MAX_PER_RUN, show_default=True, help='本轮最多生成的数量')
+@click.option('--force', is_flag=True, help='忽略低峰时段限制')
+def pregen_fill_command(max_items, force):
+    """为热门谜底补充预生成池（建议通过 cron 定期执行，非低峰时段自动跳过）。"""
+    if not force and not is_offpeak():
+        click.echo(f"Outside off-peak hours ({PREGEN_OFFPEAK_HOURS}), skipping.")
+        return
+    click.echo(f"Pre-generated {fill_pregeneration_pool(max_items)} items.")
+
+
+def reinit_after_fork(worker_count=1):
+    """
+    由 gunicorn.conf.py 的 post_fork 钩子在每个工作进程中调用（预加载应用后 fork；未预加载时应用在
+    post_fork 之后导入，多进程的判断由 create_version_store_from_env 按 WEB_CONCURRENCY 完成）。
+    fork 前建立的数据库连接和 HTTP 长连接属于主进程，子进程必须丢弃后重新建立，不能与其他进程共用同一个套接字。
+
+    参数:
+        worker_count: 工作进程数；大于 1 且版本号只保存在进程内存中时，关闭轮询接口的 ETag
+    """
+    global user_versions
+    with app.app_context():
+        # close=False：只丢弃继承来的连接，不关闭主进程仍持有的套接字
+        db.engine.dispose(close=False)
+    gemini_proxy_session.close()
+    rollups.reset_after_fork()
+    jimeng_poller.reset_after_fork()
+    _jimeng_task_slots.clear()
+    if worker_count > 1 and isinstance(user_versions, LocalVersionStore):
+        logging.warning("多进程部署未配置 REDIS_URL，各进程的用户版本号不一致，已关闭 /api/user、/api/history 的 ETag。")
+        user_versions = DisabledVersionStore()
 
 
 if __name__ == '__main__':
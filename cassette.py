@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+上游调用录制与回放（cassette）
+功能：让性能分析和回归测试不依赖真实的 Gemini / 即梦服务，结果可重复且不产生费用
+    1. record：正常调用上游，同时把请求、响应和耗时按请求内容的哈希保存到 CASSETTE_DIR/<名称>/<哈希>.json
+    2. replay：不访问网络，直接返回录制的响应；同一请求录制了多次时按顺序循环返回。
+       CASSETTE_LATENCY=original 时按录制的耗时等待，zero 时立即返回；没有录制的请求抛出 CassetteMiss
+    3. off（默认）：直接调用上游
+环境变量：CASSETTE_MODE（off / record / replay）、CASSETTE_DIR（默认 ./cassettes）、CASSETTE_LATENCY（original / zero）
+注意：录制时每条记录会被读出再整体写回，请使用单进程录制（GUNICORN_WORKERS=1）
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import timedelta
+from typing import Callable, Optional
+
+import requests
+
+MODE_OFF = "off"
+MODE_RECORD = "record"
+MODE_REPLAY = "replay"
+
+
+class CassetteMiss(RuntimeError):
+    """回放模式下没有找到对应请求的录制"""
+
+
+def response_to_dict(response: requests.Response) -> dict:
+    """把 requests 响应转换为可保存的字典（只保留状态码、响应头和解码后的响应体）"""
+    return {
+        "status_code": response.status_code,
+        "headers": dict(response.headers),
+        "text": response.text,
+        "url": response.url,
+    }
+
+
+def response_from_dict(data: dict, elapsed_ms: float) -> requests.Response:
+    """由录制的字典构造 requests 响应，调用方可照常使用 raise_for_status()、json()、elapsed"""
+    response = requests.Response()
+    response.status_code = data["status_code"]
+    response.headers.update(data["headers"])
+    response._content = data["text"].encode("utf-8")
+    response.encoding = "utf-8"
+    response.url = data.get("url", "")
+    response.elapsed = timedelta(milliseconds=elapsed_ms)
+    return response
+
+
+class Cassette:
+    """按请求内容录制和回放上游调用"""
+
+    def __init__(self, directory: str, mode: str = MODE_OFF, latency: str = "original"):
+        if mode not in (MODE_OFF, MODE_RECORD, MODE_REPLAY):
+            raise ValueError(f"未知的 CASSETTE_MODE：{mode}")
+        self.directory = directory
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._positions = {}
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == MODE_REPLAY
+
+    def _path(self, name: str, request: dict) -> str:
+        canonical = json.dumps(request, ensure_ascii=False, sort_keys=True, default=str)
+        digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, name, f"{digest}.json")
+
+    def _record(self, name: str, request: dict, response, elapsed_ms: float) -> None:
+        path = self._path(name, request)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            entry = {"name": name, "request": request, "episodes": []}
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    entry = json.load(f)
+            entry["episodes"].append({"response": response, "elapsed_ms": round(elapsed_ms, 3)})
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        logging.info("已录制上游调用 %s（%s，第 %d 次）", name, os.path.basename(path), len(entry["episodes"]))
+
+    def _replay(self, name: str, request: dict) -> tuple:
+        path = self._path(name, request)
+        try:
+            with open(path, encoding="utf-8") as f:
+                episodes = json.load(f)["episodes"]
+        except FileNotFoundError:
+            raise CassetteMiss(f"没有 {name} 请求的录制：{os.path.basename(path)}") from None
+        with self._lock:
+            position = self._positions.get(path, 0)
+            self._positions[path] = position + 1
+        episode = episodes[position % len(episodes)]
+        if self.latency == "original":
+            time.sleep(episode["elapsed_ms"] / 1000)
+        return episode["response"], episode["elapsed_ms"]
+
+    def call(self, name: str, request: dict, func: Callable, encode: Optional[Callable] = None,
+             decode: Optional[Callable] = None):
+        """
+        通过录制/回放层调用上游
+
+        参数:
+            name: 上游名称，决定录制的子目录
+            request: 决定录制键的请求内容（不应包含签名、时间戳等每次变化的字段）
+            func: 实际调用上游的无参函数
+            encode: 把 func 的返回值转换为可 JSON 序列化的对象；为 None 时原样保存
+            decode: 把录制的对象和耗时（毫秒）还原为 func 的返回值；为 None 时原样返回
+
+        返回:
+            func 的返回值（回放模式下为录制的值）
+
+        异常:
+            CassetteMiss: 回放模式下没有对应的录制；录制模式下 func 抛出的异常不录制，原样抛出
+        """
+        if self.mode == MODE_REPLAY:
+            response, elapsed_ms = self._replay(name, request)
+            return decode(response, elapsed_ms) if decode else response
+        if self.mode == MODE_OFF:
+            return func()
+        start = time.perf_counter()
+        result = func()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self._record(name, request, encode(result) if encode else result, elapsed_ms)
+        return result
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette() -> Cassette:
+    """返回本进程的录制/回放层（首次调用时按环境变量创建）"""
+    global _cassette
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette(
+                os.getenv("CASSETTE_DIR", "./cassettes"),
+                os.getenv("CASSETTE_MODE", MODE_OFF).lower(),
+                os.getenv("CASSETTE_LATENCY", "original").lower(),
+            )
+            if _cassette.mode != MODE_OFF:
+                logging.warning("上游调用录制/回放已启用：模式 %s，目录 %s", _cassette.mode, _cassette.directory)
+        return _cassette
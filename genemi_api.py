@@ -9,12 +9,15 @@ Gemini梗图提示词生成工具
 import os
 import sys
 import logging
-from datetime import datetime
 from dotenv import load_dotenv
 from typing import Optional, List
 import vertexai
 from vertexai.preview.vision_models import ImageGenerationModel
-from vertexai.generative_models import GenerativeModel, Image
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Image
+from prompt_parser import PROMPT_RESPONSE_SCHEMA
+from log_config import setup_logging
+from cassette import get_cassette
+from image_fingerprint import DescriptionCache, sha256_hex, dhash
 
 # 加载环境变量
 load_dotenv()
@@ -22,28 +25,8 @@ load_dotenv()
 # ------------------------------
 # 日志系统初始化
 # ------------------------------
-"""初始化日志配置，同时输出到文件和控制台"""
-# 日志目录（可根据需要修改）
-LOG_DIR = os.getenv("LOGS_PATH")
-os.makedirs(LOG_DIR, exist_ok=True)  # 确保日志目录存在
-
-# 日志文件名（按日期命名）
-log_filename = datetime.now().strftime("%Y-%m-%d") + "_genemi.log"
-log_filepath = os.path.join(LOG_DIR, log_filename)
-
-# 日志格式：时间 - 级别 - 模块:行号 - 消息
-log_format = "%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s"
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format=log_format,
-    handlers=[
-        logging.FileHandler(log_filepath, encoding="utf-8"),  # 输出到文件
-        logging.StreamHandler(sys.stdout)  # 输出到控制台
-    ]
-)
-logging.info("日志系统初始化完成，日志文件路径：%s", log_filepath)
+# 统一日志配置（队列异步写入、按时间和大小轮转）；被其他服务导入时沿用该服务已有的配置
+setup_logging("genemi")
 
 
 # ------------------------------
@@ -57,6 +40,10 @@ try:
     PROJECT_ID = os.getenv("PROJECT_ID")
     LOCATION = os.getenv("LOCATION")
     MODEL_NAME = os.getenv("MODEL_NAME")
+    # 修复（重新格式化）输出时使用的模型，默认与主模型相同，建议配置为更快更便宜的模型
+    REPAIR_MODEL_NAME = os.getenv("REPAIR_MODEL_NAME", MODEL_NAME)
+    # 对冲调用使用的模型，默认与主模型相同，建议配置为更快的模型（主调用过慢时才会使用）
+    HEDGE_MODEL_NAME = os.getenv("HEDGE_MODEL_NAME", MODEL_NAME)
 
     if not all([PROJECT_ID, LOCATION, MODEL_NAME]):
         raise ValueError("环境变量中未配置PROJECT_ID, LOCATION, 或 MODEL_NAME")
@@ -68,6 +55,10 @@ try:
     # 加载模型
     model = GenerativeModel(MODEL_NAME)
     logging.info("Gemini模型加载完成，使用模型：%s", MODEL_NAME)
+    repair_model = model if REPAIR_MODEL_NAME == MODEL_NAME else GenerativeModel(REPAIR_MODEL_NAME)
+    logging.info("Gemini修复模型加载完成，使用模型：%s", REPAIR_MODEL_NAME)
+    hedge_model = model if HEDGE_MODEL_NAME == MODEL_NAME else GenerativeModel(HEDGE_MODEL_NAME)
+    logging.info("Gemini对冲模型加载完成，使用模型：%s", HEDGE_MODEL_NAME)
 
 except Exception as e:
     logging.critical("Vertex AI 初始化失败：%s", str(e), exc_info=True)
@@ -134,15 +125,43 @@ ROLE_PROMPT = """# Role: 万能梗图提示词
 用户正在和你连接。用户的输入是：谜底是"""
 
 
+# 结构化输出模式下追加的输出格式说明（覆盖角色定义中的代码块格式要求）
+STRUCTURED_OUTPUT_INSTRUCTION = """
+
+## Output Format
+忽略上文中使用代码块包裹提示词的要求，直接输出一个 JSON 对象，包含以下字段：
+- answer: 谜底
+- zh_prompt: 中文【谜题截图提示词】
+- en_prompt: 英文【谜题截图提示词】
+- rationale: 【设计思路解析】
+"""
+
+# 修复模式提示词：只做格式整理，不重新创作
+REPAIR_PROMPT = """下面是一段梗图谜题设计文本，其格式不符合要求。请不要修改或重新创作任何内容，只将其整理为一个 JSON 对象，字段为：
+answer（谜底）、zh_prompt（中文谜题截图提示词）、en_prompt（英文谜题截图提示词）、rationale（设计思路解析）。
+如果缺少英文提示词，请将中文提示词忠实翻译为英文。
+
+待整理文本：
+"""
+
+# 结构化输出的生成配置
+STRUCTURED_GENERATION_CONFIG = GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=PROMPT_RESPONSE_SCHEMA,
+)
+
+
 # ------------------------------
 # 核心功能函数
 # ------------------------------
-def genemi_generate_api(prompt: str) -> Optional[str]:
+def genemi_generate_api(prompt: str, structured: bool = False, use_hedge_model: bool = False) -> Optional[str]:
     """
     调用Gemini API生成梗图提示词（根据谜底生成完整的文生图提示词）
     
     参数:
         prompt: 谜底内容（字符串）
+        structured: 是否使用结构化输出模式（返回符合 PROMPT_RESPONSE_SCHEMA 的 JSON 文本）
+        use_hedge_model: 是否使用对冲模型（HEDGE_MODEL_NAME）代替主模型
         
     返回:
         Optional[str]: 成功返回包含中英文提示词和设计思路的文本；失败返回None
@@ -151,42 +170,135 @@ def genemi_generate_api(prompt: str) -> Optional[str]:
         当API调用失败时会抛出异常，需上层捕获处理
     """
     logging.info("=" * 50)
-    logging.info("开始调用Gemini API生成提示词，谜底：%s", prompt)
+    logging.info("开始调用Gemini API生成提示词，谜底长度：%d字符，结构化输出：%s", len(prompt), structured)
+    logging.debug("谜底：%s", prompt)
     logging.info("=" * 50)
     
     try:
         # 拼接完整提示词（角色定义 + 用户输入谜底）
         full_prompt = f"{ROLE_PROMPT}{prompt}"
+        if structured:
+            full_prompt += STRUCTURED_OUTPUT_INSTRUCTION
         logging.debug("完整提示词长度：%d字符", len(full_prompt))
         
         # 调用Gemini API
-        logging.info("向Gemini API发送请求，模型：%s", MODEL_NAME)
-
-        # 核心改动：使用Vertex AI的API调用方式
-        response = model.generate_content(full_prompt)
+        model_name, generative_model = (HEDGE_MODEL_NAME, hedge_model) if use_hedge_model else (MODEL_NAME, model)
+        logging.info("向Gemini API发送请求，模型：%s", model_name)
+
+        # 核心改动：使用Vertex AI的API调用方式（经过录制/回放层，回放时不访问网络）
+        response_text = get_cassette().call(
+            "gemini",
+            {"model": model_name, "prompt": full_prompt, "structured": structured},
+            lambda: generative_model.generate_content(
+                full_prompt,
+                generation_config=STRUCTURED_GENERATION_CONFIG if structured else None,
+            ).text,
+        )
         
         # 处理响应
-        if response.text is None:
+        if response_text is None:
             logging.info("Gemini API返回空结果，可能是内容过滤导致")
             return None
             
-        logging.info("Gemini API响应成功，返回结果长度：%d字符", len(response.text))
-        return response.text
+        logging.info("Gemini API响应成功，返回结果长度：%d字符", len(response_text))
+        logging.debug("Gemini API返回结果：%s", response_text)
+        return response_text
             
     except Exception as e:
-        logging.info("Gemini API调用失败：%s", str(e), exc_info=True)
+        logging.error("Gemini API调用失败：%s", e, exc_info=True)
         raise  # 抛出异常，由上层决定处理方式
 
 
+def repair_prompt_response(raw_text: str) -> Optional[str]:
+    """
+    对格式不正确的Gemini响应做一次低成本的格式修复（只整理格式，不重新创作）
+    
+    参数:
+        raw_text: 无法解析的原始响应文本
+        
+    返回:
+        Optional[str]: 成功返回符合 PROMPT_RESPONSE_SCHEMA 的 JSON 文本；失败返回None
+        
+    异常:
+        当API调用失败时会抛出异常，需上层捕获处理
+    """
+    logging.info("开始修复Gemini响应格式，原始长度：%d字符，模型：%s", len(raw_text), REPAIR_MODEL_NAME)
+    
+    try:
+        # 与生成调用一样经过录制/回放层，回放时格式修复也不访问网络
+        repair_prompt = f"{REPAIR_PROMPT}{raw_text}"
+        response_text = get_cassette().call(
+            "gemini",
+            {"model": REPAIR_MODEL_NAME, "prompt": repair_prompt, "structured": True},
+            lambda: repair_model.generate_content(
+                repair_prompt,
+                generation_config=STRUCTURED_GENERATION_CONFIG,
+            ).text,
+        )
+        
+        if response_text is None:
+            logging.info("Gemini修复调用返回空结果")
+            return None
+            
+        logging.info("Gemini修复调用成功，返回结果长度：%d字符", len(response_text))
+        return response_text
+            
+    except Exception as e:
+        logging.error("Gemini修复调用失败：%s", e, exc_info=True)
+        raise
+
+
 # ------------------------------
 # 新增核心功能函数 (立体雕塑生成)
 # ------------------------------
+# 人物描述缓存：用户反复上传同一张头像或表情图时，按图片指纹复用视觉模型的分析结果
+figurine_description_cache = DescriptionCache(
+    int(os.getenv("FIGURINE_DESCRIPTION_CACHE_SIZE", "2048")),
+    int(os.getenv("FIGURINE_CACHE_MAX_DISTANCE", "3")),
+)
+
+
+def describe_character(uploaded_image_bytes: bytes) -> str:
+    """
+    使用多模态模型提取图片中人物的外貌特征；相同（SHA-256）或近似（dHash 汉明距离）的图片直接返回缓存的描述
+    
+    参数:
+        uploaded_image_bytes: 用户上传的图片的二进制数据
+        
+    返回:
+        str: 人物特征描述
+        
+    异常:
+        当API调用失败时会抛出异常，需上层捕获处理
+    """
+    sha256, phash = sha256_hex(uploaded_image_bytes), dhash(uploaded_image_bytes)
+    cached, match = figurine_description_cache.get(sha256, phash)
+    if cached is not None:
+        logging.info("图片指纹命中人物描述缓存（%s），跳过视觉模型调用", match)
+        return cached
+
+    logging.info("使用 Gemini Vision 模型分析图片...")
+    multimodal_model = GenerativeModel("gemini-pro-vision")
+    input_image = Image.from_bytes(uploaded_image_bytes)
+    
+    # 提示 Gemini Vision 提取关键外貌特征
+    analysis_prompt = "Describe the key visual features of the person in this image for a character designer. Focus on hair style and color, face shape, gender, and clothing style."
+    
+    response = multimodal_model.generate_content([analysis_prompt, input_image])
+    character_description = response.text
+    logging.info("图片分析完成，人物特征描述长度: %d字符", len(character_description or ""))
+    logging.debug("人物特征描述: %s", character_description)
+    if character_description:
+        figurine_description_cache.put(sha256, phash, character_description)
+    return character_description
+
+
 def generate_figurine_image(uploaded_image_bytes: bytes) -> Optional[bytes]:
     """
     接收上传的图片，使用Gemini生成手办图片。
     
     流程:
-    1. 使用多模态模型分析图片中的人物特征。
+    1. 使用多模态模型分析图片中的人物特征（相同或近似的图片复用缓存的描述）。
     2. 将特征描述与固定的手办提示词模板结合。
     3. 使用Imagen模型根据最终提示词生成图片。
 
@@ -201,17 +313,8 @@ def generate_figurine_image(uploaded_image_bytes: bytes) -> Optional[bytes]:
     logging.info("=" * 50)
 
     try:
-        # 步骤 1: 使用多模态模型分析图片
-        logging.info("步骤 1: 使用 Gemini Vision 模型分析图片...")
-        multimodal_model = GenerativeModel("gemini-pro-vision")
-        input_image = Image.from_bytes(uploaded_image_bytes)
-        
-        # 提示 Gemini Vision 提取关键外貌特征
-        analysis_prompt = "Describe the key visual features of the person in this image for a character designer. Focus on hair style and color, face shape, gender, and clothing style."
-        
-        response = multimodal_model.generate_content([analysis_prompt, input_image])
-        character_description = response.text
-        logging.info(f"图片分析完成，人物特征描述: {character_description}")
+        # 步骤 1: 使用多模态模型分析图片（相同或近似的图片复用缓存的人物描述）
+        character_description = describe_character(uploaded_image_bytes)
 
         # 步骤 2: 结合特征描述和固定模板，生成最终的生图Prompt
         logging.info("步骤 2: 构建最终的文生图提示词...")
@@ -223,7 +326,7 @@ def generate_figurine_image(uploaded_image_bytes: bytes) -> Optional[bytes]:
             "Next to the computer is a high-quality toy packaging box with 2D flat illustrations of the character."
         )
         final_prompt = base_prompt.format(description=character_description)
-        logging.info(f"最终提示词: {final_prompt}")
+        logging.debug("最终提示词: %s", final_prompt)
 
         # 步骤 3: 使用 Imagen 模型生成图片
         logging.info("步骤 3: 调用 Imagen 模型生成图片...")
@@ -247,7 +350,7 @@ def generate_figurine_image(uploaded_image_bytes: bytes) -> Optional[bytes]:
         return generated_image_bytes
 
     except Exception as e:
-        logging.error(f"立体雕塑生成流程失败: {e}", exc_info=True)
+        logging.error("立体雕塑生成流程失败: %s", e, exc_info=True)
         return None
 
 
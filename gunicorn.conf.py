@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+生产环境 gunicorn 配置（主后端与新加坡代理共用，通过环境变量区分）
+功能：替代 Werkzeug 开发服务器（app.run）
+    1. gthread 工作进程：每个进程一个线程池，请求在等待 Gemini / 即梦（60 秒以上）时只占用一个线程；
+       空闲的长连接由主循环管理，不占用线程；主循环独立发送心跳，长请求不会被 timeout 误杀
+    2. 预加载应用后 fork：导入、模型初始化只做一次，post_fork 中重建日志线程、数据库连接池和 HTTP 连接池
+    3. 平滑重启：SIGHUP / SIGTERM 时旧进程停止接收新请求，等待进行中的生成最多 graceful_timeout 秒
+    4. 工作进程处理 max_requests（加随机抖动）个请求后平滑回收，避免内存碎片持续增长
+启动：
+    gunicorn -c gunicorn.conf.py app:app
+    GUNICORN_BIND=0.0.0.0:5551 gunicorn -c gunicorn.conf.py singapore_gemini_server:app
+环境变量：GUNICORN_BIND、GUNICORN_WORKERS、GUNICORN_THREADS、GUNICORN_TIMEOUT、GUNICORN_GRACEFUL_TIMEOUT、
+    GUNICORN_KEEPALIVE、GUNICORN_MAX_REQUESTS、GUNICORN_MAX_REQUESTS_JITTER、GUNICORN_PRELOAD、GUNICORN_PIDFILE、
+    GUNICORN_ACCESS_LOG
+"""
+
+import os
+import sys
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5550")
+
+# 请求几乎都在等待上游，进程数只需覆盖 CPU（bcrypt、JSON 序列化），并发由线程数提供；
+# 线程数应大于准入控制的上游并发与排队上限之和（GEMINI_MAX_CONCURRENCY + ADMISSION_MAX_QUEUE 等），并为轮询接口留出余量。
+# 注意：准入控制（GEMINI_MAX_CONCURRENCY 等）和用户限流按进程计算，总并发 = 配置值 × 进程数
+worker_class = "gthread"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+
+# gthread 的 timeout 是工作进程心跳超时（进程卡死才会触发），与单个请求耗时无关
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# 一次生成最长约为准入排队 30 秒 + Gemini 60 秒 + 即梦 30 秒以上，重启时留足排空时间
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "180"))
+# 新加坡代理由主后端的连接池长期复用，应调大（如 75），避免空闲连接被提前关闭
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "200"))
+
+# 新加坡代理的 gRPC 客户端不支持在 fork 前初始化后跨进程使用，可设为 false 在每个工作进程中分别导入
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+pidfile = os.getenv("GUNICORN_PIDFILE") or None
+errorlog = "-"
+accesslog = os.getenv("GUNICORN_ACCESS_LOG") or None
+
+# fork 后需要重新初始化的应用模块（模块中定义了 reinit_after_fork(worker_count) 时调用）
+APP_MODULES = ("app", "singapore_gemini_server")
+
+
+def post_fork(server, worker):
+    """
+    在每个新工作进程中切换到本进程自己的日志文件，并重建 fork 前创建的后台线程和连接
+    （未预加载时应用尚未导入，只需要切换日志文件）
+    """
+    from log_config import reinit_logging_after_fork
+    reinit_logging_after_fork()
+    # 未预加载时应用在此之后才导入，按实际进程数创建只适用于单进程的组件（如用户版本号存储）
+    os.environ["WEB_CONCURRENCY"] = str(server.cfg.workers)
+    for name in APP_MODULES:
+        module = sys.modules.get(name)
+        if module is not None and hasattr(module, "reinit_after_fork"):
+            module.reinit_after_fork(server.cfg.workers)
+
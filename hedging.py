@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+对冲请求（hedged request）
+功能：削减上游调用的长尾延迟：主调用超过自适应阈值仍未返回时，再发出一个备用调用（可以使用更快的模型），
+      采用先返回的有效结果
+    1. 自适应阈值：最近 window 次主调用耗时的 percentile 分位数，限制在 [min_delay, max_delay] 之间；
+       样本不足 min_samples 时使用 initial_delay
+    2. 配额：令牌桶限制对冲比例：每个请求存入 max_ratio 个令牌（最多累积 burst 个），每次对冲消耗 1 个；
+       同时进行中的对冲调用不超过 max_inflight 个。上游整体变慢时对冲比例不会失控，调用量最多增加 max_ratio
+    3. 结果选择：先返回且通过 is_valid 校验的结果获胜；无效结果或异常不会获胜，继续等待另一个调用；
+       都失败时优先返回主调用的结果（无效结果由调用方自行处理，如格式修复），否则抛出主调用的异常
+    4. 落败的调用：同步 SDK 调用无法从外部中断，落败的调用在后台线程中自然结束，结果直接丢弃
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+
+
+class Hedger:
+    """
+    对冲调用器（线程安全，一个上游一个实例）
+
+    参数:
+        name: 上游名称，用于日志
+        percentile: 触发对冲的主调用耗时分位数
+        min_delay / max_delay: 对冲等待时间的上下限（秒）
+        initial_delay: 样本不足时的对冲等待时间（秒）
+        window: 参与计算分位数的最近主调用数量
+        min_samples: 开始使用自适应阈值所需的最少样本数
+        max_ratio: 对冲调用占请求数的最大比例
+        burst: 令牌桶容量（允许短时间内连续对冲的次数）
+        max_inflight: 同时进行中的对冲调用上限
+    """
+
+    def __init__(self, name: str, percentile: float = 0.95, min_delay: float = 2.0, max_delay: float = 30.0,
+                 initial_delay: float = 20.0, window: int = 200, min_samples: int = 20, max_ratio: float = 0.1,
+                 burst: float = 5.0, max_inflight: int = 8):
+        self.name = name
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.initial_delay = initial_delay
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.burst = burst
+        self.max_inflight = max_inflight
+        self._latencies = deque(maxlen=window)
+        self._tokens = burst
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self.counters = {
+            "requests": 0, "hedged": 0, "hedge_wins": 0, "primary_wins": 0, "no_valid_result": 0,
+            "denied_budget": 0, "denied_inflight": 0,
+        }
+
+    def hedge_delay(self) -> float:
+        """当前的对冲等待时间（秒）"""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < self.min_samples:
+            return self.initial_delay
+        index = min(len(samples) - 1, int(self.percentile * len(samples)))
+        return min(self.max_delay, max(self.min_delay, samples[index]))
+
+    def _try_acquire_hedge(self) -> bool:
+        with self._lock:
+            if self._inflight >= self.max_inflight:
+                self.counters["denied_inflight"] += 1
+                return False
+            if self._tokens < 1:
+                self.counters["denied_budget"] += 1
+                return False
+            self._tokens -= 1
+            self._inflight += 1
+            self.counters["hedged"] += 1
+            return True
+
+    def _run(self, label: str, func: Callable, results: queue.Queue) -> None:
+        start = time.perf_counter()
+        try:
+            value, error = func(), None
+        except Exception as e:
+            value, error = None, e
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if label == PRIMARY:
+                # 无论输赢都记录主调用的真实耗时，否则被对冲截断的慢调用会让阈值越来越低
+                self._latencies.append(elapsed)
+            else:
+                self._inflight -= 1
+        results.put((label, value, error, elapsed))
+
+    def call(self, primary: Callable, hedge: Optional[Callable] = None,
+             is_valid: Callable = lambda value: True):
+        """
+        执行一次对冲调用
+
+        参数:
+            primary: 主调用（无参函数）
+            hedge: 备用调用（无参函数），默认与主调用相同
+            is_valid: 判断结果能否获胜
+
+        返回:
+            获胜的结果；都无效时返回主调用的结果（主调用抛出异常时返回备用调用的结果）
+
+        异常:
+            两个调用都抛出异常时抛出主调用的异常（未对冲时即主调用的异常）
+        """
+        hedge = hedge or primary
+        with self._lock:
+            self.counters["requests"] += 1
+            self._tokens = min(self.burst, self._tokens + self.max_ratio)
+        results = queue.Queue()
+        threading.Thread(target=self._run, args=(PRIMARY, primary, results), name=f"{self.name}-primary",
+                         daemon=True).start()
+        delay = self.hedge_delay()
+        deadline = time.monotonic() + delay
+        pending, may_hedge, outcomes = 1, True, {}
+        while pending:
+            timeout = max(0.0, deadline - time.monotonic()) if may_hedge else None
+            try:
+                label, value, error, elapsed = results.get(timeout=timeout)
+            except queue.Empty:
+                may_hedge = False
+                if self._try_acquire_hedge():
+                    logging.info("%s 主调用 %.1f 秒未返回，发出对冲调用", self.name, delay)
+                    threading.Thread(target=self._run, args=(HEDGE, hedge, results), name=f"{self.name}-hedge",
+                                     daemon=True).start()
+                    pending += 1
+                continue
+            pending -= 1
+            if error is None and is_valid(value):
+                with self._lock:
+                    self.counters["hedge_wins" if label == HEDGE else "primary_wins"] += 1
+                if label == HEDGE:
+                    logging.info("%s 对冲调用获胜（耗时 %.1f 秒）", self.name, elapsed)
+                return value
+            outcomes[label] = (value, error)
+            # 主调用在对冲之前就结束（无效或失败）：不再对冲，交给调用方处理
+            may_hedge = False
+
+        with self._lock:
+            self.counters["no_valid_result"] += 1
+        for label in (PRIMARY, HEDGE):
+            value, error = outcomes.get(label, (None, None))
+            if label in outcomes and error is None:
+                return value
+        raise outcomes[PRIMARY][1]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["tokens"] = round(self._tokens, 2)
+            stats["inflight_hedges"] = self._inflight
+            stats["samples"] = len(self._latencies)
+        stats["hedge_delay_ms"] = round(self.hedge_delay() * 1000, 1)
+        stats["hedge_rate"] = round(stats["hedged"] / stats["requests"], 4) if stats["requests"] else 0.0
+        stats["hedge_win_rate"] = round(stats["hedge_wins"] / stats["hedged"], 4) if stats["hedged"] else 0.0
+        return stats
+
+
+def create_hedger_from_env(name: str) -> Optional[Hedger]:
+    """按 GEMINI_HEDGE_* 环境变量创建（时间单位为毫秒）；GEMINI_HEDGE_ENABLED=false 时返回 None"""
+    if os.getenv("GEMINI_HEDGE_ENABLED", "true").lower() != "true":
+        return None
+    return Hedger(
+        name,
+        percentile=float(os.getenv("GEMINI_HEDGE_PERCENTILE", "0.95")),
+        min_delay=int(os.getenv("GEMINI_HEDGE_MIN_DELAY_MS", "2000")) / 1000,
+        max_delay=int(os.getenv("GEMINI_HEDGE_MAX_DELAY_MS", "30000")) / 1000,
+        initial_delay=int(os.getenv("GEMINI_HEDGE_INITIAL_DELAY_MS", "20000")) / 1000,
+        window=int(os.getenv("GEMINI_HEDGE_WINDOW", "200")),
+        max_ratio=float(os.getenv("GEMINI_HEDGE_MAX_RATIO", "0.1")),
+        max_inflight=int(os.getenv("GEMINI_HEDGE_MAX_INFLIGHT", "8")),
+    )
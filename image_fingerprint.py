@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+上传图片指纹
+功能：识别重复上传的图片，复用已有的分析和生成结果
+    1. 精确指纹：文件内容的 SHA-256
+    2. 感知指纹：64 位差值哈希（dHash），重新压缩、缩放、轻微调色后基本不变，用汉明距离判断是否近似
+    3. 分段索引：64 位指纹拆成 4 段各 16 位；汉明距离不超过 3 的两个指纹至少有一段完全相同，
+       数据库只需对每段建普通索引，按段精确匹配取出少量候选再计算距离
+    4. 人物描述缓存：新加坡代理按指纹缓存视觉模型生成的人物描述，重复图片不再调用视觉模型
+"""
+
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+PHASH_BANDS = 4
+PHASH_BAND_BITS = 16
+
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(data: bytes, hash_size: int = 8) -> Optional[int]:
+    """
+    计算图片的差值哈希（无符号 64 位整数）
+
+    参数:
+        data: 图片文件内容
+        hash_size: 每行比较的次数，8 对应 64 位
+
+    返回:
+        Optional[int]: 差值哈希；无法解码为图片时返回 None
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image = ImageOps.exif_transpose(image).convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+            pixels = list(image.getdata())
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | int(pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def is_distinctive(phash: Optional[int]) -> bool:
+    """纯色、渐变等几乎没有细节的图片 dHash 接近全 0 或全 1，彼此都"近似"，不用于近似匹配"""
+    return phash is not None and 8 <= bin(phash).count("1") <= 56
+
+
+def phash_bands(phash: int) -> List[int]:
+    """把 64 位指纹拆成 PHASH_BANDS 段（从高位到低位）"""
+    mask = (1 << PHASH_BAND_BITS) - 1
+    return [(phash >> (PHASH_BAND_BITS * (PHASH_BANDS - 1 - i))) & mask for i in range(PHASH_BANDS)]
+
+
+def to_signed64(value: int) -> int:
+    """无符号 64 位整数转为有符号（数据库 BIGINT 只能保存有符号值）"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_signed64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+
+class DescriptionCache:
+    """
+    按图片指纹缓存文本结果的 LRU：先按 SHA-256 精确匹配，再在所有条目中找汉明距离不超过 max_distance 的近似图片。
+    条目数有上限（默认 2048），线性扫描的开销远小于一次视觉模型调用
+    """
+
+    def __init__(self, max_entries: int = 2048, max_distance: int = 3):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"exact_hits": 0, "near_hits": 0, "misses": 0}
+
+    def get(self, sha256: str, phash: Optional[int]) -> Tuple[Optional[str], Optional[str]]:
+        """返回 (缓存的文本, 命中方式 exact / near)；未命中时返回 (None, None)"""
+        with self._lock:
+            entry = self._entries.get(sha256)
+            if entry is not None:
+                self._entries.move_to_end(sha256)
+                self.stats["exact_hits"] += 1
+                return entry[1], "exact"
+            if is_distinctive(phash) and self.max_distance >= 0:
+                best_key, best_distance = None, self.max_distance + 1
+                for key, (other, _) in self._entries.items():
+                    distance = hamming(phash, other) if other is not None else best_distance
+                    if distance < best_distance:
+                        best_key, best_distance = key, distance
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.stats["near_hits"] += 1
+                    return self._entries[best_key][1], "near"
+            self.stats["misses"] += 1
+            return None, None
+
+    def put(self, sha256: str, phash: Optional[int], text: str) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[sha256] = (phash, text)
+            self._entries.move_to_end(sha256)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
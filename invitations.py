@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+邀请码批量发放、导入与导出
+功能：运营活动一次发放数十万个邀请码，不再逐条 INSERT
+    1. 生成：secrets 安全随机数，字母表去掉易混淆的 0/O、1/I/L、U，默认 12 位（约 59 位熵），可加活动前缀
+    2. 写入：PostgreSQL 用 COPY 写入临时表，再一条 INSERT ... SELECT ... ON CONFLICT (code) DO NOTHING 并入正式表；
+       其他数据库（如本地 SQLite）按批 executemany。与已有邀请码冲突的会被跳过，发放时重新生成补足数量
+    3. 导出：按 id 键集分页（每页一次索引范围扫描），逐行生成 CSV，不把全部结果读入内存，也不长时间占用事务
+    4. 兑换：code 上的唯一索引 + 一条带条件的 UPDATE，一次索引查找完成校验与占用，耗时与邀请码总数无关
+"""
+
+import io
+import csv
+import secrets
+import logging
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List, Optional
+
+from sqlalchemy import select, update, or_, text
+
+CODE_ALPHABET = "23456789ABCDEFGHJKMNPQRSTVWXYZ"
+CODE_MAX_LENGTH = 20
+EXPORT_COLUMNS = ["code", "campaign", "expires_at", "is_used", "used_by_user_id", "created_at"]
+
+
+def generate_codes(count: int, length: int = 12, prefix: str = "") -> List[str]:
+    """
+    生成 count 个互不相同的随机邀请码
+
+    参数:
+        count: 数量
+        length: 随机部分长度
+        prefix: 前缀（如活动代号），与随机部分合计不超过 CODE_MAX_LENGTH
+
+    返回:
+        List[str]: 邀请码列表
+
+    异常:
+        ValueError: 长度超出限制或随机部分过短
+    """
+    if length < 8:
+        raise ValueError("邀请码随机部分至少 8 位")
+    if len(prefix) + length > CODE_MAX_LENGTH:
+        raise ValueError(f"邀请码总长度不能超过 {CODE_MAX_LENGTH}")
+    codes = set()
+    while len(codes) < count:
+        codes.add(prefix + "".join(secrets.choice(CODE_ALPHABET) for _ in range(length)))
+    return list(codes)
+
+
+def read_codes(lines: Iterable[str]) -> Iterator[str]:
+    """
+    从文本逐行读取待导入的邀请码：每行一个，或 CSV 的第一列；忽略空行、表头和 # 开头的注释
+
+    异常:
+        ValueError: 邀请码超过 CODE_MAX_LENGTH
+    """
+    for line_number, line in enumerate(lines, 1):
+        code = line.split(",", 1)[0].strip()
+        if not code or code.startswith("#") or (line_number == 1 and code.lower() == "code"):
+            continue
+        if len(code) > CODE_MAX_LENGTH:
+            raise ValueError(f"第 {line_number} 行邀请码超过 {CODE_MAX_LENGTH} 个字符：{code}")
+        yield code
+
+
+class InvitationCodeLoader:
+    """
+    把邀请码批量写入 invitation_codes 表
+
+    参数:
+        engine: SQLAlchemy 引擎
+        table: 邀请码表（InvitationCode.__table__）
+        batch_size: 每批（每个事务）写入的数量
+    """
+
+    def __init__(self, engine, table, batch_size: int = 10000):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+
+    @property
+    def uses_copy(self) -> bool:
+        return self.engine.dialect.name == "postgresql"
+
+    def load(self, codes: Iterable[str], campaign: Optional[str] = None,
+             expires_at: Optional[datetime] = None) -> dict:
+        """
+        写入邀请码，已存在的跳过
+
+        返回:
+            dict: {"inserted": 写入数量, "skipped": 已存在而跳过的数量}
+        """
+        inserted = skipped = 0
+        batch = []
+        for code in codes:
+            batch.append(code)
+            if len(batch) >= self.batch_size:
+                count = self._load_batch(batch, campaign, expires_at)
+                inserted, skipped = inserted + count, skipped + len(batch) - count
+                batch = []
+        if batch:
+            count = self._load_batch(batch, campaign, expires_at)
+            inserted, skipped = inserted + count, skipped + len(batch) - count
+        return {"inserted": inserted, "skipped": skipped}
+
+    def issue(self, count: int, campaign: Optional[str] = None, expires_at: Optional[datetime] = None,
+              length: int = 12, prefix: str = "") -> int:
+        """
+        生成并写入 count 个新邀请码；与已有邀请码冲突的部分重新生成，直到凑满
+
+        返回:
+            int: 写入数量（等于 count）
+        """
+        issued = 0
+        while issued < count:
+            batch = generate_codes(min(self.batch_size, count - issued), length, prefix)
+            issued += self._load_batch(batch, campaign, expires_at)
+            logging.info("已发放邀请码 %d / %d（活动 %s）", issued, count, campaign)
+        return issued
+
+    def _load_batch(self, codes: List[str], campaign: Optional[str], expires_at: Optional[datetime]) -> int:
+        """在一个事务中写入一批邀请码，返回实际写入的数量"""
+        now = datetime.now(timezone.utc)
+        with self.engine.begin() as connection:
+            if self.uses_copy:
+                return self._copy_batch(connection, codes, campaign, expires_at, now)
+            existing = set(connection.execute(
+                select(self.table.c.code).where(self.table.c.code.in_(codes))
+            ).scalars())
+            rows = [
+                {"code": code, "campaign": campaign, "expires_at": expires_at, "is_used": False, "created_at": now}
+                for code in dict.fromkeys(codes) if code not in existing
+            ]
+            if rows:
+                connection.execute(self.table.insert(), rows)
+            return len(rows)
+
+    def _copy_batch(self, connection, codes, campaign, expires_at, now) -> int:
+        """COPY 到事务结束即删除的临时表，再整体并入正式表（一次往返写入整批，不逐行解析 INSERT）"""
+        buffer = io.StringIO("".join(f"{code}\n" for code in codes))
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute("CREATE TEMP TABLE invitation_codes_staging (code VARCHAR(20) NOT NULL) ON COMMIT DROP")
+            cursor.copy_expert("COPY invitation_codes_staging (code) FROM STDIN", buffer)
+        finally:
+            cursor.close()
+        result = connection.execute(text(
+            f"INSERT INTO {self.table.name} (code, campaign, expires_at, is_used, created_at) "
+            "SELECT DISTINCT code, :campaign, :expires_at, FALSE, :now FROM invitation_codes_staging "
+            "ON CONFLICT (code) DO NOTHING"
+        ), {"campaign": campaign, "expires_at": expires_at, "now": now})
+        return result.rowcount
+
+
+def export_codes(session, model, campaign: Optional[str] = None, status: str = "all",
+                 page_size: int = 5000) -> Iterator[str]:
+    """
+    以 CSV 文本行的形式流式导出邀请码（第一行为表头）
+
+    参数:
+        session: 数据库会话
+        model: InvitationCode 模型
+        campaign: 只导出该活动的邀请码；为 None 时导出全部
+        status: all / unused（未使用且未过期）/ used
+        page_size: 每页读取的数量
+
+    返回:
+        Iterator[str]: CSV 行
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush() -> str:
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    writer.writerow(EXPORT_COLUMNS)
+    yield flush()
+    query = select(*(getattr(model, column) for column in ["id"] + EXPORT_COLUMNS)).order_by(model.id)
+    if campaign is not None:
+        query = query.where(model.campaign == campaign)
+    if status == "unused":
+        query = query.where(model.is_used.is_(False),
+                            or_(model.expires_at.is_(None), model.expires_at > datetime.now(timezone.utc)))
+    elif status == "used":
+        query = query.where(model.is_used.is_(True))
+    last_id = 0
+    while True:
+        rows = session.execute(query.where(model.id > last_id).limit(page_size)).all()
+        if not rows:
+            break
+        for row in rows:
+            writer.writerow([value.isoformat() if isinstance(value, datetime) else value for value in row[1:]])
+        last_id = rows[-1].id
+        # 每页结束后释放连接，导出期间不长时间占用事务
+        session.rollback()
+        yield flush()
+
+
+def redeem_code(session, model, code: str, user_id: int) -> bool:
+    """
+    占用邀请码：一条带条件的 UPDATE（未使用且未过期），走 code 的唯一索引；并发注册同一邀请码时只有一个成功。
+    调用方负责提交事务
+
+    返回:
+        bool: 是否占用成功
+    """
+    result = session.execute(
+        update(model)
+        .where(model.code == code, model.is_used.is_(False),
+               or_(model.expires_at.is_(None), model.expires_at > datetime.now(timezone.utc)))
+        .values(is_used=True, used_by_user_id=user_id)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
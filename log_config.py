@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+统一日志配置
+功能：替代各模块各自的 logging.basicConfig，供主后端、新加坡代理和 API 工具模块共用
+    1. 请求线程只把日志记录放入有界队列，由后台线程写文件，磁盘 I/O 不占用请求耗时；队列满时丢弃并计数
+    2. 日志文件按时间（默认每天午夜）和大小（默认 100MB）轮转，只保留最近 LOG_BACKUP_COUNT 个
+    3. 文件中每行一条 JSON 记录（时间、级别、分类、位置、trace_id、消息），控制台输出可读文本
+    4. 按分类（命名 logger 的名称，根 logger 的记录使用模块名）设置级别；INFO 及以下的高频日志可按分类
+       或采样键（extra={"sample_key": ...}）抽样输出
+    5. gunicorn 预加载应用后 fork 出的工作进程通过 reinit_logging_after_fork 重新启动后台写日志线程
+    6. 多进程部署时每个工作进程写自己的 <service>.<pid>.log：轮转通过重命名文件完成，无法在进程之间协调，
+       多个进程轮转同一个文件会互相改名，日志丢失或被拆散到不同文件
+环境变量：LOGS_PATH、LOG_LEVEL、LOG_LEVELS（如 "jimeng_api=WARNING,werkzeug=WARNING"）、
+    LOG_SAMPLE_RATES（如 "poll=0.01,jimeng_api=0.2"）、LOG_MAX_BYTES、LOG_ROTATE_WHEN、LOG_BACKUP_COUNT、
+    LOG_QUEUE_SIZE、LOG_CONSOLE
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from typing import Optional
+
+from tracing import get_tracer
+
+# 轮询接口等高频日志使用的采样键：logging.info("...", extra=SAMPLE_POLL)
+SAMPLE_POLL = {"sample_key": "poll"}
+
+_listener = None
+_queue_handler = None
+_service = None
+# reinit_logging_after_fork 调用过（本进程是 fork 出的工作进程）时，日志文件名带上进程号
+_per_process_files = False
+_setup_lock = threading.Lock()
+
+
+def _parse_mapping(value: str, cast) -> dict:
+    """解析 "a=1,b=2" 形式的配置"""
+    result = {}
+    for item in (value or "").split(","):
+        key, sep, raw = item.partition("=")
+        if sep and key.strip():
+            result[key.strip()] = cast(raw.strip())
+    return result
+
+
+def record_category(record: logging.LogRecord) -> str:
+    """日志分类：命名 logger 使用其名称，根 logger 的记录使用模块名"""
+    return record.module if record.name == "root" else record.name
+
+
+class SizedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """按时间轮转，同时在单个文件超过 max_bytes 时提前轮转"""
+
+    def __init__(self, filename: str, max_bytes: int, **kwargs):
+        super().__init__(filename, encoding="utf-8", **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record) -> int:
+        if super().shouldRollover(record):
+            return 1
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, 2)
+            return int(self.stream.tell() >= self.max_bytes)
+        return 0
+
+    def rotation_filename(self, default_name: str) -> str:
+        # 同一时间段内因大小提前轮转时，在文件名后追加序号，避免覆盖
+        name, index = default_name, 1
+        while os.path.exists(name):
+            name = f"{default_name}.{index}"
+            index += 1
+        return name
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "category": record_category(record),
+            "location": f"{record.module}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class CategoryFilter(logging.Filter):
+    """按分类过滤级别，并对 INFO 及以下的记录按分类或采样键抽样；同时附加当前 trace_id"""
+
+    def __init__(self, default_level: int, levels: dict, sample_rates: dict):
+        super().__init__()
+        self.default_level = default_level
+        self.levels = levels
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = record_category(record)
+        if record.levelno < self.levels.get(category, self.default_level):
+            return False
+        if record.levelno <= logging.INFO and self.sample_rates:
+            rate = self.sample_rates.get(getattr(record, "sample_key", None), self.sample_rates.get(category, 1.0))
+            if rate < 1.0 and random.random() >= rate:
+                return False
+        span = get_tracer().current_span()
+        record.trace_id = span.context.trace_id if span is not None else None
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """队列已满时直接丢弃日志并计数，而不是阻塞请求线程"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._last_report = time.monotonic()
+
+    def prepare(self, record):
+        """请求线程中只合并消息参数、把异常堆栈转为文本，格式化和写文件都留给后台线程"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            now = time.monotonic()
+            if now - self._last_report > 60:
+                self._last_report = now
+                sys.stderr.write(f"日志队列已满，累计丢弃 {self.dropped} 条日志\n")
+
+
+def _create_file_handler(service: str) -> SizedTimedRotatingFileHandler:
+    """创建写 LOGS_PATH/<service>.log 的轮转文件处理器；工作进程中为 <service>.<pid>.log"""
+    log_dir = os.getenv("LOGS_PATH", "./logs")
+    os.makedirs(log_dir, exist_ok=True)
+    filename = f"{service}.{os.getpid()}.log" if _per_process_files else f"{service}.log"
+    file_handler = SizedTimedRotatingFileHandler(
+        os.path.join(log_dir, filename),
+        max_bytes=int(os.getenv("LOG_MAX_BYTES", str(100 * 1024 * 1024))),
+        when=os.getenv("LOG_ROTATE_WHEN", "midnight"),
+        backupCount=int(os.getenv("LOG_BACKUP_COUNT", "14")),
+    )
+    file_handler.setFormatter(JsonFormatter())
+    return file_handler
+
+
+def setup_logging(service: str) -> Optional[QueueListener]:
+    """
+    为当前进程配置日志（只有第一次调用生效，之后的调用直接返回）
+
+    参数:
+        service: 服务名，决定日志文件名（LOGS_PATH/<service>.log）
+
+    返回:
+        QueueListener: 后台写日志的监听器；进程退出时自动停止并写完队列中的日志
+    """
+    global _listener, _queue_handler, _service
+    with _setup_lock:
+        if _listener is not None:
+            return _listener
+
+        _service = service
+        handlers = [_create_file_handler(service)]
+        if os.getenv("LOG_CONSOLE", "true").lower() == "true":
+            console_handler = logging.StreamHandler(sys.stdout)
+            console_handler.setFormatter(
+                logging.Formatter("%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s")
+            )
+            handlers.append(console_handler)
+
+        default_level = logging.getLevelName(os.getenv("LOG_LEVEL", "INFO").upper())
+        levels = {
+            category: logging.getLevelName(level.upper())
+            for category, level in _parse_mapping(os.getenv("LOG_LEVELS", ""), str).items()
+        }
+        levels = {category: level for category, level in levels.items() if isinstance(level, int)}
+
+        queue_handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000"))))
+        queue_handler.addFilter(CategoryFilter(
+            default_level, levels, _parse_mapping(os.getenv("LOG_SAMPLE_RATES", "poll=0.01"), float),
+        ))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        _queue_handler = queue_handler
+        # 根 logger 取所有级别中最低的一个，具体分类的级别由 CategoryFilter 判断
+        root.setLevel(min([default_level, *levels.values()]))
+
+        _listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+        return _listener
+
+
+def reinit_logging_after_fork() -> None:
+    """
+    在 fork 出的工作进程（如 gunicorn 的 post_fork）中调用，预加载与否都需要：
+    之后的日志写入本进程自己的 <service>.<pid>.log，各进程分别轮转自己的文件。
+    预加载时后台写日志的线程不会随 fork 复制到子进程，还需要换一个新队列并重新启动监听器，否则日志只进不出；
+    未预加载时应用尚未导入，之后的 setup_logging 直接使用带进程号的文件名
+    """
+    global _listener, _per_process_files
+    with _setup_lock:
+        _per_process_files = True
+        if _listener is None:
+            return
+        old_listener = _listener
+        atexit.unregister(old_listener.stop)
+        handlers = []
+        for handler in old_listener.handlers:
+            if isinstance(handler, SizedTimedRotatingFileHandler):
+                # 只关闭子进程继承的文件描述符；主进程的文件和轮转不受影响
+                handler.close()
+                handler = _create_file_handler(_service)
+            handlers.append(handler)
+        _queue_handler.queue = queue.Queue(maxsize=old_listener.queue.maxsize)
+        _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+分阶段的生成流水线
+功能：一次生成由若干声明好的阶段（如 prompt → image → store → finalize）依次完成，各阶段独立配置：
+    1. 并发：阶段可以绑定一个上游并发预算（admission.UpstreamBudget），超出部分按优先级、按用户公平排队
+    2. 超时：阶段在调用方线程中执行，超时由阶段函数内上游调用自身的超时（HTTP 超时、任务等待时间）保证；
+       不另开线程限时，超时失败后不会有仍在后台运行、共用请求数据库会话或继续写入文件的阶段
+    3. 重试：RetryPolicy 指定最多尝试次数、退避时间和可重试的异常类型
+    4. 观测：每个阶段记录一个 stage.<名称> Span，完成后回调 on_stage_done(上下文, 阶段名, 耗时毫秒)
+    5. 检查点：checkpoint=True 的阶段完成后记入 ctx.completed 并回调 on_checkpoint(上下文) 持久化；
+       从检查点恢复的上下文跳过已完成的阶段，重试只从失败的阶段继续，不重复已完成的上游调用
+环境变量（按流水线和阶段名，如 PIPELINE_MEME_IMAGE_ATTEMPTS）：
+    PIPELINE_<流水线>_<阶段>_ATTEMPTS（默认 1）、_BACKOFF_SECONDS（默认 1）
+"""
+
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from admission import PRIORITY_NORMAL
+from tracing import get_tracer
+
+
+@dataclass
+class RetryPolicy:
+    attempts: int = 1
+    backoff: float = 1.0
+    retry_on: tuple = ()
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        return attempt < self.attempts and isinstance(error, self.retry_on)
+
+
+@dataclass
+class GenerationContext:
+    """一次生成在各阶段之间传递的状态"""
+    endpoint: str
+    user_id: int
+    generation_id: Optional[int] = None
+    priority: int = PRIORITY_NORMAL
+    # 请求参数（只读）与各阶段的产出
+    inputs: dict = field(default_factory=dict)
+    outputs: dict = field(default_factory=dict)
+    # 失败时需要删除的临时文件
+    temp_paths: list = field(default_factory=list)
+    timings: dict = field(default_factory=dict)
+    # 已完成并保存了检查点的阶段（从检查点恢复时跳过）
+    completed: list = field(default_factory=list)
+    started: float = field(default_factory=time.perf_counter)
+    failed_stage: Optional[str] = None
+    # 结果已提交（生成记录已完成、额度已扣除）；之后的阶段失败不能再把记录标记为失败
+    committed: bool = False
+    response: object = None
+
+
+class Stage:
+    """
+    流水线的一个阶段
+
+    参数:
+        name: 阶段名
+        run: 阶段函数，接收 GenerationContext，把结果写入 ctx.outputs
+        budget: 上游并发预算；为 None 时不限制并发
+        retry: 重试策略
+        checkpoint: 完成后是否保存检查点（产出需可 JSON 序列化）；提交最终结果或构造响应的阶段应为 False
+    """
+
+    def __init__(self, name: str, run: Callable, budget=None, retry: Optional[RetryPolicy] = None,
+                 checkpoint: bool = True):
+        self.name = name
+        self.checkpoint = checkpoint
+        self.run = run
+        self.budget = budget
+        self.retry = retry or RetryPolicy()
+
+    @classmethod
+    def from_env(cls, pipeline: str, name: str, run: Callable, budget=None, retry_on: tuple = (),
+                 checkpoint: bool = True) -> "Stage":
+        """按 PIPELINE_<流水线>_<阶段>_* 环境变量创建阶段"""
+        prefix = f"PIPELINE_{pipeline}_{name}_".upper()
+        retry = RetryPolicy(
+            attempts=int(os.getenv(f"{prefix}ATTEMPTS", "1")),
+            backoff=float(os.getenv(f"{prefix}BACKOFF_SECONDS", "1")),
+            retry_on=retry_on,
+        )
+        return cls(name, run, budget=budget, retry=retry, checkpoint=checkpoint)
+
+    def execute(self, ctx: GenerationContext) -> None:
+        """执行一次（有并发预算时占用一个槽位）"""
+        if self.budget is None:
+            self.run(ctx)
+            return
+        with self.budget.slot(ctx.user_id, ctx.priority):
+            self.run(ctx)
+
+
+class Pipeline:
+    """
+    按顺序执行各阶段；任一阶段最终失败时记录 ctx.failed_stage 并抛出该阶段的异常
+
+    参数:
+        name: 流水线名
+        stages: 阶段列表
+        on_stage_done: 阶段成功后的回调 (上下文, 阶段名, 耗时毫秒)
+        on_checkpoint: 保存检查点的回调 (上下文)
+    """
+
+    def __init__(self, name: str, stages: list, on_stage_done: Optional[Callable] = None,
+                 on_checkpoint: Optional[Callable] = None):
+        self.name = name
+        self.stages = stages
+        self.on_stage_done = on_stage_done
+        self.on_checkpoint = on_checkpoint
+
+    def run(self, ctx: GenerationContext) -> GenerationContext:
+        for stage in self.stages:
+            if stage.name in ctx.completed:
+                logging.info("流水线 %s 阶段 %s 已有检查点，跳过", self.name, stage.name)
+                continue
+            self._run_stage(stage, ctx)
+            if stage.checkpoint:
+                ctx.completed.append(stage.name)
+                if self.on_checkpoint is not None:
+                    self.on_checkpoint(ctx)
+        return ctx
+
+    def _run_stage(self, stage: Stage, ctx: GenerationContext) -> None:
+        tracer = get_tracer()
+        attempt = 0
+        while True:
+            attempt += 1
+            start = time.perf_counter()
+            try:
+                with tracer.span(f"stage.{stage.name}", pipeline=self.name, attempt=attempt):
+                    stage.execute(ctx)
+            except Exception as e:
+                if not stage.retry.should_retry(e, attempt):
+                    ctx.failed_stage = stage.name
+                    raise
+                delay = stage.retry.backoff * 2 ** (attempt - 1)
+                logging.warning("流水线 %s 阶段 %s 第 %d 次失败（%s），%.1f 秒后重试", self.name, stage.name, attempt, e, delay)
+                time.sleep(delay)
+                continue
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            ctx.timings[stage.name] = round(elapsed_ms, 1)
+            if self.on_stage_done is not None:
+                self.on_stage_done(ctx, stage.name, elapsed_ms)
+            return
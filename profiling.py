@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+按需请求采样分析
+功能：定位生产环境中个别慢请求的 CPU / 等待时间分布，默认关闭
+    1. 触发方式：请求头 X-Profile 或查询参数 profile 等于 PROFILE_TOKEN；或按 PROFILE_SAMPLE_RATE 随机抽样；
+       应用也可以传入自定义的授权判断（如主后端的管理员用户）
+    2. 采样线程只在有请求被分析时运行，每隔 PROFILE_INTERVAL_MS 毫秒读取被分析线程的调用栈，
+       汇总为火焰图折叠格式（"根;调用者;被调用者 次数"，可直接导入 speedscope 或 flamegraph.pl）
+    3. 结果写入 PROFILES_PATH 目录（默认 LOGS_PATH/profiles/<服务名>），多个工作进程共用；
+       最多保留 PROFILE_MAX_FILES 个（环形缓冲，最旧的先删除）
+    4. 未启用时不挂载任何钩子；启用后未被分析的请求只多一次请求头和查询参数的判断
+环境变量：PROFILE_TOKEN、PROFILE_SAMPLE_RATE（默认 0）、PROFILE_INTERVAL_MS（默认 5）、PROFILES_PATH、PROFILE_MAX_FILES
+"""
+
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Optional
+from urllib.parse import urlencode
+
+from tracing import get_tracer
+
+MAX_STACK_DEPTH = 128
+
+
+def fold_stack(frame) -> str:
+    """把调用栈转换为折叠格式：从最外层到当前帧，以分号连接"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """按固定间隔采样指定线程的调用栈；没有被采样的线程时后台线程自动退出"""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, thread_id: int) -> Counter:
+        """开始采样线程 thread_id，返回累计各调用栈采样次数的 Counter"""
+        stacks = Counter()
+        with self._lock:
+            self._targets[thread_id] = stacks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+                self._thread.start()
+        return stacks
+
+    def stop(self, thread_id: int) -> None:
+        with self._lock:
+            self._targets.pop(thread_id, None)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if not self._targets:
+                    self._thread = None
+                    return
+                targets = list(self._targets.items())
+            frames = sys._current_frames()
+            for thread_id, stacks in targets:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[fold_stack(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class ProfileStore:
+    """磁盘上的环形缓冲：每个分析结果一个 JSON 文件，文件名按时间排序，超过 max_files 时删除最旧的"""
+
+    def __init__(self, directory: str, max_files: int = 200):
+        self.directory = directory
+        self.max_files = max_files
+        self._lock = threading.Lock()
+
+    def _files(self) -> list:
+        try:
+            return sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+        except FileNotFoundError:
+            return []
+
+    def save(self, profile: dict) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{profile['id']}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+        with self._lock:
+            for name in self._files()[:-self.max_files or None]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass  # 其他工作进程已删除
+
+    def recent(self, limit: int = 50) -> list:
+        """最近的分析结果摘要（不含调用栈），按时间倒序"""
+        summaries = []
+        for name in reversed(self._files()):
+            if len(summaries) >= limit:
+                break
+            profile = self.get(name[:-len(".json")])
+            if profile is not None:
+                profile.pop("stacks", None)
+                summaries.append(profile)
+        return summaries
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        if os.path.basename(profile_id) != profile_id:
+            return None
+        try:
+            with open(os.path.join(self.directory, f"{profile_id}.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+class RequestProfiler:
+    """决定哪些请求需要分析，并保存分析结果"""
+
+    def __init__(self, service: str, store: ProfileStore, token: Optional[str] = None, sample_rate: float = 0.0,
+                 interval: float = 0.005):
+        self.service = service
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_rate
+        self.sampler = StackSampler(interval)
+        self.authorize = None
+        self.enabled = bool(token) or sample_rate > 0
+
+    def token_matches(self, value: Optional[str]) -> bool:
+        return bool(self.token and value and hmac.compare_digest(value, self.token))
+
+    def should_profile(self, request) -> Optional[str]:
+        """返回触发原因（token / admin / sampled），不需要分析时返回 None"""
+        flag = request.headers.get("X-Profile") or request.args.get("profile")
+        if flag:
+            if self.token_matches(flag):
+                return "token"
+            if self.authorize is not None and self.authorize():
+                return "admin"
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        return None
+
+
+def create_profiler_from_env(service: str, authorize: Optional[Callable[[], bool]] = None) -> RequestProfiler:
+    """
+    按环境变量创建请求分析器
+
+    参数:
+        service: 服务名，记录在分析结果中
+        authorize: 可选的授权判断；请求带有 X-Profile / profile 标记且返回 True 时分析该请求（设置后即启用）
+    """
+    default_path = os.path.join(os.getenv("LOGS_PATH", "./logs"), "profiles", service)
+    profiler = RequestProfiler(
+        service,
+        ProfileStore(os.getenv("PROFILES_PATH", default_path), int(os.getenv("PROFILE_MAX_FILES", "200"))),
+        token=os.getenv("PROFILE_TOKEN") or None,
+        sample_rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+        interval=int(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000,
+    )
+    if authorize is not None:
+        profiler.authorize = authorize
+        profiler.enabled = True
+    return profiler
+
+
+def profiled_path(request) -> str:
+    """记录在分析结果中的请求路径：去掉 profile 查询参数（其值可能是 PROFILE_TOKEN），保留其余参数"""
+    args = [(key, value) for key, value in request.args.items(multi=True) if key != "profile"]
+    return f"{request.path}?{urlencode(args)}" if args else request.path
+
+
+def instrument_profiling(app, profiler: RequestProfiler) -> None:
+    """为 Flask 应用挂载按需分析：被分析的请求在响应头 X-Profile-Id 中返回分析结果 ID"""
+    from flask import g, request
+
+    if not profiler.enabled:
+        return
+
+    @app.before_request
+    def start_profile():
+        reason = profiler.should_profile(request)
+        if reason is None:
+            return
+        g.profile = {
+            "id": f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}",
+            "reason": reason,
+            "thread_id": threading.get_ident(),
+            "started": time.perf_counter(),
+            "cpu_started": time.thread_time(),
+            "stacks": profiler.sampler.start(threading.get_ident()),
+        }
+
+    @app.after_request
+    def record_profile_id(response):
+        profile = g.get("profile")
+        if profile is not None:
+            profile["status_code"] = response.status_code
+            response.headers["X-Profile-Id"] = profile["id"]
+        return response
+
+    @app.teardown_request
+    def save_profile(exc):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        profiler.sampler.stop(profile["thread_id"])
+        root = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+        span = get_tracer().current_span()
+        stacks = profile["stacks"]
+        try:
+            profiler.store.save({
+                "id": profile["id"],
+                "service": profiler.service,
+                "request": root,
+                "path": profiled_path(request),
+                "reason": profile["reason"],
+                "status_code": profile.get("status_code", 500),
+                "error": f"{type(exc).__name__}: {exc}" if exc is not None else None,
+                "trace_id": span.context.trace_id if span is not None else None,
+                "created_at": time.time(),
+                "wall_ms": round((time.perf_counter() - profile["started"]) * 1000, 3),
+                "cpu_ms": round((time.thread_time() - profile["cpu_started"]) * 1000, 3),
+                "interval_ms": profiler.sampler.interval * 1000,
+                "samples": sum(stacks.values()),
+                "stacks": {f"{root};{stack}": count for stack, count in stacks.most_common()},
+            })
+        except OSError as e:
+            logging.warning("保存请求分析结果失败：%s", e)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Gemini 梗图提示词解析工具
+功能：统一解析 Gemini 返回的提示词文本，供主后端（app.py）和新加坡代理（singapore_gemini_server.py）共用
+支持两种格式：
+    1. 结构化输出（JSON 对象：answer / zh_prompt / en_prompt / rationale）
+    2. 旧版自由文本（两个 ```json 代码块，依次为英文、中文提示词）
+"""
+
+import re
+import json
+from typing import Optional
+
+# 旧版自由文本中包裹提示词的代码块（兼容 ```json / ```JSON / 无语言标记）
+PROMPT_PATTERN = r'```(?:json)?\s*(.*?)```'
+
+# 旧版自由文本中以括号包裹的谜底，如 "(苹果)" 或 "（苹果）"
+ANSWER_PATTERN = r'[(（]\s*([^()（）\n]{1,50}?)\s*[)）]'
+
+# 结构化输出的字段
+PROMPT_FIELDS = ("answer", "zh_prompt", "en_prompt", "rationale")
+
+# 模型偶尔会使用的同义字段名
+FIELD_ALIASES = {
+    "chinese_prompt": "zh_prompt",
+    "english_prompt": "en_prompt",
+    "design_rationale": "rationale",
+}
+
+# Vertex AI 结构化输出的 response_schema（OpenAPI 子集）
+PROMPT_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "answer": {"type": "string", "description": "谜底"},
+        "zh_prompt": {"type": "string", "description": "中文谜题截图提示词"},
+        "en_prompt": {"type": "string", "description": "英文谜题截图提示词"},
+        "rationale": {"type": "string", "description": "设计思路解析"},
+    },
+    "required": ["answer", "zh_prompt", "en_prompt", "rationale"],
+}
+
+
+class PromptParseError(ValueError):
+    """Gemini 响应无法解析为提示词时抛出"""
+
+
+def _validate_fields(data: dict) -> dict:
+    """
+    校验并规范化结构化字段
+
+    参数:
+        data: 从 JSON 解析出的字典
+
+    返回:
+        dict: 包含 PROMPT_FIELDS 全部字段的字典（字符串已去除首尾空白）
+
+    异常:
+        PromptParseError: 缺少中文或英文提示词时抛出
+    """
+    normalized = {}
+    for key, value in data.items():
+        normalized[FIELD_ALIASES.get(key, key)] = value
+
+    result = {}
+    for field in PROMPT_FIELDS:
+        value = normalized.get(field)
+        result[field] = value.strip() if isinstance(value, str) else ""
+
+    if not result["zh_prompt"] or not result["en_prompt"]:
+        raise PromptParseError("结构化输出缺少 zh_prompt 或 en_prompt 字段")
+    return result
+
+
+def _parse_json(text: str) -> Optional[dict]:
+    """尝试把整段文本（或唯一的代码块）解析为 JSON 对象，失败返回 None"""
+    candidate = text.strip()
+    if candidate.startswith("```"):
+        blocks = re.findall(PROMPT_PATTERN, candidate, re.DOTALL | re.IGNORECASE)
+        if len(blocks) != 1:
+            return None
+        candidate = blocks[0].strip()
+
+    try:
+        data = json.loads(candidate)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _parse_fenced_blocks(text: str) -> dict:
+    """解析旧版自由文本格式：第一个代码块为英文提示词，第二个为中文提示词"""
+    matches = re.findall(PROMPT_PATTERN, text, re.DOTALL | re.IGNORECASE)
+    if len(matches) < 2:
+        raise PromptParseError(f"只找到 {len(matches)} 个提示词代码块，至少需要 2 个")
+
+    answer_match = re.search(ANSWER_PATTERN, text)
+    rationale = text[text.rfind("```") + 3:]
+    return _validate_fields({
+        "answer": answer_match.group(1) if answer_match else "",
+        "en_prompt": matches[0],
+        "zh_prompt": matches[1],
+        "rationale": rationale,
+    })
+
+
+def parse_prompt_response(text: Optional[str]) -> dict:
+    """
+    解析 Gemini 返回的提示词文本
+
+    参数:
+        text: Gemini 原始响应文本（结构化 JSON 或旧版自由文本）
+
+    返回:
+        dict: {"answer", "zh_prompt", "en_prompt", "rationale"}
+
+    异常:
+        PromptParseError: 两种格式均无法解析时抛出
+    """
+    if not text or not text.strip():
+        raise PromptParseError("Gemini 响应为空")
+
+    data = _parse_json(text)
+    if data is not None:
+        return _validate_fields(data)
+    return _parse_fenced_blocks(text)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+上游副本的客户端负载均衡
+功能：主后端直接在多个新加坡 Gemini 代理副本之间分配请求，不需要额外的负载均衡器
+    1. 选择：在健康副本中选进行中请求最少的一个，相同时选延迟 EWMA 最低的（新副本 EWMA 为 0，会先得到流量）
+    2. 被动摘除：连续 eject_failures 次连接失败、超时或 5xx 后摘除
+    3. 主动探测：后台线程每 probe_interval 秒请求各副本的 /healthz；探测失败同样计入连续失败，
+       被摘除的副本连续 readmit_probes 次探测成功后恢复
+    4. 所有副本都被摘除时仍从中选择（失败开放），避免探测异常导致全部请求直接失败
+"""
+
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+from urllib.parse import urljoin
+
+import requests
+
+
+class Replica:
+    """单个副本的状态与统计"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.health_url = urljoin(url, "/healthz")
+        self.outstanding = 0
+        self.ewma_ms = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.probe_successes = 0
+        self.ejected = False
+        self.ejected_at = None
+        self.ejections = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": not self.ejected,
+            "outstanding": self.outstanding,
+            "ewma_ms": round(self.ewma_ms, 1),
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+            "ejected_seconds": round(time.monotonic() - self.ejected_at, 1) if self.ejected else None,
+        }
+
+
+class ReplicaPool:
+    """
+    在多个副本之间按最少进行中请求 + 延迟 EWMA 选择，并维护健康状态
+
+    参数:
+        urls: 副本的完整请求地址列表
+        eject_failures: 连续失败多少次后摘除
+        readmit_probes: 被摘除后连续多少次探测成功才恢复
+        probe_interval: 主动探测间隔（秒），为 0 时不探测（被摘除的副本将不会自动恢复）
+        probe_timeout: 单次探测超时（秒）
+        ewma_alpha: 延迟 EWMA 的平滑系数
+        failure_penalty_ms: 失败请求计入 EWMA 的最小耗时（毫秒）
+    """
+
+    def __init__(self, urls: List[str], eject_failures: int = 3, readmit_probes: int = 2,
+                 probe_interval: float = 5.0, probe_timeout: float = 2.0, ewma_alpha: float = 0.3,
+                 failure_penalty_ms: float = 5000.0):
+        if not urls:
+            raise ValueError("至少需要一个副本地址")
+        self.replicas = [Replica(url) for url in urls]
+        self.eject_failures = eject_failures
+        self.readmit_probes = readmit_probes
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.ewma_alpha = ewma_alpha
+        self.failure_penalty_ms = failure_penalty_ms
+        self._lock = threading.Lock()
+        self._prober_pid = None
+
+    def choose(self, exclude=()) -> Replica:
+        """选择一个副本（不计入进行中请求，需配合 track 使用）"""
+        self._ensure_prober()
+        with self._lock:
+            candidates = [r for r in self.replicas if r not in exclude] or self.replicas
+            healthy = [r for r in candidates if not r.ejected] or candidates
+            return min(healthy, key=lambda r: (r.outstanding, r.ewma_ms))
+
+    @contextmanager
+    def track(self, replica: Replica):
+        """
+        记录一次对 replica 的请求：进行中计数、耗时 EWMA、成败。
+        with 块内抛出异常视为失败；响应为 5xx 时调用方应调用 yield 出的函数标记失败
+        """
+        failed = []
+        with self._lock:
+            replica.outstanding += 1
+            replica.requests += 1
+        start = time.perf_counter()
+        try:
+            yield lambda: failed.append(True)
+        except Exception:
+            failed.append(True)
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                replica.outstanding -= 1
+                if failed:
+                    replica.failures += 1
+                    self._record_failure(replica, "请求失败")
+                    # 快速失败的副本不能因为"延迟低"而继续被优先选择
+                    elapsed_ms = max(elapsed_ms, self.failure_penalty_ms)
+                else:
+                    replica.consecutive_failures = 0
+                replica.ewma_ms = elapsed_ms if replica.ewma_ms == 0 else (
+                    self.ewma_alpha * elapsed_ms + (1 - self.ewma_alpha) * replica.ewma_ms)
+
+    def _record_failure(self, replica: Replica, reason: str) -> None:
+        """调用方需持有 self._lock"""
+        replica.consecutive_failures += 1
+        replica.probe_successes = 0
+        if not replica.ejected and replica.consecutive_failures >= self.eject_failures:
+            replica.ejected, replica.ejected_at = True, time.monotonic()
+            replica.ejections += 1
+            logging.warning("副本 %s 连续失败 %d 次（%s），已摘除", replica.url, replica.consecutive_failures, reason)
+
+    def _record_probe(self, replica: Replica, ok: bool) -> None:
+        with self._lock:
+            if not ok:
+                self._record_failure(replica, "健康检查失败")
+                return
+            if replica.ejected:
+                replica.probe_successes += 1
+                if replica.probe_successes >= self.readmit_probes:
+                    replica.ejected, replica.ejected_at = False, None
+                    replica.consecutive_failures = replica.probe_successes = 0
+                    # 清零 EWMA：恢复的副本先得到少量流量，重新测得真实延迟，而不是一直背着失败时的惩罚值
+                    replica.ewma_ms = 0.0
+                    logging.info("副本 %s 健康检查恢复，重新加入", replica.url)
+
+    def _ensure_prober(self) -> None:
+        """在当前进程中启动探测线程（首次使用时启动；fork 后的子进程中重新启动）。只有一个副本时无需探测"""
+        if self.probe_interval <= 0 or len(self.replicas) < 2 or self._prober_pid == os.getpid():
+            return
+        with self._lock:
+            if self._prober_pid == os.getpid():
+                return
+            self._prober_pid = os.getpid()
+        threading.Thread(target=self._probe_loop, name="replica-prober", daemon=True).start()
+
+    def _probe_loop(self) -> None:
+        session = requests.Session()
+        while True:
+            for replica in self.replicas:
+                try:
+                    ok = session.get(replica.health_url, timeout=self.probe_timeout).status_code == 200
+                except requests.RequestException:
+                    ok = False
+                self._record_probe(replica, ok)
+            time.sleep(self.probe_interval)
+
+    def stats(self) -> list:
+        with self._lock:
+            return [replica.to_dict() for replica in self.replicas]
+
+
+def create_replica_pool_from_env(urls: List[str]) -> Optional[ReplicaPool]:
+    """按 GEMINI_PROXY_* 环境变量创建副本池；urls 为空时返回 None"""
+    if not urls:
+        return None
+    return ReplicaPool(
+        urls,
+        eject_failures=int(os.getenv("GEMINI_PROXY_EJECT_FAILURES", "3")),
+        readmit_probes=int(os.getenv("GEMINI_PROXY_READMIT_PROBES", "2")),
+        probe_interval=float(os.getenv("GEMINI_PROXY_PROBE_INTERVAL", "5")),
+        probe_timeout=float(os.getenv("GEMINI_PROXY_PROBE_TIMEOUT", "2")),
+    )
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+图片分级保留与淘汰
+功能：基于 image_assets 表（记录每个图片文件的大小、最后访问时间和所属生成记录）按策略清理磁盘
+    1. 热数据：最近访问过的图片保持原样
+    2. 冷数据：长时间未访问的图片重新压缩为 JPEG 并移动到 archive/ 目录
+    3. 过期数据：冷数据继续闲置则删除文件，Generation.image_url 置空作为墓碑
+    4. 孤儿文件：所属生成记录已删除或失败的图片直接删除；上传的原图保留一段时间后删除
+    5. 容量上限：总大小超过上限时按最后访问时间（LRU）淘汰
+每一步都按索引分批处理（LIMIT batch_size），不扫描整个目录，可以频繁增量运行
+"""
+
+import os
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from PIL import Image
+from sqlalchemy import func, or_, update
+
+ARCHIVE_DIR = "archive"
+
+TIER_HOT = "hot"
+TIER_COLD = "cold"
+TIER_DELETED = "deleted"
+
+KIND_GENERATED = "generated"
+KIND_UPLOAD = "upload"
+
+
+@dataclass
+class RetentionPolicy:
+    hot_days: int = 7
+    delete_days: int = 90
+    upload_days: int = 3
+    max_bytes: int = 0
+    archive_quality: int = 80
+
+    @classmethod
+    def from_env(cls) -> "RetentionPolicy":
+        return cls(
+            hot_days=int(os.getenv("RETENTION_HOT_DAYS", "7")),
+            delete_days=int(os.getenv("RETENTION_DELETE_DAYS", "90")),
+            upload_days=int(os.getenv("RETENTION_UPLOAD_DAYS", "3")),
+            max_bytes=int(os.getenv("RETENTION_MAX_BYTES", "0")),
+            archive_quality=int(os.getenv("RETENTION_ARCHIVE_QUALITY", "80")),
+        )
+
+
+def compress_image(src_path: str, dst_path: str, quality: int) -> int:
+    """
+    将图片重新压缩为 JPEG
+
+    返回:
+        int: 压缩后的文件大小（字节）
+    """
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    with Image.open(src_path) as image:
+        image.convert("RGB").save(dst_path, "JPEG", quality=quality, optimize=True)
+    return os.path.getsize(dst_path)
+
+
+class RetentionSweeper:
+    """按保留策略增量处理 image_assets 中的记录"""
+
+    def __init__(self, db, image_asset_model, generation_model, storage, images_root, uploads_root,
+                 url_prefix, policy: RetentionPolicy, variant_model=None):
+        self.db = db
+        self.ImageAsset = image_asset_model
+        self.Generation = generation_model
+        self.GenerationVariant = variant_model
+        self.storage = storage
+        self.roots = {KIND_GENERATED: images_root, KIND_UPLOAD: uploads_root}
+        self.url_prefix = url_prefix
+        self.policy = policy
+
+    def _referencing(self, generation_id):
+        """引用该图片的生成记录：原始记录，以及从谜底结果缓存复用它的记录"""
+        return or_(self.Generation.id == generation_id, self.Generation.source_generation_id == generation_id)
+
+    def _retarget(self, asset, new_url) -> None:
+        """
+        把引用该图片的生成记录和多版本记录的 image_url 改为 new_url（None 为墓碑）
+        同一生成记录下有多个版本的图片，按当前地址（本地路由地址或 CDN 地址）精确匹配，不影响其他版本
+        """
+        urls = [f"{self.url_prefix}{asset.key}"]
+        public_url = self.storage.public_url(asset.key)
+        if public_url:
+            urls.append(public_url)
+        self.db.session.execute(
+            update(self.Generation)
+            .where(self._referencing(asset.generation_id), self.Generation.image_url.in_(urls))
+            .values(image_url=new_url)
+        )
+        if self.GenerationVariant is not None:
+            self.db.session.execute(
+                update(self.GenerationVariant)
+                .where(self.GenerationVariant.generation_id == asset.generation_id,
+                       self.GenerationVariant.image_url.in_(urls))
+                .values(image_url=new_url)
+            )
+
+    def _local_path(self, asset) -> str:
+        return os.path.join(self.roots[asset.kind], asset.key)
+
+    def _delete_asset(self, asset, reason: str) -> None:
+        """删除文件并留下墓碑：资产标记为 deleted，生成记录的 image_url 置空"""
+        try:
+            os.remove(self._local_path(asset))
+        except FileNotFoundError:
+            pass
+        if asset.kind == KIND_GENERATED and self.storage.is_remote:
+            self.storage.delete(asset.key)
+        if asset.kind == KIND_GENERATED and asset.generation_id:
+            self._retarget(asset, None)
+        asset.tier = TIER_DELETED
+        logging.info("已删除图片 %s（%s，%d 字节）", asset.key, reason, asset.size_bytes or 0)
+
+    def _archive_asset(self, asset) -> None:
+        """冷数据：本地图片重新压缩到 archive/ 目录；对象存储上的图片交给存储自身的生命周期规则"""
+        src_path = self._local_path(asset)
+        if asset.kind != KIND_GENERATED or self.storage.is_remote or not os.path.exists(src_path):
+            asset.tier = TIER_COLD
+            return
+
+        stem = os.path.splitext(os.path.basename(asset.key))[0]
+        new_key = f"{ARCHIVE_DIR}/{stem}.jpg"
+        new_size = compress_image(src_path, os.path.join(self.roots[KIND_GENERATED], new_key), self.policy.archive_quality)
+        if asset.generation_id:
+            self._retarget(asset, f"{self.url_prefix}{new_key}")
+        logging.info("已归档图片 %s -> %s（%d -> %d 字节）", asset.key, new_key, asset.size_bytes or 0, new_size)
+        os.remove(src_path)
+        asset.key, asset.size_bytes, asset.tier = new_key, new_size, TIER_COLD
+
+    def _batch(self, query, batch_size: int):
+        return query.order_by(self.ImageAsset.last_accessed_at).limit(batch_size).all()
+
+    def sweep(self, batch_size: int = 500) -> dict:
+        """
+        执行一轮增量清理，每一步最多处理 batch_size 条记录
+
+        返回:
+            dict: 各步骤处理的记录数
+        """
+        ImageAsset, Generation = self.ImageAsset, self.Generation
+        now = datetime.now(timezone.utc)
+        stats = {"orphans": 0, "uploads": 0, "archived": 0, "expired": 0, "evicted": 0}
+
+        # 1. 孤儿：生成记录已被删除或生成失败
+        orphans = self._batch(
+            ImageAsset.query.outerjoin(Generation, ImageAsset.generation_id == Generation.id).filter(
+                ImageAsset.tier != TIER_DELETED,
+                ImageAsset.kind == KIND_GENERATED,
+                or_(ImageAsset.generation_id.is_(None), Generation.status == "failed"),
+            ),
+            batch_size,
+        )
+        for asset in orphans:
+            self._delete_asset(asset, "orphan")
+        stats["orphans"] = len(orphans)
+        self.db.session.commit()
+
+        # 2. 上传的原图只保留 upload_days 天
+        uploads = self._batch(
+            ImageAsset.query.filter(
+                ImageAsset.tier != TIER_DELETED,
+                ImageAsset.kind == KIND_UPLOAD,
+                ImageAsset.created_at < now - timedelta(days=self.policy.upload_days),
+            ),
+            batch_size,
+        )
+        for asset in uploads:
+            self._delete_asset(asset, "upload expired")
+        stats["uploads"] = len(uploads)
+        self.db.session.commit()
+
+        # 3. 热数据长时间未访问 -> 冷数据
+        cold = self._batch(
+            ImageAsset.query.filter(
+                ImageAsset.tier == TIER_HOT,
+                ImageAsset.kind == KIND_GENERATED,
+                ImageAsset.last_accessed_at < now - timedelta(days=self.policy.hot_days),
+            ),
+            batch_size,
+        )
+        for asset in cold:
+            self._archive_asset(asset)
+        stats["archived"] = len(cold)
+        self.db.session.commit()
+
+        # 4. 冷数据继续闲置 -> 删除
+        expired = self._batch(
+            ImageAsset.query.filter(
+                ImageAsset.tier == TIER_COLD,
+                ImageAsset.last_accessed_at < now - timedelta(days=self.policy.delete_days),
+            ),
+            batch_size,
+        )
+        for asset in expired:
+            self._delete_asset(asset, "expired")
+        stats["expired"] = len(expired)
+        self.db.session.commit()
+
+        # 5. 总容量超过上限时按 LRU 淘汰
+        if self.policy.max_bytes > 0:
+            total = self.db.session.query(func.coalesce(func.sum(ImageAsset.size_bytes), 0)).filter(
+                ImageAsset.tier != TIER_DELETED
+            ).scalar()
+            if total > self.policy.max_bytes:
+                for asset in self._batch(ImageAsset.query.filter(ImageAsset.tier != TIER_DELETED), batch_size):
+                    if total <= self.policy.max_bytes:
+                        break
+                    total -= asset.size_bytes or 0
+                    self._delete_asset(asset, "over capacity")
+                    stats["evicted"] += 1
+                self.db.session.commit()
+
+        logging.info("图片保留策略执行完成：%s", stats)
+        return stats
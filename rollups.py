@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+用量与延迟预聚合（rollup）
+功能：统计类问题（每天生成多少、失败率、热门谜底、各阶段耗时）直接读预聚合表，不再扫描 generations
+    1. 计数：按小时和天、接口（endpoint）、来源（upstream / answer_cache / pregenerated / ...）、状态、尺寸累加
+    2. 阶段耗时：按小时和天、接口、阶段记录固定分桶的直方图（每桶的次数和耗时总和），可计算平均值和分位数
+    3. 热门谜底：按天、归一化谜底累加
+    4. 写入：生成记录状态变化时在内存中累加，每 ROLLUP_FLUSH_INTERVAL 秒合并成一批
+       INSERT ... ON CONFLICT DO UPDATE SET count = count + excluded.count 写入；
+       热点计数行每个进程每个间隔只更新一次，不与请求事务争抢行锁。为 0 时每次记录立即写入
+    5. 查询：结果行数只取决于时间范围和维度的取值个数，与 generations 表的大小无关
+注意：进程被强制结束时最多丢失最后一个间隔内的计数；写入失败的增量保留到下一次重试
+"""
+
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import select, func
+
+GRANULARITY_HOUR = "hour"
+GRANULARITY_DAY = "day"
+
+# 阶段耗时直方图的桶上界（毫秒），最后一个桶收集所有更慢的请求
+LATENCY_BUCKETS_MS = [50, 100, 250, 500, 1000, 2000, 5000, 10000, 20000, 30000, 45000, 60000, 90000, 120000, 180000]
+LATENCY_OVERFLOW_MS = 2 ** 31 - 1
+
+
+def bucket_start(at: datetime, granularity: str) -> datetime:
+    """返回时间点所在小时或天（UTC）的起点"""
+    at = at.astimezone(timezone.utc)
+    if granularity == GRANULARITY_DAY:
+        return at.replace(hour=0, minute=0, second=0, microsecond=0)
+    return at.replace(minute=0, second=0, microsecond=0)
+
+
+def latency_bucket(elapsed_ms: float) -> int:
+    for upper in LATENCY_BUCKETS_MS:
+        if elapsed_ms <= upper:
+            return upper
+    return LATENCY_OVERFLOW_MS
+
+
+def histogram_quantile(histogram: dict, fraction: float) -> Optional[int]:
+    """
+    由 {桶上界: 次数} 计算分位数（返回所在桶的上界，溢出桶返回最后一个有限上界）
+
+    返回:
+        Optional[int]: 分位数（毫秒）；没有数据时返回 None
+    """
+    total = sum(histogram.values())
+    if total == 0:
+        return None
+    threshold = fraction * total
+    cumulative = 0
+    for upper in sorted(histogram):
+        cumulative += histogram[upper]
+        if cumulative >= threshold:
+            return min(upper, LATENCY_BUCKETS_MS[-1])
+    return LATENCY_BUCKETS_MS[-1]
+
+
+class RollupRecorder:
+    """
+    在内存中累加计数，定期合并写入预聚合表
+
+    参数:
+        app: Flask 应用（写入线程中需要应用上下文）
+        db: Flask-SQLAlchemy 实例
+        usage_model: 计数表模型（UsageRollup）
+        latency_model: 阶段耗时表模型（LatencyRollup）
+        answer_model: 热门谜底表模型（AnswerRollup）
+        flush_interval: 写入间隔（秒），为 0 时每次记录立即写入
+        enabled: 为 False 时所有记录调用直接返回
+    """
+
+    def __init__(self, app, db, usage_model, latency_model, answer_model, flush_interval: float = 10.0,
+                 enabled: bool = True):
+        self.app = app
+        self.db = db
+        self.UsageRollup = usage_model
+        self.LatencyRollup = latency_model
+        self.AnswerRollup = answer_model
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._usage = defaultdict(int)
+        self._latency = defaultdict(lambda: [0, 0])
+        self._answers = defaultdict(int)
+        self._flusher_pid = None
+        self.flush_errors = 0
+        atexit.register(self.flush)
+
+    def record_generation(self, endpoint: str, source: str, status: str, size: Optional[str] = None,
+                          answer_key: Optional[str] = None, at: Optional[datetime] = None) -> None:
+        """
+        记录一次生成结果
+
+        参数:
+            endpoint: 接口名，如 generate_meme
+            source: 结果来源：upstream（调用上游）、answer_cache、pregenerated、figurine_cache、variant
+            status: completed / failed / rejected
+            size: 图片尺寸选项
+            answer_key: 归一化谜底；只统计完成的生成
+        """
+        if not self.enabled:
+            return
+        at = at or datetime.now(timezone.utc)
+        with self._lock:
+            for granularity in (GRANULARITY_HOUR, GRANULARITY_DAY):
+                self._usage[(granularity, bucket_start(at, granularity), endpoint, source, status, size or "")] += 1
+            if answer_key and status == "completed":
+                self._answers[(bucket_start(at, GRANULARITY_DAY), answer_key[:255])] += 1
+        self._after_record()
+
+    def record_latency(self, endpoint: str, stage: str, elapsed_ms: float, at: Optional[datetime] = None) -> None:
+        """记录一个阶段的耗时（毫秒）"""
+        if not self.enabled:
+            return
+        at = at or datetime.now(timezone.utc)
+        upper = latency_bucket(elapsed_ms)
+        with self._lock:
+            for granularity in (GRANULARITY_HOUR, GRANULARITY_DAY):
+                entry = self._latency[(granularity, bucket_start(at, granularity), endpoint, stage, upper)]
+                entry[0] += 1
+                entry[1] += int(elapsed_ms)
+        self._after_record()
+
+    def _after_record(self) -> None:
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def _ensure_flusher(self) -> None:
+        """在当前进程中启动写入线程（首次记录时启动；fork 后的子进程中重新启动）"""
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="rollup-flusher", daemon=True).start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def reset_after_fork(self) -> None:
+        """fork 后丢弃从父进程继承的未写入增量（父进程会自己写入）"""
+        with self._lock:
+            self._usage.clear()
+            self._latency.clear()
+            self._answers.clear()
+            self._flusher_pid = None
+
+    def flush(self) -> None:
+        """把累加的增量写入数据库；失败时增量放回缓冲区，下次重试"""
+        with self._lock:
+            usage, self._usage = self._usage, defaultdict(int)
+            latency, self._latency = self._latency, defaultdict(lambda: [0, 0])
+            answers, self._answers = self._answers, defaultdict(int)
+        if not (usage or latency or answers):
+            return
+        try:
+            with self.app.app_context(), self.db.engine.begin() as connection:
+                self._upsert(connection, self.UsageRollup, [
+                    {"granularity": g, "bucket_start": b, "endpoint": e, "source": s, "status": st, "size": sz,
+                     "count": count}
+                    for (g, b, e, s, st, sz), count in sorted(usage.items())
+                ], ["granularity", "bucket_start", "endpoint", "source", "status", "size"], ["count"])
+                self._upsert(connection, self.LatencyRollup, [
+                    {"granularity": g, "bucket_start": b, "endpoint": e, "stage": stage, "le_ms": le,
+                     "count": count, "total_ms": total_ms}
+                    for (g, b, e, stage, le), (count, total_ms) in sorted(latency.items())
+                ], ["granularity", "bucket_start", "endpoint", "stage", "le_ms"], ["count", "total_ms"])
+                self._upsert(connection, self.AnswerRollup, [
+                    {"bucket_start": b, "answer_key": key, "count": count}
+                    for (b, key), count in sorted(answers.items())
+                ], ["bucket_start", "answer_key"], ["count"])
+        except Exception as e:
+            self.flush_errors += 1
+            logging.warning("写入预聚合统计失败，下次重试：%s", e)
+            with self._lock:
+                for key, count in usage.items():
+                    self._usage[key] += count
+                for key, (count, total_ms) in latency.items():
+                    self._latency[key][0] += count
+                    self._latency[key][1] += total_ms
+                for key, count in answers.items():
+                    self._answers[key] += count
+
+    def _upsert(self, connection, model, rows, key_columns, sum_columns) -> None:
+        """按 key_columns 合并写入，sum_columns 在已有值上累加（行按键排序，避免并发写入时互相死锁）"""
+        if not rows:
+            return
+        if connection.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        table = model.__table__
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={column: table.c[column] + statement.excluded[column] for column in sum_columns},
+        )
+        connection.execute(statement, rows)
+
+    def summary(self, session, granularity: str, since: datetime, until: Optional[datetime] = None,
+                endpoint: Optional[str] = None, top_answers: int = 20) -> dict:
+        """
+        从预聚合表汇总统计
+
+        参数:
+            session: 数据库会话
+            granularity: hour / day
+            since: 起始时间（按所在小时或天对齐）
+            until: 结束时间（不含），默认为当前时间
+            endpoint: 只统计该接口
+            top_answers: 返回的热门谜底数量
+
+        返回:
+            dict: buckets（每个时间段按状态、来源、尺寸的计数和失败率）、latency（各接口各阶段的次数、平均值和分位数）、
+                  top_answers（按天统计的热门谜底，只有 day 粒度时返回）
+        """
+        start = bucket_start(since, granularity)
+        until = until or datetime.now(timezone.utc)
+        U, L, A = self.UsageRollup, self.LatencyRollup, self.AnswerRollup
+
+        usage_query = select(U.bucket_start, U.endpoint, U.source, U.status, U.size, U.count).where(
+            U.granularity == granularity, U.bucket_start >= start, U.bucket_start < until)
+        if endpoint:
+            usage_query = usage_query.where(U.endpoint == endpoint)
+        buckets = {}
+        for row in session.execute(usage_query.order_by(U.bucket_start)):
+            bucket = buckets.setdefault(row.bucket_start.isoformat(), {
+                "total": 0, "by_status": defaultdict(int), "by_endpoint": defaultdict(int),
+                "by_source": defaultdict(int), "by_size": defaultdict(int),
+            })
+            bucket["total"] += row.count
+            bucket["by_status"][row.status] += row.count
+            bucket["by_endpoint"][row.endpoint] += row.count
+            bucket["by_source"][row.source] += row.count
+            if row.size:
+                bucket["by_size"][row.size] += row.count
+        for bucket in buckets.values():
+            finished = bucket["by_status"]["completed"] + bucket["by_status"]["failed"]
+            bucket["failure_rate"] = round(bucket["by_status"]["failed"] / finished, 4) if finished else 0.0
+
+        latency_query = select(L.endpoint, L.stage, L.le_ms, func.sum(L.count), func.sum(L.total_ms)).where(
+            L.granularity == granularity, L.bucket_start >= start, L.bucket_start < until
+        ).group_by(L.endpoint, L.stage, L.le_ms)
+        if endpoint:
+            latency_query = latency_query.where(L.endpoint == endpoint)
+        histograms = defaultdict(lambda: {"histogram": {}, "total_ms": 0})
+        for row_endpoint, stage, le_ms, count, total_ms in session.execute(latency_query):
+            entry = histograms[f"{row_endpoint}.{stage}"]
+            entry["histogram"][le_ms] = int(count)
+            entry["total_ms"] += int(total_ms)
+        latency = {}
+        for name, entry in sorted(histograms.items()):
+            count = sum(entry["histogram"].values())
+            latency[name] = {
+                "count": count,
+                "mean_ms": round(entry["total_ms"] / count, 1) if count else None,
+                "p50_ms": histogram_quantile(entry["histogram"], 0.50),
+                "p95_ms": histogram_quantile(entry["histogram"], 0.95),
+                "p99_ms": histogram_quantile(entry["histogram"], 0.99),
+            }
+
+        result = {"granularity": granularity, "since": start.isoformat(), "until": until.isoformat(),
+                  "buckets": buckets, "latency": latency}
+        if granularity == GRANULARITY_DAY and top_answers > 0:
+            answer_total = func.sum(A.count).label("total")
+            rows = session.execute(
+                select(A.answer_key, answer_total)
+                .where(A.bucket_start >= start, A.bucket_start < until)
+                .group_by(A.answer_key).order_by(answer_total.desc()).limit(top_answers)
+            )
+            result["top_answers"] = [{"answer_key": key, "count": int(total)} for key, total in rows]
+        return result
+
+
+def create_rollup_recorder_from_env(app, db, usage_model, latency_model, answer_model) -> RollupRecorder:
+    """按 ROLLUPS_ENABLED（默认 true）、ROLLUP_FLUSH_INTERVAL（秒，默认 10）创建"""
+    return RollupRecorder(
+        app, db, usage_model, latency_model, answer_model,
+        flush_interval=float(os.getenv("ROLLUP_FLUSH_INTERVAL", "10")),
+        enabled=os.getenv("ROLLUPS_ENABLED", "true").lower() == "true",
+    )
+
+
+def default_since(granularity: str, periods: int) -> datetime:
+    """最近 periods 个小时或天的起点"""
+    step = timedelta(days=1) if granularity == GRANULARITY_DAY else timedelta(hours=1)
+    return bucket_start(datetime.now(timezone.utc), granularity) - step * (periods - 1)
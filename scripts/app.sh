@@ -1 +1 @@
-nohup python3 app.py > logs/app.log 2>&1 &
\ No newline at end of file
+GUNICORN_PIDFILE=logs/gunicorn_app.pid LOG_CONSOLE=false nohup gunicorn -c gunicorn.conf.py app:app > logs/app.stdout.log 2>&1 &
\ No newline at end of file
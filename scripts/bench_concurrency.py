@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+并发压测工具：比较 Werkzeug 开发服务器与 gunicorn 在长时间 I/O 等待下的吞吐和延迟
+功能：
+    1. stub：模拟后端的桩应用，/wait?ms= 模拟等待上游（Gemini / 即梦），/cpu?ms= 模拟 CPU 计算（bcrypt、JSON 序列化）
+    2. load：固定并发的闭环压测，每个客户端线程使用独立的长连接会话，按 URL 分别统计吞吐量与延迟分位数
+用法（在仓库根目录执行）：
+    python scripts/bench_concurrency.py stub --port 5560                  # 开发服务器（与 app.run 相同）
+    GUNICORN_BIND=127.0.0.1:5560 gunicorn -c gunicorn.conf.py --pythonpath scripts bench_concurrency:stub_app
+    python scripts/bench_concurrency.py load --url "http://127.0.0.1:5560/wait?ms=2000" \\
+        --url "http://127.0.0.1:5560/cpu?ms=20" --concurrency 100 --duration 30
+"""
+
+import sys
+import time
+import json
+import argparse
+import threading
+from collections import defaultdict
+
+import requests
+from flask import Flask, request, jsonify
+
+stub_app = Flask(__name__)
+
+
+@stub_app.route("/wait")
+def stub_wait():
+    """模拟等待上游响应：只占用线程，不占用 CPU"""
+    time.sleep(request.args.get("ms", 1000, type=int) / 1000)
+    return jsonify({"ok": True})
+
+
+@stub_app.route("/cpu")
+def stub_cpu():
+    """模拟 CPU 密集的请求处理"""
+    deadline = time.perf_counter() + request.args.get("ms", 10, type=int) / 1000
+    count = 0
+    while time.perf_counter() < deadline:
+        count += 1
+    return jsonify({"ok": True, "iterations": count})
+
+
+def percentile(values: list, fraction: float) -> float:
+    """返回已排序列表的分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
+
+
+def run_load(urls: list, concurrency: int, duration: float, timeout: float) -> dict:
+    """
+    以固定并发对 urls 闭环压测 duration 秒（客户端 i 固定请求 urls[i % len(urls)]）
+
+    参数:
+        urls: 压测的 URL 列表
+        concurrency: 并发客户端数
+        duration: 压测时长（秒）
+        timeout: 单个请求超时（秒）
+
+    返回:
+        dict: URL -> {requests, errors, rps, p50_ms, p95_ms, p99_ms, max_ms}
+    """
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(url):
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = session.get(url, timeout=timeout).status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with lock:
+                if ok:
+                    latencies[url].append(elapsed_ms)
+                else:
+                    errors[url] += 1
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(urls[i % len(urls)],), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    report = {}
+    for url in urls:
+        values = sorted(latencies[url])
+        report[url] = {
+            "requests": len(values),
+            "errors": errors[url],
+            "rps": round(len(values) / elapsed, 2),
+            "p50_ms": round(percentile(values, 0.50), 1),
+            "p95_ms": round(percentile(values, 0.95), 1),
+            "p99_ms": round(percentile(values, 0.99), 1),
+            "max_ms": round(values[-1], 1) if values else 0.0,
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="并发压测工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stub_parser = subparsers.add_parser("stub", help="用 Werkzeug 开发服务器运行桩应用")
+    stub_parser.add_argument("--port", type=int, default=5560)
+
+    load_parser = subparsers.add_parser("load", help="闭环压测")
+    load_parser.add_argument("--url", action="append", required=True, help="可重复指定，客户端轮流分配")
+    load_parser.add_argument("--concurrency", type=int, default=50)
+    load_parser.add_argument("--duration", type=float, default=30)
+    load_parser.add_argument("--timeout", type=float, default=120)
+
+    args = parser.parse_args(argv)
+    if args.command == "stub":
+        stub_app.run(host="127.0.0.1", port=args.port)
+        return
+    report = run_load(args.url, args.concurrency, args.duration, args.timeout)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
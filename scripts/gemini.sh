@@ -0,0 +1,3 @@
+# gRPC 客户端不能跨 fork 共用，新加坡代理不预加载；主后端连接池长期复用连接，保持连接 75 秒
+GUNICORN_BIND=0.0.0.0:5551 GUNICORN_PRELOAD=false GUNICORN_KEEPALIVE=75 GUNICORN_PIDFILE=logs/gunicorn_gemini.pid \
+LOG_CONSOLE=false nohup gunicorn -c gunicorn.conf.py singapore_gemini_server:app > logs/gemini.stdout.log 2>&1 &
\ No newline at end of file
@@ -6,80 +6,182 @@ Gemini API代理服务
 """
 import os
 import sys
+import hmac
 import logging
 import json
 import io
+import gzip
 from flask import send_file
-import re  # 导入 re 模块
-import datetime
 from flask import Flask, request, jsonify
+from werkzeug.serving import WSGIRequestHandler
 from dotenv import load_dotenv
 load_dotenv()
 
+# 配置日志（需在导入其他模块之前，使整个进程写入同一个日志文件）
+from log_config import setup_logging
+setup_logging("gemini_server")
+
 # 将 api 目录添加到系统路径
 # 假设 genemi_api.py 与此文件在同一目录下或可通过python path访问
 sys.path.append(os.path.join(os.path.dirname(__file__), 'api'))
-from genemi_api import genemi_generate_api, generate_figurine_image
+from genemi_api import genemi_generate_api, repair_prompt_response, generate_figurine_image
+from prompt_parser import parse_prompt_response, PromptParseError
+from tracing import configure_tracer, instrument_flask
+from profiling import create_profiler_from_env, instrument_profiling
+from hedging import create_hedger_from_env
 
 # 应用配置
 app = Flask(__name__)
+# 中文直接以 UTF-8 输出，避免 \uXXXX 转义使响应体积翻倍
+app.json.ensure_ascii = False
 
-# 配置日志
-LOG_DIR = os.getenv("LOGS_PATH")
-os.makedirs(LOG_DIR, exist_ok=True)
-log_filename = datetime.datetime.now().strftime("%Y-%m-%d") + "_gemini_server.log"
-log_filepath = os.path.join(LOG_DIR, log_filename)
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s",
-    handlers=[
-        logging.FileHandler(log_filepath, encoding="utf-8"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 logging.info("新加坡 Gemini 服务日志系统初始化完成。")
 
-# 定义用于解析的正则表达式
-PROMPT_PATTERN = r'```json(.*?)```'
+# 分布式追踪：从主后端传来的 traceparent 请求头延续同一个 trace
+tracer = configure_tracer(os.getenv("TRACING_SERVICE_NAME", "singapore-gemini-proxy"))
+instrument_flask(app, tracer)
+
+# 按需请求分析（默认关闭）：配置 PROFILE_TOKEN 后，请求头 X-Profile 等于该值的请求会被采样分析
+profiler = create_profiler_from_env(os.getenv("TRACING_SERVICE_NAME", "singapore-gemini-proxy"))
+instrument_profiling(app, profiler)
+
+# 是否启用 Gemini 结构化输出（JSON schema）模式
+GEMINI_STRUCTURED_OUTPUT = os.getenv("GEMINI_STRUCTURED_OUTPUT", "true").lower() == "true"
+
+# 提示词生成的对冲调用：主调用超过近期耗时的高分位数仍未返回时，用 HEDGE_MODEL_NAME 再发一次，采用先返回的有效结果
+prompt_hedger = create_hedger_from_env("gemini.prompt")
+
+# 管理接口（对冲统计）的令牌，请求头 X-Admin-Token
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# 响应压缩配置：小于阈值的响应不压缩（gzip 头部开销得不偿失）
+RESPONSE_GZIP_MIN_BYTES = int(os.getenv("RESPONSE_GZIP_MIN_BYTES", "512"))
+RESPONSE_GZIP_LEVEL = int(os.getenv("RESPONSE_GZIP_LEVEL", "6"))
+
+# 精简响应模式下调用方可以索取的字段
+PROMPT_RESPONSE_FIELDS = ("prompt", "chinese_prompt", "english_prompt", "answer", "rationale")
+
+
+def get_json_payload() -> dict:
+    """读取请求体 JSON，支持 Content-Encoding: gzip 压缩的请求体。"""
+    if request.headers.get("Content-Encoding", "").lower() == "gzip":
+        raw_body = gzip.decompress(request.get_data())
+        return json.loads(raw_body.decode("utf-8")) if raw_body else {}
+    return request.get_json(silent=True) or {}
+
+
+@app.after_request
+def compress_response(response):
+    """对支持 gzip 的调用方压缩 JSON 响应，减少跨区域传输字节数。"""
+    if (
+        response.direct_passthrough
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+        or "gzip" not in request.headers.get("Accept-Encoding", "").lower()
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < RESPONSE_GZIP_MIN_BYTES:
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=RESPONSE_GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """健康检查：供主后端的副本池主动探测，不调用 Vertex"""
+    return jsonify({"status": "ok"}), 200
+
+
+def generate_and_parse(answer: str, use_hedge_model: bool = False) -> tuple:
+    """
+    生成并解析提示词，返回 (原始响应, 解析结果)；格式不正确时解析结果为 None，由调用方做格式修复
+
+    异常:
+        Gemini 调用失败时抛出
+    """
+    raw_response = genemi_generate_api(prompt=answer, structured=GEMINI_STRUCTURED_OUTPUT,
+                                       use_hedge_model=use_hedge_model)
+    try:
+        return raw_response, parse_prompt_response(raw_response)
+    except PromptParseError as pe:
+        logging.warning("Gemini 响应格式不正确（%s），响应长度: %d字符", pe, len(raw_response or ""))
+        logging.debug("格式不正确的 Gemini 响应: %s", raw_response)
+        return raw_response, None
+
 
 @app.route('/api/genemi', methods=['POST'])
 def generate_gemini_prompt():
     """
     接收来自主后端服务的请求，调用本地 Gemini API，解析后返回最终的中文提示词。
     """
-    data = request.get_json()
+    try:
+        data = get_json_payload()
+    except (OSError, ValueError) as e:
+        logging.warning("无法解析请求体: %s", e)
+        return jsonify({"message": "Invalid request body."}), 400
     answer = data.get('answer')
     
     if not answer:
         logging.warning("请求缺少 'answer' 参数。")
         return jsonify({"message": "Missing 'answer' parameter."}), 400
 
-    logging.info("收到生成梗图提示词的请求，谜底: %s", answer)
+    # 精简响应模式：只返回调用方索取的字段；未指定时返回全部字段
+    fields = data.get('fields') or list(PROMPT_RESPONSE_FIELDS)
+    if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+        logging.warning("响应字段列表格式不正确: %r", fields)
+        return jsonify({"message": "'fields' must be a list of strings."}), 400
+    unknown_fields = [f for f in fields if f not in PROMPT_RESPONSE_FIELDS]
+    if unknown_fields:
+        logging.warning("请求了未知的响应字段: %s", unknown_fields)
+        return jsonify({"message": f"Unknown fields: {', '.join(unknown_fields)}"}), 400
+
+    logging.info("收到生成梗图提示词的请求，谜底长度: %d字符", len(str(answer)))
+    logging.debug("谜底: %s", answer)
 
     try:
-        # 1. 调用核心的 Gemini 生成函数
-        raw_gemini_response = genemi_generate_api(prompt=answer)
+        # 1. 调用核心的 Gemini 生成函数并在新加坡服务内部解析响应（启用对冲时，先返回且能解析的结果获胜）
+        with tracer.span("vertex.generate", structured=GEMINI_STRUCTURED_OUTPUT, hedged=prompt_hedger is not None):
+            if prompt_hedger is None:
+                raw_gemini_response, result = generate_and_parse(answer)
+            else:
+                raw_gemini_response, result = prompt_hedger.call(
+                    lambda: generate_and_parse(answer),
+                    lambda: generate_and_parse(answer, use_hedge_model=True),
+                    is_valid=lambda outcome: outcome[1] is not None,
+                )
 
         if not raw_gemini_response:
             logging.error("genemi_generate_api 返回了空响应。")
             return jsonify({"message": "Gemini API returned an empty response."}), 500
 
-        # 2. 在新加坡服务内部解析响应
-        logging.info("解析 Gemini 的响应以提取中文提示词。")
-        matches = re.findall(PROMPT_PATTERN, raw_gemini_response, re.DOTALL)
-        
-        if not matches or len(matches) < 2:
-            logging.error(f"无法从 Gemini 响应中解析出提示词。响应内容: {raw_gemini_response}")
-            raise ValueError("Gemini 响应格式不正确。")
+        # 2. 格式不正确时只做一次低成本的格式修复，而不是整体重新生成
+        if result is None:
+            logging.info("尝试格式修复。")
+            with tracer.span("vertex.repair"):
+                repaired = repair_prompt_response(raw_gemini_response)
+            with tracer.span("prompt.parse", repaired=True):
+                result = parse_prompt_response(repaired)
+            logging.info("Gemini 响应格式修复成功。")
         
-        # 3. 提取并返回干净的中文提示词
-        chinese_prompt = matches[1].strip()
-        logging.info("成功提取中文提示词。")
+        # 3. 提取干净的中英文提示词，并只返回调用方需要的字段
+        parsed = {
+            "prompt": raw_gemini_response,
+            "chinese_prompt": result["zh_prompt"],
+            "english_prompt": result["en_prompt"],
+            "answer": result["answer"],
+            "rationale": result["rationale"],
+        }
+        logging.info("成功提取中文提示词，返回字段: %s", fields)
         
-        return jsonify({"chinese_prompt": chinese_prompt}), 200
+        return jsonify({field: parsed[field] for field in fields}), 200
 
     except Exception as e:
-        logging.error(f"调用 Gemini API 或解析时发生未知错误: {e}", exc_info=True)
+        logging.error("调用 Gemini API 或解析时发生未知错误: %s", e, exc_info=True)
         return jsonify({"message": "An unexpected error occurred on the Gemini server."}), 500
 
 
@@ -103,10 +205,11 @@ def generate_figurine_from_image_proxy():
 
     try:
         image_bytes = file.read()
-        logging.info(f"已读取上传的图片，大小: {len(image_bytes)} bytes。")
+        logging.info("已读取上传的图片，大小: %d bytes。", len(image_bytes))
 
         # 调用核心AI逻辑
-        generated_image_bytes = generate_figurine_image(uploaded_image_bytes=image_bytes)
+        with tracer.span("vertex.generate_figurine", image_bytes=len(image_bytes)):
+            generated_image_bytes = generate_figurine_image(uploaded_image_bytes=image_bytes)
 
         if not generated_image_bytes:
             logging.error("generate_figurine_image 未能返回图片数据。")
@@ -122,10 +225,42 @@ def generate_figurine_from_image_proxy():
         )
 
     except Exception as e:
-        logging.error(f"处理立体雕塑请求时发生未知错误: {e}", exc_info=True)
+        logging.error("处理立体雕塑请求时发生未知错误: %s", e, exc_info=True)
         return jsonify({"message": "An unexpected error occurred on the Singapore server."}), 500
 
 
+@app.route('/api/admin/hedging', methods=['GET'])
+def get_hedging_stats():
+    """
+    提示词对冲统计（本进程内）：请求数、对冲次数与比例、对冲获胜次数与比例、因配额或并发上限放弃的次数、当前对冲等待时间。
+    需要请求头 X-Admin-Token 等于 ADMIN_TOKEN
+    """
+    token = request.headers.get("X-Admin-Token", "")
+    if not (ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN)):
+        return jsonify({"message": "Forbidden."}), 403
+    if prompt_hedger is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify({"enabled": True, **prompt_hedger.snapshot()}), 200
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+def get_profiles(profile_id=None):
+    """
+    查看请求分析结果：不带 ID 时列出最近的摘要，带 ID 时返回单个结果。需要请求头 X-Profile-Token 等于 PROFILE_TOKEN
+    """
+    if not profiler.token_matches(request.headers.get("X-Profile-Token")):
+        return jsonify({"message": "Forbidden."}), 403
+    if profile_id is None:
+        return jsonify(profiler.store.recent(min(request.args.get("limit", 50, type=int), 200))), 200
+    profile = profiler.store.get(profile_id)
+    if profile is None:
+        return jsonify({"message": "Profile not found."}), 404
+    return jsonify(profile), 200
+
+
 if __name__ == '__main__':
     logging.info("启动新加坡 Gemini API 服务...")
+    # 默认的 HTTP/1.0 每个请求后都会断开连接；改为 HTTP/1.1 以支持主后端的长连接复用
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run(host='0.0.0.0', port=5551)
\ No newline at end of file
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+生成图片的存储后端
+功能：为生成的图片提供统一的存储接口，支持本地磁盘和 S3 兼容对象存储（AWS S3 / MinIO / 火山引擎 TOS 等）
+    1. LocalStorage：图片保存在 IMAGES_PATH 目录，由 Flask 直接提供下载
+    2. S3Storage：图片异步上传到对象存储，下载通过预签名 URL 或 CDN 地址完成，不再经过 Flask
+环境依赖：使用 S3 后端时需要安装 boto3，并在 .env 中配置 STORAGE_BACKEND=s3 与 S3_* 参数
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Optional
+
+
+class LocalStorage:
+    """本地磁盘存储：文件已由生成流程写入 root 目录，只负责定位、删除和判断存在"""
+
+    is_remote = False
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def upload_file(self, local_path: str, key: str) -> None:
+        target = self.local_path(key)
+        if os.path.abspath(local_path) != os.path.abspath(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(local_path, target)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.local_path(key))
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def url_for(self, key: str) -> Optional[str]:
+        """本地存储没有外部 URL，由 Flask 路由提供文件"""
+        return None
+
+    def public_url(self, key: str) -> Optional[str]:
+        return None
+
+
+class S3Storage:
+    """S3 兼容对象存储：大文件自动分片上传，读取通过预签名 URL 或 CDN 地址"""
+
+    is_remote = True
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: Optional[str] = None,
+        region: Optional[str] = None,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        public_base_url: Optional[str] = None,
+        presign_expires: int = 3600,
+        multipart_threshold: int = 8 * 1024 * 1024,
+    ):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 需要安装 boto3（pip install boto3）") from e
+
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.public_base_url = public_base_url.rstrip("/") if public_base_url else None
+        self.presign_expires = presign_expires
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            max_concurrency=4,
+        )
+
+    def _object_key(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def upload_file(self, local_path: str, key: str) -> None:
+        content_type = "image/png" if key.lower().endswith(".png") else "image/jpeg"
+        self.client.upload_file(
+            local_path,
+            self.bucket,
+            self._object_key(key),
+            ExtraArgs={"ContentType": content_type, "CacheControl": "public, max-age=31536000, immutable"},
+            Config=self.transfer_config,
+        )
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def public_url(self, key: str) -> Optional[str]:
+        """配置了 CDN / 公共读地址时返回永久 URL，可直接记录在 Generation.image_url 中"""
+        if self.public_base_url:
+            return f"{self.public_base_url}/{self._object_key(key)}"
+        return None
+
+    def url_for(self, key: str) -> Optional[str]:
+        """返回可直接下载的 URL：优先 CDN 地址，否则生成有时效的预签名 URL"""
+        return self.public_url(key) or self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=self.presign_expires,
+        )
+
+
+class AsyncUploader:
+    """在后台线程池中上传文件，不占用请求处理时间"""
+
+    def __init__(self, storage, max_workers: int = 4):
+        self.storage = storage
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-upload")
+
+    def submit(self, local_path: str, key: str, on_done: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        提交一个上传任务
+
+        参数:
+            local_path: 本地文件路径
+            key: 存储中的对象键
+            on_done: 上传成功后的回调，参数为对象键
+        """
+        def _upload():
+            try:
+                self.storage.upload_file(local_path, key)
+                logging.info("图片上传完成：%s", key)
+                if on_done:
+                    on_done(key)
+            except Exception as e:
+                logging.error("图片上传失败：%s，错误：%s", key, e, exc_info=True)
+                raise
+
+        return self._executor.submit(_upload)
+
+
+def create_storage_from_env():
+    """根据环境变量创建存储后端：STORAGE_BACKEND=local（默认）或 s3"""
+    backend = os.getenv("STORAGE_BACKEND", "local").lower()
+    if backend == "s3":
+        return S3Storage(
+            bucket=os.environ["S3_BUCKET"],
+            prefix=os.getenv("S3_PREFIX", "generated_images"),
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+            region=os.getenv("S3_REGION"),
+            access_key=os.getenv("S3_ACCESS_KEY"),
+            secret_key=os.getenv("S3_SECRET_KEY"),
+            public_base_url=os.getenv("STORAGE_PUBLIC_BASE_URL"),
+            presign_expires=int(os.getenv("S3_PRESIGN_EXPIRES", "3600")),
+        )
+    return LocalStorage(os.getenv("IMAGES_PATH", "./images"))
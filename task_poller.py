@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+异步任务的多路轮询器
+功能：上游以"提交任务 + 查询结果"方式工作时，用一个调度线程和少量查询线程跟踪所有未完成的任务，
+      不为每个任务占用一个线程或一条长时间挂起的连接
+    1. 多路复用：所有任务按下一次查询时间放在一个小顶堆中，调度线程只负责到期派发，查询在线程池中执行
+    2. 自适应间隔：按最近完成任务耗时的 EWMA 估计完成时间；预计完成前按剩余时间的一半等待，
+       超过预计时间后从 min_interval 开始按 backoff 倍数增长，不超过 max_interval
+    3. 完成回调：watch() 返回 concurrent.futures.Future；第一次 watch 时可注册 on_done(task_id, 结果, 异常)，
+       在查询线程中先于 Future 执行，其返回值作为 Future 的结果（抛出的异常作为 Future 的异常）。
+       等待方醒来时回调的副作用（如写入检查点）已经完成，没有等待方（请求已超时）时回调同样执行。
+       同一个任务被多次 watch 时共用一个 Future 和回调，只查询一次
+    4. 失败：上游返回失败状态、连续 max_errors 次查询出错或超过 task_timeout 时以 TaskFailed 结束
+"""
+
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+TASK_PENDING = "pending"
+TASK_DONE = "done"
+TASK_FAILED = "failed"
+
+
+class TaskFailed(Exception):
+    """异步任务失败、过期或超时"""
+
+    def __init__(self, task_id: str, reason: str):
+        super().__init__(f"任务 {task_id} 失败：{reason}")
+        self.task_id = task_id
+        self.reason = reason
+
+
+class _WatchedTask:
+    def __init__(self, task_id: str, on_done: Optional[Callable]):
+        self.task_id = task_id
+        self.on_done = on_done
+        self.future = Future()
+        self.started = time.monotonic()
+        self.interval = 0.0
+        self.errors = 0
+        self.polls = 0
+
+
+class TaskPoller:
+    """
+    异步任务轮询器（线程安全，一个上游一个实例）
+
+    参数:
+        name: 上游名称，用于日志和线程名
+        fetch: 查询函数 fetch(task_id) -> (状态, 结果)，状态为 TASK_PENDING / TASK_DONE / TASK_FAILED；
+               TASK_FAILED 时结果为失败原因。抛出异常视为临时错误，稍后重试
+        workers: 查询线程数
+        min_interval / max_interval: 查询间隔的上下限（秒）
+        backoff: 超过预计完成时间后查询间隔的增长倍数
+        initial_estimate: 还没有完成样本时的预计完成时间（秒）
+        task_timeout: 任务的最长等待时间（秒）
+        max_errors: 连续查询出错的次数上限
+    """
+
+    def __init__(self, name: str, fetch: Callable, workers: int = 4, min_interval: float = 1.0,
+                 max_interval: float = 10.0, backoff: float = 1.5, initial_estimate: float = 20.0,
+                 task_timeout: float = 600.0, max_errors: int = 5):
+        self.name = name
+        self.fetch = fetch
+        self.workers = workers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.task_timeout = task_timeout
+        self.max_errors = max_errors
+        self._estimate = initial_estimate
+        self._tasks = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._pid = None
+        self._executor = None
+        self.counters = {"watched": 0, "polls": 0, "poll_errors": 0, "completed": 0, "failed": 0}
+
+    def watch(self, task_id: str, on_done: Optional[Callable] = None) -> Future:
+        """开始跟踪一个任务，返回其 Future；任务已在跟踪中时返回同一个 Future（忽略本次的 on_done）"""
+        with self._cond:
+            self._ensure_started()
+            task = self._tasks.get(task_id)
+            if task is not None:
+                return task.future
+            task = _WatchedTask(task_id, on_done)
+            self._tasks[task_id] = task
+            self.counters["watched"] += 1
+            self._schedule(task, self._next_delay(task))
+            self._cond.notify()
+            return task.future
+
+    def _next_delay(self, task: _WatchedTask) -> float:
+        remaining = self._estimate - (time.monotonic() - task.started)
+        if remaining > self.min_interval:
+            delay = remaining / 2
+        else:
+            delay = task.interval * self.backoff if task.interval else self.min_interval
+        task.interval = min(self.max_interval, max(self.min_interval, delay))
+        return task.interval
+
+    def _schedule(self, task: _WatchedTask, delay: float) -> None:
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), task))
+
+    def _ensure_started(self) -> None:
+        """按进程惰性启动调度线程和查询线程池（gunicorn fork 后的子进程各自启动）"""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"{self.name}-poll")
+        threading.Thread(target=self._loop, name=f"{self.name}-poller", daemon=True).start()
+
+    def _loop(self) -> None:
+        pid = os.getpid()
+        while True:
+            with self._cond:
+                if self._pid != pid:
+                    return
+                now = time.monotonic()
+                if not self._heap or self._heap[0][0] > now:
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                    continue
+                _, _, task = heapq.heappop(self._heap)
+                executor = self._executor
+            executor.submit(self._poll, task)
+
+    def _poll(self, task: _WatchedTask) -> None:
+        if time.monotonic() - task.started > self.task_timeout:
+            self._finish(task, error=TaskFailed(task.task_id, f"超过 {self.task_timeout:g} 秒未完成"))
+            return
+        task.polls += 1
+        try:
+            status, result = self.fetch(task.task_id)
+        except Exception as e:
+            task.errors += 1
+            with self._cond:
+                self.counters["polls"] += 1
+                self.counters["poll_errors"] += 1
+            if task.errors >= self.max_errors:
+                self._finish(task, error=TaskFailed(task.task_id, f"连续 {task.errors} 次查询失败：{e}"))
+                return
+            logging.warning("%s 任务 %s 查询失败（第 %d 次）：%s", self.name, task.task_id, task.errors, e)
+            with self._cond:
+                self._schedule(task, self._next_delay(task))
+                self._cond.notify()
+            return
+        task.errors = 0
+        with self._cond:
+            self.counters["polls"] += 1
+        if status == TASK_DONE:
+            self._finish(task, result=result)
+        elif status == TASK_FAILED:
+            self._finish(task, error=TaskFailed(task.task_id, str(result)))
+        else:
+            with self._cond:
+                self._schedule(task, self._next_delay(task))
+                self._cond.notify()
+
+    def _finish(self, task: _WatchedTask, result=None, error: Optional[Exception] = None) -> None:
+        elapsed = time.monotonic() - task.started
+        with self._cond:
+            if error is None:
+                self.counters["completed"] += 1
+                self._estimate = 0.8 * self._estimate + 0.2 * elapsed
+            else:
+                self.counters["failed"] += 1
+        if error is None:
+            logging.info("%s 任务 %s 完成（%.1f 秒，查询 %d 次）", self.name, task.task_id, elapsed, task.polls)
+        else:
+            logging.error("%s %s", self.name, error)
+        if task.on_done is not None:
+            try:
+                result = task.on_done(task.task_id, result, error)
+            except Exception as e:
+                logging.error("%s 任务 %s 的完成回调失败：%s", self.name, task.task_id, e, exc_info=True)
+                error = error or e
+        # 设置结果之后才移出跟踪表：回调执行期间再次 watch 同一任务时拿到的仍是这个 Future，不会重新查询
+        if error is None:
+            task.future.set_result(result)
+        else:
+            task.future.set_exception(error)
+        with self._cond:
+            self._tasks.pop(task.task_id, None)
+
+    def reset_after_fork(self) -> None:
+        """fork 后丢弃从父进程继承的任务和线程状态（子进程在第一次 watch 时重新启动）"""
+        with self._cond:
+            self._tasks.clear()
+            self._heap.clear()
+            self._pid = None
+            self._executor = None
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            stats = dict(self.counters)
+            stats["outstanding"] = len(self._tasks)
+            stats["estimated_seconds"] = round(self._estimate, 1)
+        return stats
+
+
+def create_task_poller_from_env(name: str, fetch: Callable) -> TaskPoller:
+    """按 <NAME>_POLL_* 环境变量创建，例如 JIMENG_POLL_WORKERS"""
+    prefix = f"{name.upper()}_POLL_"
+    return TaskPoller(
+        name, fetch,
+        workers=int(os.getenv(f"{prefix}WORKERS", "4")),
+        min_interval=float(os.getenv(f"{prefix}MIN_INTERVAL_SECONDS", "1")),
+        max_interval=float(os.getenv(f"{prefix}MAX_INTERVAL_SECONDS", "10")),
+        backoff=float(os.getenv(f"{prefix}BACKOFF", "1.5")),
+        initial_estimate=float(os.getenv(f"{prefix}INITIAL_ESTIMATE_SECONDS", "20")),
+        task_timeout=float(os.getenv(f"{prefix}TASK_TIMEOUT_SECONDS", "600")),
+    )
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import pytest
+
+from admission import (
+    PRIORITY_HIGH, PRIORITY_NORMAL, AdmissionRejected, UpstreamBudget, UserRateLimiter,
+)
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out waiting for condition"
+        time.sleep(0.005)
+
+
+def test_queue_grants_by_priority_then_round_robin_per_user():
+    budget = UpstreamBudget("jimeng", max_concurrency=1, max_queue=10, max_wait=5, max_queued_per_user=5)
+    budget.acquire(user_id=0)
+    granted = []
+
+    def waiter(label, user_id, priority):
+        budget.acquire(user_id, priority)
+        granted.append(label)
+
+    threads = []
+    for label, user_id, priority in [("a1", 1, PRIORITY_NORMAL), ("a2", 1, PRIORITY_NORMAL),
+                                     ("b1", 2, PRIORITY_NORMAL), ("c1", 3, PRIORITY_HIGH)]:
+        thread = threading.Thread(target=waiter, args=(label, user_id, priority), daemon=True)
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: budget.snapshot()["queued"] == len(threads))
+
+    # 每归还一个槽位只准入一个排队的请求
+    for expected in range(1, 5):
+        budget.release()
+        wait_until(lambda: len(granted) == expected)
+        assert budget.snapshot()["active"] == 1
+    for thread in threads:
+        thread.join(timeout=1)
+
+    # 高优先级优先；同一优先级内用户 1 的第二个请求排在用户 2 之后
+    assert granted == ["c1", "a1", "b1", "a2"]
+
+
+def test_full_queue_rejects_with_retry_after_and_position():
+    budget = UpstreamBudget("gemini", max_concurrency=1, max_queue=1, max_wait=5, max_queued_per_user=5)
+    budget.acquire(user_id=1)
+    threading.Thread(target=budget.acquire, args=(2,), daemon=True).start()
+    wait_until(lambda: budget.snapshot()["queued"] == 1)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        budget.acquire(user_id=3)
+    # 平均占用 10 秒、排在第 2 位、1 个槽位：预计 20 秒后有空位
+    assert rejected.value.reason == "gemini_queue_full"
+    assert rejected.value.queue_position == 2
+    assert rejected.value.retry_after == 20
+
+    budget.release()
+    wait_until(lambda: budget.snapshot()["queued"] == 0)
+
+
+def test_retry_after_follows_observed_hold_time():
+    budget = UpstreamBudget("gemini", max_concurrency=2, max_queue=0, max_wait=5, max_queued_per_user=5)
+    budget.acquire(user_id=1)
+    budget.release(hold_seconds=0)
+    budget.acquire(user_id=1)
+    budget.acquire(user_id=2)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        budget.acquire(user_id=3)
+    # 平均占用时长 0.8 * 10 + 0.2 * 0 = 8 秒，第 1 位、2 个槽位
+    assert rejected.value.retry_after == 4
+
+
+def test_per_user_queue_limit():
+    budget = UpstreamBudget("jimeng", max_concurrency=1, max_queue=10, max_wait=5, max_queued_per_user=1)
+    budget.acquire(user_id=1)
+    threading.Thread(target=budget.acquire, args=(2,), daemon=True).start()
+    wait_until(lambda: budget.snapshot()["queued"] == 1)
+
+    with pytest.raises(AdmissionRejected, match="jimeng_queue_full"):
+        budget.acquire(user_id=2)
+    budget.release()
+    wait_until(lambda: budget.snapshot()["queued"] == 0)
+
+
+def test_queue_timeout_rejects_and_leaves_queue():
+    budget = UpstreamBudget("jimeng", max_concurrency=1, max_queue=10, max_wait=0.05, max_queued_per_user=5)
+    budget.acquire(user_id=1)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        budget.acquire(user_id=2)
+    assert rejected.value.reason == "jimeng_queue_timeout"
+    assert rejected.value.queue_position == 1
+    assert rejected.value.retry_after == 10
+    assert budget.snapshot()["queued"] == 0
+    assert budget.stats["rejected_timeout"] == 1
+
+
+def test_rate_limiter_allows_burst_then_rejects():
+    limiter = UserRateLimiter(rate_per_minute=6, burst=2)
+    limiter.check(1)
+    limiter.check(1)
+    with pytest.raises(AdmissionRejected) as rejected:
+        limiter.check(1)
+    assert rejected.value.reason == "rate_limited"
+    assert rejected.value.retry_after == 10
+    # 其他用户有各自的令牌桶
+    limiter.check(2)
@@ -0,0 +1,84 @@
+import time
+
+from hedging import Hedger
+
+
+def slow(value, seconds=0.1):
+    def call():
+        time.sleep(seconds)
+        return value
+    return call
+
+
+def fast(value):
+    return lambda: value
+
+
+def make_hedger(**kwargs):
+    options = dict(initial_delay=0.01, min_samples=1000, burst=1, max_ratio=0)
+    options.update(kwargs)
+    return Hedger("test", **options)
+
+
+def test_hedge_wins_when_primary_is_slow():
+    hedger = make_hedger()
+
+    assert hedger.call(slow("primary"), fast("hedge")) == "hedge"
+    assert hedger.counters["hedged"] == 1
+    assert hedger.counters["hedge_wins"] == 1
+
+
+def test_no_hedge_without_budget_tokens():
+    hedger = make_hedger()
+    hedger.call(slow("primary"), fast("hedge"))
+
+    # 令牌已用完且不补充：第二次只能等主调用
+    assert hedger.call(slow("primary"), fast("hedge")) == "primary"
+    assert hedger.counters["hedged"] == 1
+    assert hedger.counters["denied_budget"] == 1
+    assert hedger.counters["primary_wins"] == 1
+
+
+def test_budget_refills_by_max_ratio_per_request():
+    hedger = make_hedger(max_ratio=0.5)
+    results = [hedger.call(slow("primary"), fast("hedge")) for _ in range(3)]
+
+    # 每个请求补充 0.5 个令牌：最多每两个请求对冲一次
+    assert results == ["hedge", "primary", "hedge"]
+    assert hedger.counters["hedged"] == 2
+    assert hedger.counters["denied_budget"] == 1
+
+
+def test_inflight_limit_blocks_hedges():
+    hedger = make_hedger(max_inflight=0)
+
+    assert hedger.call(slow("primary"), fast("hedge")) == "primary"
+    assert hedger.counters["hedged"] == 0
+    assert hedger.counters["denied_inflight"] == 1
+    assert hedger.snapshot()["tokens"] == 1
+
+
+def test_fast_primary_does_not_spend_budget():
+    hedger = make_hedger(initial_delay=1.0)
+
+    assert hedger.call(fast("primary"), fast("hedge")) == "primary"
+    assert hedger.counters["hedged"] == 0
+    assert hedger.snapshot()["tokens"] == 1
+
+
+def test_invalid_primary_is_returned_without_hedging():
+    hedger = make_hedger(initial_delay=1.0)
+
+    assert hedger.call(fast(None), fast("hedge"), is_valid=lambda value: value is not None) is None
+    assert hedger.counters["hedged"] == 0
+    assert hedger.counters["no_valid_result"] == 1
+
+
+def test_hedge_delay_adapts_within_bounds():
+    hedger = make_hedger(initial_delay=2.0, min_samples=3, min_delay=0.5, max_delay=1.0)
+    assert hedger.hedge_delay() == 2.0
+
+    for _ in range(3):
+        hedger.call(fast("primary"))
+    # 主调用都很快：分位数低于下限，取 min_delay
+    assert hedger.hedge_delay() == 0.5
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 日志配置是进程级的全局状态，在独立的子进程中验证
+FORKING_SERVER = textwrap.dedent("""
+    import logging, os, sys
+    from log_config import setup_logging, reinit_logging_after_fork
+    setup_logging("svc")
+    logging.info("master")
+    workers = []
+    for _ in range(2):
+        pid = os.fork()
+        if pid == 0:
+            reinit_logging_after_fork()
+            logging.info("worker")
+            sys.exit(0)
+        workers.append(pid)
+    for pid in workers:
+        os.waitpid(pid, 0)
+    print(" ".join(str(pid) for pid in workers))
+""")
+
+
+def test_forked_workers_write_their_own_files(tmp_path):
+    env = dict(os.environ, LOGS_PATH=str(tmp_path), LOG_CONSOLE="false", PYTHONPATH=ROOT)
+    output = subprocess.run([sys.executable, "-c", FORKING_SERVER], env=env, cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    workers = output.split()
+
+    assert sorted(os.listdir(tmp_path)) == sorted(["svc.log"] + [f"svc.{pid}.log" for pid in workers])
+    assert '"message": "master"' in (tmp_path / "svc.log").read_text(encoding="utf-8")
+    for pid in workers:
+        lines = (tmp_path / f"svc.{pid}.log").read_text(encoding="utf-8").splitlines()
+        assert len(lines) == 1 and '"message": "worker"' in lines[0]
@@ -0,0 +1,95 @@
+import pytest
+
+from pipeline import GenerationContext, Pipeline, RetryPolicy, Stage
+
+
+def recording_stage(name, calls, checkpoint=True, failures=(), retry=None):
+    """返回一个阶段：每次执行记入 calls，依次抛出 failures 中的异常，之后把阶段名写入 ctx.outputs"""
+    failures = list(failures)
+
+    def run(ctx):
+        calls.append(name)
+        if failures:
+            raise failures.pop(0)
+        ctx.outputs[name] = True
+
+    return Stage(name, run, retry=retry, checkpoint=checkpoint)
+
+
+def test_stage_retries_retryable_errors():
+    calls = []
+    retry = RetryPolicy(attempts=3, backoff=0, retry_on=(ConnectionError,))
+    stage = recording_stage("image", calls, failures=[ConnectionError("reset"), ConnectionError("reset")], retry=retry)
+    ctx = Pipeline("meme", [stage]).run(GenerationContext("generate_meme", user_id=1))
+
+    assert calls == ["image"] * 3
+    assert ctx.outputs["image"] is True
+    assert "image" in ctx.timings
+    assert ctx.failed_stage is None
+
+
+def test_stage_gives_up_after_attempts():
+    calls = []
+    retry = RetryPolicy(attempts=2, backoff=0, retry_on=(ConnectionError,))
+    stage = recording_stage("image", calls, failures=[ConnectionError("a"), ConnectionError("b")], retry=retry)
+    ctx = GenerationContext("generate_meme", user_id=1)
+
+    with pytest.raises(ConnectionError, match="b"):
+        Pipeline("meme", [stage]).run(ctx)
+    assert calls == ["image", "image"]
+    assert ctx.failed_stage == "image"
+    assert ctx.completed == []
+
+
+def test_stage_does_not_retry_other_errors():
+    calls = []
+    retry = RetryPolicy(attempts=3, backoff=0, retry_on=(ConnectionError,))
+    stage = recording_stage("image", calls, failures=[ValueError("bad prompt")], retry=retry)
+    ctx = GenerationContext("generate_meme", user_id=1)
+
+    with pytest.raises(ValueError):
+        Pipeline("meme", [stage]).run(ctx)
+    assert calls == ["image"]
+    assert ctx.failed_stage == "image"
+
+
+def test_run_skips_checkpointed_stages():
+    calls, checkpoints = [], []
+    stages = [
+        recording_stage("prompt", calls),
+        recording_stage("image", calls),
+        recording_stage("store", calls, checkpoint=False),
+    ]
+    pipeline = Pipeline("meme", stages, on_checkpoint=lambda ctx: checkpoints.append(list(ctx.completed)))
+    ctx = GenerationContext("generate_meme", user_id=1, completed=["prompt"])
+
+    pipeline.run(ctx)
+
+    assert calls == ["image", "store"]
+    assert ctx.completed == ["prompt", "image"]
+    assert checkpoints == [["prompt", "image"]]
+
+
+def test_failed_stage_keeps_earlier_checkpoints():
+    calls = []
+    stages = [recording_stage("prompt", calls), recording_stage("image", calls, failures=[RuntimeError("down")])]
+    ctx = GenerationContext("generate_meme", user_id=1)
+
+    with pytest.raises(RuntimeError):
+        Pipeline("meme", stages).run(ctx)
+    assert ctx.completed == ["prompt"]
+
+    # 重试时只从失败的阶段继续
+    calls.clear()
+    ctx.failed_stage = None
+    Pipeline("meme", stages).run(ctx)
+    assert calls == ["image"]
+    assert ctx.completed == ["prompt", "image"]
+
+
+def test_on_stage_done_reports_each_stage():
+    done = []
+    stages = [recording_stage("prompt", []), recording_stage("image", [])]
+    Pipeline("meme", stages, on_stage_done=lambda ctx, stage, ms: done.append((stage, ms >= 0))).run(
+        GenerationContext("generate_meme", user_id=1))
+    assert done == [("prompt", True), ("image", True)]
@@ -0,0 +1,15 @@
+from flask import Flask, request
+
+from profiling import profiled_path
+
+app = Flask(__name__)
+
+
+def test_profile_token_is_not_recorded():
+    with app.test_request_context("/api/history?page=2&profile=secret-token&page_size=20"):
+        assert profiled_path(request) == "/api/history?page=2&page_size=20"
+
+
+def test_path_without_other_args():
+    with app.test_request_context("/api/user?profile=secret-token"):
+        assert profiled_path(request) == "/api/user"
@@ -0,0 +1,104 @@
+import threading
+
+import pytest
+
+from task_poller import TASK_DONE, TASK_FAILED, TASK_PENDING, TaskFailed, TaskPoller
+
+
+class FakeUpstream:
+    """按任务返回预设的状态序列，最后一个状态一直保持"""
+
+    def __init__(self, **statuses):
+        self.statuses = {task_id: list(sequence) for task_id, sequence in statuses.items()}
+        self.polls = {}
+        self.lock = threading.Lock()
+
+    def fetch(self, task_id):
+        with self.lock:
+            self.polls[task_id] = self.polls.get(task_id, 0) + 1
+            sequence = self.statuses[task_id]
+            outcome = sequence.pop(0) if len(sequence) > 1 else sequence[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def make_poller(upstream, **kwargs):
+    options = dict(workers=2, min_interval=0.01, max_interval=0.02, initial_estimate=0.01, task_timeout=5)
+    options.update(kwargs)
+    return TaskPoller("test", upstream.fetch, **options)
+
+
+def test_task_completes_after_pending_polls():
+    upstream = FakeUpstream(t1=[(TASK_PENDING, None), (TASK_PENDING, None), (TASK_DONE, ["a.png"])])
+    poller = make_poller(upstream)
+
+    assert poller.watch("t1").result(timeout=2) == ["a.png"]
+    assert upstream.polls["t1"] == 3
+    stats = poller.snapshot()
+    assert stats["completed"] == 1 and stats["outstanding"] == 0
+
+
+def test_failed_task_raises_task_failed():
+    upstream = FakeUpstream(t1=[(TASK_PENDING, None), (TASK_FAILED, "content rejected")])
+    poller = make_poller(upstream)
+
+    with pytest.raises(TaskFailed) as failed:
+        poller.watch("t1").result(timeout=2)
+    assert failed.value.task_id == "t1"
+    assert failed.value.reason == "content rejected"
+    assert poller.snapshot()["failed"] == 1
+
+
+def test_repeated_poll_errors_fail_the_task():
+    upstream = FakeUpstream(t1=[ConnectionError("reset")])
+    poller = make_poller(upstream, max_errors=3)
+
+    with pytest.raises(TaskFailed, match="3"):
+        poller.watch("t1").result(timeout=2)
+    assert upstream.polls["t1"] == 3
+
+
+def test_on_done_runs_before_future_and_sets_its_result():
+    upstream = FakeUpstream(t1=[(TASK_PENDING, None), (TASK_DONE, ["a.png"])])
+    poller = make_poller(upstream)
+    seen = []
+
+    def on_done(task_id, result, error):
+        # 回调执行时 Future 尚未完成，再次 watch 拿到的仍是同一个 Future
+        seen.append((task_id, result, error, future.done(), poller.watch("t1") is future))
+        return ["stored.png"]
+
+    future = poller.watch("t1", on_done=on_done)
+    assert future.result(timeout=2) == ["stored.png"]
+    assert seen == [("t1", ["a.png"], None, False, True)]
+
+
+def test_on_done_receives_failure_and_errors_propagate():
+    upstream = FakeUpstream(t1=[(TASK_FAILED, "expired")], t2=[(TASK_DONE, ["b.png"])])
+    poller = make_poller(upstream)
+    errors = []
+
+    def record_failure(task_id, result, error):
+        errors.append(error)
+
+    with pytest.raises(TaskFailed):
+        poller.watch("t1", on_done=record_failure).result(timeout=2)
+    assert isinstance(errors[0], TaskFailed)
+
+    def broken_callback(task_id, result, error):
+        raise RuntimeError("checkpoint write failed")
+
+    with pytest.raises(RuntimeError, match="checkpoint write failed"):
+        poller.watch("t2", on_done=broken_callback).result(timeout=2)
+
+
+def test_watch_deduplicates_tasks():
+    upstream = FakeUpstream(t1=[(TASK_PENDING, None), (TASK_DONE, ["a.png"])])
+    poller = make_poller(upstream)
+
+    first, second = poller.watch("t1"), poller.watch("t1")
+    assert first is second
+    assert first.result(timeout=2) == ["a.png"]
+    assert upstream.polls["t1"] == 2
+    assert poller.snapshot()["watched"] == 1
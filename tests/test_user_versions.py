@@ -0,0 +1,15 @@
+from user_versions import DisabledVersionStore, LocalVersionStore, create_version_store_from_env
+
+
+def test_single_process_uses_local_versions(monkeypatch):
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    monkeypatch.delenv("WEB_CONCURRENCY", raising=False)
+    assert isinstance(create_version_store_from_env(), LocalVersionStore)
+
+
+def test_multiple_workers_without_redis_disable_versions(monkeypatch):
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    store = create_version_store_from_env()
+    assert isinstance(store, DisabledVersionStore)
+    assert store.token(1) is None
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+轻量级分布式追踪
+功能：在 app.py、新加坡代理和即梦调用之间关联同一个请求的耗时
+    1. 按 W3C Trace Context 规范解析和注入 traceparent 请求头，跨进程延续同一个 trace
+    2. Span 记录名称、起止时间、属性和错误，通过 contextvars 维护当前 Span，嵌套调用自动形成父子关系
+    3. Span 结束后交给可插拔的导出器：内存环形缓冲（供管理接口查询）、JSON Lines 文件、
+       或通过 TRACING_EXPORTER=模块:类名 指定的自定义导出器（如对接 OpenTelemetry Collector）
+环境变量：TRACING_EXPORTER（none / memory / file / 模块:类名，默认 memory）、TRACING_FILE、
+    TRACING_MEMORY_SPANS、TRACING_SAMPLE_RATE
+"""
+
+import os
+import re
+import json
+import time
+import random
+import logging
+import importlib
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+# traceparent: 版本-trace_id-parent_id-flags，如 00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01
+TRACEPARENT_PATTERN = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class SpanContext:
+    """跨进程传递的追踪上下文"""
+
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool = True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def to_traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    @classmethod
+    def from_traceparent(cls, header: Optional[str]) -> Optional["SpanContext"]:
+        """解析 traceparent 请求头，格式不合法时返回 None（按规范视为没有上游上下文）"""
+        match = TRACEPARENT_PATTERN.match((header or "").strip().lower())
+        if not match:
+            return None
+        version, trace_id, span_id, flags = match.groups()
+        if version == "ff" or trace_id == "0" * 32 or span_id == "0" * 16:
+            return None
+        return cls(trace_id, span_id, sampled=bool(int(flags, 16) & 0x01))
+
+
+class Span:
+    """一次操作的耗时记录"""
+
+    def __init__(self, tracer, name: str, context: SpanContext, parent_id: Optional[str], attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.error = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, exc: BaseException) -> None:
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self) -> None:
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = round((time.perf_counter() - self._start) * 1000, 3)
+        if self.context.sampled:
+            self.tracer.export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "service": self.tracer.service,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class InMemoryExporter:
+    """保存最近 max_spans 个 Span 的环形缓冲，可按 trace 查询；适合离线排查和管理接口"""
+
+    def __init__(self, max_spans: int = 5000):
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span.to_dict())
+
+    def get_trace(self, trace_id: str) -> list:
+        with self._lock:
+            spans = [s for s in self._spans if s["trace_id"] == trace_id]
+        return sorted(spans, key=lambda s: s["start_time"])
+
+    def slowest_roots(self, limit: int = 20, name_prefix: str = "") -> list:
+        """本进程内最慢的根 Span（没有本地父 Span 的入口请求），用于定位尾延迟"""
+        with self._lock:
+            roots = [s for s in self._spans if s["attributes"].get("span.root") and s["name"].startswith(name_prefix)]
+        return sorted(roots, key=lambda s: s["duration_ms"], reverse=True)[:limit]
+
+
+class FileExporter:
+    """以 JSON Lines 追加写入文件，便于离线用 jq / pandas 分析"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+class Tracer:
+    """创建 Span 并交给导出器；exporter 为 None 时只传播上下文，不记录"""
+
+    def __init__(self, service: str, exporter=None, sample_rate: float = 1.0):
+        self.service = service
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def export(self, span: Span) -> None:
+        if self.exporter is None:
+            return
+        try:
+            self.exporter.export(span)
+        except Exception as e:
+            logging.warning("导出 Span 失败：%s", e)
+
+    def current_span(self) -> Optional[Span]:
+        return _current_span.get()
+
+    def start_span(self, name: str, parent: Optional[SpanContext] = None, **attributes) -> Span:
+        """
+        创建一个 Span（不设为当前 Span，需要调用方自行 end）
+
+        参数:
+            name: Span 名称
+            parent: 上游传入的上下文；为 None 时使用当前 Span，没有当前 Span 则开启新的 trace
+            attributes: Span 属性
+        """
+        if parent is None:
+            current = _current_span.get()
+            parent = current.context if current is not None else None
+        if parent is None:
+            context = SpanContext(f"{random.getrandbits(128):032x}", f"{random.getrandbits(64):016x}",
+                                  sampled=random.random() < self.sample_rate)
+            parent_id = None
+        else:
+            context = SpanContext(parent.trace_id, f"{random.getrandbits(64):016x}", parent.sampled)
+            parent_id = parent.span_id
+        if _current_span.get() is None:
+            attributes["span.root"] = True
+        return Span(self, name, context, parent_id, attributes)
+
+    def activate(self, span: Span):
+        """把 span 设为当前 Span，返回用于 deactivate 的令牌"""
+        return _current_span.set(span)
+
+    def deactivate(self, token) -> None:
+        _current_span.reset(token)
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[SpanContext] = None, **attributes):
+        """在 with 语句块内记录一个 Span，异常会记录到 Span 上并继续抛出"""
+        span = self.start_span(name, parent, **attributes)
+        token = self.activate(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            self.deactivate(token)
+            span.end()
+
+    def inject(self, headers: dict) -> dict:
+        """把当前 Span 的上下文写入 traceparent 请求头"""
+        current = _current_span.get()
+        if current is not None:
+            headers["traceparent"] = current.context.to_traceparent()
+        return headers
+
+
+def create_exporter_from_env():
+    """根据 TRACING_EXPORTER 创建导出器：none / memory（默认）/ file / 模块:类名"""
+    kind = os.getenv("TRACING_EXPORTER", "memory")
+    if kind == "none":
+        return None
+    if kind == "memory":
+        return InMemoryExporter(int(os.getenv("TRACING_MEMORY_SPANS", "5000")))
+    if kind == "file":
+        default_path = os.path.join(os.getenv("LOGS_PATH", "./logs"), "traces.jsonl")
+        return FileExporter(os.getenv("TRACING_FILE", default_path))
+    module_name, _, class_name = kind.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+_tracer = Tracer("unknown")
+
+
+def configure_tracer(service: str) -> Tracer:
+    """在进程入口调用一次：按环境变量创建本进程的 Tracer，供 get_tracer() 返回"""
+    global _tracer
+    _tracer = Tracer(service, create_exporter_from_env(), float(os.getenv("TRACING_SAMPLE_RATE", "1.0")))
+    return _tracer
+
+
+def get_tracer() -> Tracer:
+    """返回本进程的 Tracer；未配置时只传播上下文，不记录 Span"""
+    return _tracer
+
+
+def instrument_flask(app, tracer: Tracer) -> None:
+    """为 Flask 应用的每个请求创建入口 Span：延续请求头中的 traceparent，并在响应头 X-Trace-Id 中返回 trace ID"""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_span():
+        parent = SpanContext.from_traceparent(request.headers.get("traceparent"))
+        route = request.url_rule.rule if request.url_rule else request.path
+        span = tracer.start_span(f"{request.method} {route}", parent, **{"http.path": request.path})
+        g.trace_span, g.trace_token = span, tracer.activate(span)
+
+    @app.after_request
+    def record_response_status(response):
+        span = g.get("trace_span")
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            response.headers["X-Trace-Id"] = span.context.trace_id
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        span = g.pop("trace_span", None)
+        if span is None:
+            return
+        if exc is not None:
+            span.record_error(exc)
+        tracer.deactivate(g.pop("trace_token"))
+        span.end()
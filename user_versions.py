@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+用户数据版本号与响应缓存
+功能：为轮询接口（/api/user、/api/history）提供条件请求支持
+    1. 每个用户一个版本号，额度或生成记录状态变化时递增；另有一个全局纪元，批量操作（如保留策略清理）后递增
+    2. ETag 由版本号派生，客户端携带的 If-None-Match 未过期时直接返回 304，不查询数据库
+    3. 序列化后的历史记录分页按版本号缓存在进程内存中，版本变化后自动失效
+环境依赖：多进程部署（或 flask retention-sweep 等命令需要让 ETag 失效）时需配置 REDIS_URL 并安装 redis；
+    未配置时版本号保存在进程内存中，只适用于单进程部署；WEB_CONCURRENCY（gunicorn.conf.py 在工作进程中设置）
+    大于 1 时不提供版本号
+"""
+
+import os
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class LocalVersionStore:
+    """进程内存中的版本号，进程重启后实例标识变化，旧的 ETag 全部失效"""
+
+    def __init__(self):
+        self.instance = uuid.uuid4().hex[:8]
+        self._epoch = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def token(self, user_id) -> Optional[str]:
+        with self._lock:
+            return f"{self.instance}.{self._epoch}.{self._versions.get(str(user_id), 0)}"
+
+    def bump(self, user_id) -> None:
+        with self._lock:
+            key = str(user_id)
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def bump_all(self) -> None:
+        with self._lock:
+            self._epoch += 1
+
+
+class DisabledVersionStore:
+    """不提供版本号：多进程部署但没有共享存储时使用，接口每次返回完整响应，避免各进程版本号不一致导致错误的 304"""
+
+    def token(self, user_id) -> Optional[str]:
+        return None
+
+    def bump(self, user_id) -> None:
+        pass
+
+    def bump_all(self) -> None:
+        pass
+
+
+class RedisVersionStore:
+    """Redis 中的版本号，所有进程共享；Redis 不可用时不返回版本号（接口退化为每次完整响应）"""
+
+    def __init__(self, url: str, prefix: str = "user_version:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("REDIS_URL 需要安装 redis（pip install redis）") from e
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.errors = redis.RedisError
+        self.prefix = prefix
+        # 实例标识：Redis 数据被清空后版本号从 0 重新计数，标识随之变化，避免与旧的 ETag 撞车
+        instance_key = f"{prefix}instance"
+        self.client.set(instance_key, uuid.uuid4().hex[:8], nx=True)
+        self.instance = self.client.get(instance_key).decode()
+
+    def token(self, user_id) -> Optional[str]:
+        try:
+            epoch, version = self.client.mget(f"{self.prefix}epoch", f"{self.prefix}{user_id}")
+        except self.errors as e:
+            logging.warning("读取用户版本号失败：%s", e)
+            return None
+        return f"{self.instance}.{int(epoch or 0)}.{int(version or 0)}"
+
+    def bump(self, user_id) -> None:
+        try:
+            self.client.incr(f"{self.prefix}{user_id}")
+        except self.errors as e:
+            logging.error("递增用户 %s 的版本号失败：%s", user_id, e)
+
+    def bump_all(self) -> None:
+        try:
+            self.client.incr(f"{self.prefix}epoch")
+        except self.errors as e:
+            logging.error("递增全局版本号失败：%s", e)
+
+
+class PageCache:
+    """按版本号校验的 LRU 缓存：版本号不一致的条目视为未命中"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get(self, key, token: Optional[str]) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if token is None or entry is None or entry[0] != token:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, token: Optional[str], body: bytes) -> None:
+        if token is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (token, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def create_version_store_from_env():
+    """
+    根据环境变量创建版本号存储：配置了 REDIS_URL 时使用 Redis；否则单进程部署使用进程内存，
+    多进程部署（WEB_CONCURRENCY 大于 1）不提供版本号，避免各进程版本号不一致导致错误的 304
+    """
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        return RedisVersionStore(redis_url)
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        logging.warning("多进程部署未配置 REDIS_URL，各进程的用户版本号不一致，已关闭 /api/user、/api/history 的 ETag。")
+        return DisabledVersionStore()
+    return LocalVersionStore()